@@ -0,0 +1,188 @@
+# Benchmarks for the patient operations, runs fully offline:
+#   python benchmarks/run_benchmarks.py --days 90 --patients 300 --json bench.json
+# Every backend but legacy-json is the repository the desks run (patient_repository.py).
+# mysql is left out by default: it needs a server, and seeds whatever database
+# db_pool.DB_CONFIG points at, so point that at a scratch one first.
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+
+from patient_repository import make_repository
+import workload
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Timer:
+    """Collects per-operation latencies in seconds."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def run(self, operation, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(operation, []).append(time.perf_counter() - started)
+        return result
+
+    def report(self, backend):
+        rows = []
+        for operation, samples in self.samples.items():
+            rows.append({
+                "backend": backend,
+                "operation": operation,
+                "count": len(samples),
+                "p50_ms": percentile(samples, 0.50) * 1000,
+                "p95_ms": percentile(samples, 0.95) * 1000,
+                "p99_ms": percentile(samples, 0.99) * 1000,
+                "ops_per_s": len(samples) / sum(samples) if sum(samples) else float("inf"),
+            })
+        return rows
+
+
+def new_record(rng, patient_id):
+    return workload.make_record(rng, patient_id, datetime.datetime.now(), 1)
+
+
+# Each backend exposes the same four operations the front ends perform:
+# new_patient(rng), lookup(patient_id), update_medicine(patient_id, medicine), pharmacy_fetch(patient_id)
+
+class LegacyJsonBackend:
+    """The original load_data/save_data path: parse everything, scan today, rewrite everything."""
+
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.next_id = 10 ** 6
+
+    def load_data(self):
+        with open(self.data_file, "r") as file:
+            return json.load(file)
+
+    def save_data(self, data):
+        with open(self.data_file, "w") as file:
+            json.dump(data, file, indent=4)
+
+    def new_patient(self, rng):
+        data = self.load_data()
+        self.next_id += 1
+        data.setdefault(str(datetime.date.today()), []).append(new_record(rng, str(self.next_id)))
+        self.save_data(data)
+
+    def lookup(self, patient_id):
+        data = self.load_data()
+        for record in data.get(str(datetime.date.today()), []):
+            if record["patient_id"] == patient_id:
+                return record
+        return None
+
+    def update_medicine(self, patient_id, medicine):
+        data = self.load_data()
+        for record in data.get(str(datetime.date.today()), []):
+            if record["patient_id"] == patient_id:
+                record["issued_medicine"] += f"\n{medicine}"
+                self.save_data(data)
+                return
+
+    pharmacy_fetch = lookup
+
+
+class RepositoryBackend:
+    """A shipped repository (see make_repository), with a second one on the same data standing in for the pharmacy."""
+
+    def __init__(self, backend, data_file, data):
+        self.desk = make_repository(backend, data_file)
+        self.desk.initialize()
+        if backend == "json":
+            workload.seed_json(self.desk, data)
+        elif backend == "sqlite":
+            workload.seed_sqlite(self.desk, data)
+        else:
+            workload.seed_mysql(data)
+        self.pharmacy = make_repository(backend, data_file, read_only=True)
+        self.pharmacy.initialize()
+
+    def new_patient(self, rng):
+        self.desk.create(workload.make_fields(rng))
+
+    def lookup(self, patient_id):
+        return self.desk.get(patient_id)
+
+    def update_medicine(self, patient_id, medicine):
+        self.desk.update_medicine(patient_id, medicine, "")
+
+    def pharmacy_fetch(self, patient_id):
+        return self.pharmacy.get(patient_id)
+
+
+def run_backend(name, backend, patient_ids, operations, seed):
+    rng = random.Random(seed)
+    timer = Timer()
+    for _ in range(operations):
+        timer.run("new_patient", backend.new_patient, rng)
+    for _ in range(operations):
+        timer.run("lookup", backend.lookup, rng.choice(patient_ids))
+    for _ in range(operations):
+        timer.run("update_medicine", backend.update_medicine, rng.choice(patient_ids), rng.choice(workload.MEDICINES))
+    for _ in range(operations):
+        timer.run("pharmacy_fetch", backend.pharmacy_fetch, rng.choice(patient_ids))
+    return timer.report(name)
+
+
+def print_report(rows):
+    print(f"{'backend':<16}{'operation':<18}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>12}")
+    for row in rows:
+        print(f"{row['backend']:<16}{row['operation']:<18}{row['count']:>7}"
+              f"{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['p99_ms']:>10.3f}{row['ops_per_s']:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the core patient operations against synthetic hospital data.")
+    parser.add_argument("--days", type=int, default=30, help="days of history to generate")
+    parser.add_argument("--patients", type=int, default=200, help="patients per day")
+    parser.add_argument("--history", type=int, default=6, help="most medication entries per record")
+    parser.add_argument("--operations", type=int, default=200, help="timed calls per operation")
+    parser.add_argument("--backends", default="legacy-json,json,sqlite", help="any of legacy-json, json, sqlite, mysql")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write results to this file, for tracking regressions")
+    args = parser.parse_args()
+
+    data = workload.generate(args.days, args.patients, args.history, seed=args.seed)
+    today = str(datetime.date.today())
+    # Lookups hit today's patients and returning patients from earlier days
+    patient_ids = [record["patient_id"] for records in data.values() for record in records]
+    patient_ids = [record["patient_id"] for record in data[today]] + random.Random(args.seed).sample(
+        patient_ids, min(len(patient_ids), len(data[today])))
+
+    workdir = tempfile.mkdtemp(prefix="hospital-bench-")
+    print(f"{args.days} days x {args.patients} patients, {args.operations} ops each, data in {workdir}\n")
+
+    rows = []
+    for name in args.backends.split(","):
+        data_file = os.path.join(workdir, f"{name}.json")
+        if name == "legacy-json":
+            workload.write_json(data, data_file)
+            backend = LegacyJsonBackend(data_file)
+        elif name in ("json", "sqlite", "mysql"):
+            backend = RepositoryBackend(name, data_file, data)
+        else:
+            parser.error(f"unknown backend {name}")
+        rows.extend(run_backend(name, backend, patient_ids, args.operations, args.seed))
+
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args": vars(args), "results": rows}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
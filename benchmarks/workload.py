@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+import random
+from medications import new_entry
+from daily_rollups import visit_keys
+
+BLOOD_GROUPS = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]
+GENDERS = ["Male", "Female", "Other"]
+MEDICINES = ["Paracetamol 500mg", "Amoxicillin 250mg", "Metformin 500mg", "Insulin 10 units",
+             "Cetirizine 10mg", "Omeprazole 20mg", "Atorvastatin 10mg", "Azithromycin 500mg",
+             "Ibuprofen 400mg", "Salbutamol inhaler", "Amlodipine 5mg", "ORS sachet"]
+FIRST_NAMES = ["Aarav", "Diya", "Ishaan", "Kavya", "Rohan", "Ananya", "Vikram", "Meera", "Arjun", "Priya"]
+LAST_NAMES = ["Sharma", "Iyer", "Reddy", "Nair", "Patel", "Gupta", "Khan", "Das", "Menon", "Rao"]
+
+def make_fields(rng):
+    """What a doctor desk types in for a new patient (patient_repository.PATIENT_FIELDS)."""
+    return {
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "blood_group": rng.choice(BLOOD_GROUPS),
+        "age": str(rng.randint(1, 95)),
+        "gender": rng.choice(GENDERS),
+        "issued_medicine": rng.choice(MEDICINES),
+        "additional_prescription": rng.choice(["", "Review after 5 days", "Take after food", "Bed rest"]),
+    }
+
+
+def make_record(rng, patient_id, when, history_lines):
+    """One patient record as the stores keep it now, with history_lines medication entries issued from when on."""
+    record = dict(make_fields(rng), patient_id=patient_id, issued_medicine="", date=when.isoformat(), version=0)
+    record["medications"] = []
+    for number in range(history_lines):
+        entry = new_entry(rng.choice(MEDICINES))
+        entry["issued_at"] = (when + datetime.timedelta(minutes=number)).isoformat(timespec="seconds")
+        record["medications"].append(entry)
+    # One version per entry after the first, as update_medicine would have left it
+    record["version"] = max(history_lines - 1, 0)
+    return record
+
+
+def generate(days, patients_per_day, history_lines=6, seed=1, end=None):
+    """Return {date: [records]} covering `days` days ending on `end` (default today)."""
+    rng = random.Random(seed)
+    end = end or datetime.date.today()
+    data = {}
+    next_id = 1
+    for day in range(days):
+        visit_date = end - datetime.timedelta(days=days - 1 - day)
+        records = []
+        for number in range(patients_per_day):
+            when = datetime.datetime.combine(visit_date, datetime.time(8)) + datetime.timedelta(seconds=number * 20)
+            records.append(make_record(rng, str(next_id).zfill(6), when, rng.randint(1, history_lines)))
+            next_id += 1
+        data[str(visit_date)] = records
+    return data
+
+
+def write_json(data, data_file):
+    """Write data as one file keyed by date, the way the original apps kept everything."""
+    with open(data_file, "w") as file:
+        json.dump(data, file, indent=4)
+
+
+def seed_json(repository, data):
+    """Load data into a JsonRepository's journal store, then compact it into day segments."""
+    with repository.store.lock:
+        repository.store.add_records((visit_date, record) for visit_date, records in data.items() for record in records)
+        repository.store.compact()
+    repository.allocator.advance_past(last_patient_id(data))
+
+
+def seed_sqlite(repository, data):
+    """Load data into a SqliteRepository in one transaction, through its own insert helpers."""
+    conn = repository.connect()
+    conn.execute("BEGIN IMMEDIATE")
+    for visit_date, records in data.items():
+        for record in records:
+            prescription_id = repository._insert(conn, record, visit_date)
+            for entry in record["medications"]:
+                repository._add_entry(conn, prescription_id, entry)
+            repository._count(conn, visit_keys(visit_date, record))
+    conn.execute("UPDATE patient_id_sequence SET last_id = MAX(last_id, ?) WHERE id = 1", (int(last_patient_id(data)),))
+    conn.execute("COMMIT")
+
+
+def seed_mysql(data):
+    """Load data into the MySQL database db_pool.DB_CONFIG points at. Use a scratch database."""
+    from db_pool import pool
+    from mysql_repository import insert_prescription, add_medication, add_rollups
+    conn = pool.acquire()
+    cursor = conn.cursor(prepared=True)
+    try:
+        for visit_date, records in data.items():
+            for record in records:
+                prescription_id = insert_prescription(cursor, record["patient_id"], record, visit_date)
+                for entry in record["medications"]:
+                    add_medication(cursor, prescription_id, entry)
+            add_rollups(cursor, [key for record in records for key in visit_keys(visit_date, record)])
+            conn.commit()
+        cursor.execute("UPDATE patient_id_sequence SET last_id = GREATEST(last_id, %s) WHERE id = 1",
+                       (int(last_patient_id(data)),))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def last_patient_id(data):
+    return max((record["patient_id"] for records in data.values() for record in records), default="0")
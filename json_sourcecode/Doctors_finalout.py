@@ -1,50 +1,47 @@
 import tkinter as tk
 from tkinter import messagebox
-import random
 import pyperclip
-import json
 import os
 import datetime
+from patient_repository import open_repository
+from task_runner import TaskRunner, show_error
+from journal_store import StaleRecordError
+from metrics import start_export
+from prescription_feed import publish
+from device_presence import biometric_device
+from biometric_index import BiometricIndex, hash_fingerprint, SIMULATED_FINGERPRINT
 
 # JSON file to store patient data
 DATA_FILE = "data.json"
 
-def load_data():
-    """Load data from the JSON file. If the file is empty or corrupted, initialize it with an empty dictionary."""
-    if not os.path.exists(DATA_FILE):
-        return {}
-    
-    with open(DATA_FILE, "r") as file:
-        # Check if the file is empty
-        if os.stat(DATA_FILE).st_size == 0:
-            return {}
+# Storage backend: "json" (data.json plus its journal), "sqlite", "mysql", "hybrid" (MySQL that keeps
+# working offline) or "service" (a shared patient_service.py), see patient_repository.py
+BACKEND = os.environ.get("HOSPITAL_BACKEND", "json")
+repository = open_repository(BACKEND, DATA_FILE)
+
+# Probed in the background so the Biometric ID button answers instantly
+device = biometric_device()
 
-        return json.load(file)
+# Fingerprint hash -> patient ID, shared with the pharmacy
+biometrics = BiometricIndex(DATA_FILE + ".biometrics")
+# Fingerprint scanned for a patient not enrolled yet, enrolled once their record is saved
+pending_biometric_hash = None
+
+def load_data():
+    """Load every day from the JSON segments and replay any journaled changes on top of it. JSON backend only."""
+    repository.store.load()
+    return {date: repository.store.day(date) for date in repository.store.days()}
 
 def save_data(data):
-    """Save data to the JSON file."""
-    with open(DATA_FILE, "w") as file:
-        json.dump(data, file, indent=4)
+    """Save data to the JSON file. Replaces everything, so prefer the repository. JSON backend only."""
+    repository.store.replace(data)
 
 def create_patient_table():
-    """Initialize the JSON database if it doesn't exist or is empty."""
-    if not os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "w") as file:
-            json.dump({}, file)
-    else:
-        # If the file exists but is empty, reset it to an empty dictionary
-        if os.stat(DATA_FILE).st_size == 0:
-            with open(DATA_FILE, "w") as file:
-                json.dump({}, file)
-
-def get_random_patient_id():
-    """Generate a random 3-digit patient ID."""
-    return str(random.randint(100, 999)).zfill(3)
+    """Initialize the database if it doesn't exist or is empty."""
+    repository.initialize()
 
 def submit_new_patient(patient_id=None):
     """Submit a new patient's data."""
-    data = load_data()
-    patient_id = patient_id or get_random_patient_id()  # Use the provided patient_id or generate a new one
     name = name_entry.get()
     blood_group = blood_group_entry.get()
     age = age_entry.get()
@@ -56,22 +53,23 @@ def submit_new_patient(patient_id=None):
         messagebox.showwarning("Input Error", "Please fill all fields.")
         return
 
-    today = str(datetime.date.today())
-    if today not in data:
-        data[today] = []
-
-    data[today].append({
-        "patient_id": patient_id,
+    fields = {
         "name": name,
         "blood_group": blood_group,
         "age": age,
         "gender": gender,
         "issued_medicine": issued_medicine,
-        "additional_prescription": additional_prescription,
-        "date": datetime.datetime.now().isoformat()
-    })
-
-    save_data(data)
+        "additional_prescription": additional_prescription
+    }
+    runner.submit("submit", repository.create, fields, patient_id, on_done=new_patient_saved)
+
+def new_patient_saved(patient_id):
+    global pending_biometric_hash
+    if pending_biometric_hash is not None:
+        runner.submit(("enroll", patient_id), biometrics.enroll, pending_biometric_hash, patient_id)
+        pending_biometric_hash = None
+    # Saved, so the pharmacy can put them on its pending list straight away
+    publish(patient_id, "new")
     messagebox.showinfo("Success", f"New patient added with Patient ID: {patient_id}")
     clear_fields()
 
@@ -82,28 +80,31 @@ def check_old_patient():
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    data = load_data()
-    today = str(datetime.date.today())
-
-    if today in data:
-        for record in data[today]:
-            if record["patient_id"] == patient_id:
-                name_entry.delete(0, tk.END)
-                name_entry.insert(0, record["name"])
-                blood_group_entry.delete(0, tk.END)
-                blood_group_entry.insert(0, record["blood_group"])
-                age_entry.delete(0, tk.END)
-                age_entry.insert(0, record["age"])
-                gender_entry.delete(0, tk.END)
-                gender_entry.insert(0, record["gender"])
-                issued_medicine_entry.delete("1.0", tk.END)
-                issued_medicine_entry.insert("1.0", record["issued_medicine"])
-                additional_prescription_entry.delete("1.0", tk.END)
-                additional_prescription_entry.insert("1.0", record["additional_prescription"])
-
-                pyperclip.copy(patient_id)
-                messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found and copied to clipboard.")
-                return
+    runner.submit(("check", patient_id), repository.get, patient_id,
+                  on_done=lambda result: show_old_patient(patient_id, *result))
+
+def show_old_patient(patient_id, visit_date, record):
+    """Fill the form with a looked-up patient's data."""
+    if record is not None:
+        name_entry.delete(0, tk.END)
+        name_entry.insert(0, record["name"])
+        blood_group_entry.delete(0, tk.END)
+        blood_group_entry.insert(0, record["blood_group"])
+        age_entry.delete(0, tk.END)
+        age_entry.insert(0, record["age"])
+        gender_entry.delete(0, tk.END)
+        gender_entry.insert(0, record["gender"])
+        issued_medicine_entry.delete("1.0", tk.END)
+        issued_medicine_entry.insert("1.0", record["issued_medicine"])
+        additional_prescription_entry.delete("1.0", tk.END)
+        additional_prescription_entry.insert("1.0", record["additional_prescription"])
+
+        pyperclip.copy(patient_id)
+        if visit_date == str(datetime.date.today()):
+            messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found and copied to clipboard.")
+        else:
+            messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found (last visit {visit_date}) and copied to clipboard.")
+        return
     messagebox.showwarning("Not Found", "Patient ID not found.")
 
 def update_old_patient_medicine():
@@ -113,34 +114,74 @@ def update_old_patient_medicine():
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    data = load_data()
-    today = str(datetime.date.today())
-
-    if today in data:
-        for record in data[today]:
-            if record["patient_id"] == patient_id:
-                issued_medicine = issued_medicine_entry.get("1.0", tk.END).strip()
-                additional_prescription = additional_prescription_entry.get("1.0", tk.END).strip()
+    runner.submit(("update", patient_id), repository.get, patient_id,
+                  on_done=lambda result: confirm_medicine_update(patient_id, *result))
 
-                if not issued_medicine and not additional_prescription:
-                    messagebox.showwarning("Input Error", "Please enter new medicine or additional prescriptions to update.")
-                    return
+def confirm_medicine_update(patient_id, visit_date, record):
+    """Ask how to apply the new medicine, then save it in the background."""
+    if record is not None:
+        issued_medicine = issued_medicine_entry.get("1.0", tk.END).strip()
+        additional_prescription = additional_prescription_entry.get("1.0", tk.END).strip()
 
-                clear_old = messagebox.askyesno("Clear Old Records", "Do you want to clear old medicine records?")
-                
-                if clear_old:
-                    record["issued_medicine"] = issued_medicine
-                else:
-                    record["issued_medicine"] += f"\n{issued_medicine}"
+        if not issued_medicine and not additional_prescription:
+            messagebox.showwarning("Input Error", "Please enter new medicine or additional prescriptions to update.")
+            return
 
-                record["additional_prescription"] = additional_prescription
-                save_data(data)
+        clear_old = messagebox.askyesno("Clear Old Records", "Do you want to clear old medicine records?")
 
-                messagebox.showinfo("Success", f"Medicine updated for Patient ID: {patient_id}")
-                clear_fields()
-                return
+        # Only saved if nobody changed the visit since it was shown here
+        runner.submit(("update", patient_id), repository.update_medicine,
+                      patient_id, issued_medicine, additional_prescription, clear_old, record.get("version", 0),
+                      on_done=lambda found: medicine_updated(patient_id, found),
+                      on_error=medicine_update_failed)
+        return
     messagebox.showwarning("Not Found", "Patient ID not found.")
 
+def medicine_update_failed(error):
+    if isinstance(error, StaleRecordError):
+        messagebox.showwarning("Changed Elsewhere",
+                               "Patient was changed at another desk. Check the patient again before updating.")
+        return
+    show_error(error)
+
+def medicine_updated(patient_id, found):
+    if not found:
+        messagebox.showwarning("Not Found", "Patient ID not found.")
+        return
+    publish(patient_id, "update")
+    messagebox.showinfo("Success", f"Medicine updated for Patient ID: {patient_id}")
+    clear_fields()
+
+def name_typed(event=None):
+    """Look up patients by name as the desk types, for patients who lost their ID."""
+    query = name_search_entry.get().strip()
+    if not query:
+        name_results.delete(0, tk.END)
+        return
+    # If a lookup is already running, show_name_candidates starts another for the latest text
+    runner.submit("names", repository.find_by_name, query,
+                  on_done=lambda candidates: show_name_candidates(query, candidates))
+
+def show_name_candidates(query, candidates):
+    """List name lookup candidates, unless the text has changed since the lookup started."""
+    if name_search_entry.get().strip() != query:
+        name_typed()
+        return
+    name_results.delete(0, tk.END)
+    shown_candidates[:] = candidates
+    for patient_id, name, last_visit in candidates:
+        name_results.insert(tk.END, f"{patient_id}  {name}  (last visit {last_visit})")
+
+def name_candidate_chosen(event=None):
+    """Load the patient picked from the name lookup."""
+    selection = name_results.curselection()
+    if not selection:
+        return
+    patient_id = shown_candidates[selection[0]][0]
+    patient_id_entry.delete(0, tk.END)
+    patient_id_entry.insert(0, patient_id)
+    check_old_patient()
+
 def clear_fields():
     """Clear all input fields."""
     patient_id_entry.delete(0, tk.END)
@@ -153,18 +194,14 @@ def clear_fields():
 
 def check_biometric_device():
     """
-    Simulates the detection of an external biometric device.
-    In a real scenario, you would replace this with actual device detection logic.
-    Returns True if a device is connected, otherwise False.
+    Returns True if an external biometric device is connected, otherwise False.
+    The answer comes from the cached result of the background probe, see device_presence.py.
     """
-    # Simulate checking for an external device
-    # In real-world applications, you'd interface with the device's SDK or API
-    device_connected = False  # Set this to True if a device is detected
-
-    return device_connected
+    return device.is_connected()
 
 def handle_biometric_input():
     """Handle biometric input and create the main form for the user to fill additional details."""
+    global pending_biometric_hash
     # First, check if a biometric device is connected
     if not check_biometric_device():
         proceed_with_id = messagebox.askyesno(
@@ -179,17 +216,28 @@ def handle_biometric_input():
             return
     else:
         # If a device is connected, proceed
-        create_main_window()
-
         # Simulate getting a unique biometric hash from a fingerprint scanner
         # In a real application, you would interface with a fingerprint reader library
-        biometric_hash = "FINGERPRINT_HASH_12345"  # Simulated hash
+        pending_biometric_hash = hash_fingerprint(SIMULATED_FINGERPRINT)
+
+        # The main window looks the fingerprint up once it is open, see resolve_biometric
+        create_main_window()
+
+def resolve_biometric():
+    """Look up the scanned fingerprint: load an enrolled patient, or prepare to enroll a new one."""
+    biometric_hash = pending_biometric_hash
+    runner.submit(("biometric", biometric_hash), biometrics.lookup, biometric_hash, on_done=biometric_resolved)
 
-        # Pre-populate the patient_id_entry with the biometric hash
+def biometric_resolved(patient_id):
+    """Fill in the enrolled patient's ID, or ask for the details of a new one."""
+    global pending_biometric_hash
+    if patient_id is not None:
+        pending_biometric_hash = None
         patient_id_entry.delete(0, tk.END)
-        patient_id_entry.insert(0, biometric_hash)
-    
-        messagebox.showinfo("Biometric ID", f"Biometric ID generated: {biometric_hash}")
+        patient_id_entry.insert(0, patient_id)
+        check_old_patient()
+    else:
+        messagebox.showinfo("Biometric ID", "New fingerprint. Fill in the patient's details and press New Patient to enroll it.")
 
 def start_method_selection():
     """Start by asking the user to choose between Patient ID and Biometric ID."""
@@ -207,11 +255,15 @@ def start_method_selection():
 def create_main_window():
     """Create the main GUI window."""
     global patient_id_entry, name_entry, blood_group_entry, age_entry, gender_entry
-    global issued_medicine_entry, additional_prescription_entry
+    global issued_medicine_entry, additional_prescription_entry, runner
+    global name_search_entry, name_results, shown_candidates
 
     window = tk.Tk()
     window.title("Hospital Database")
-    window.geometry("800x600")  # Increase main window size
+    window.geometry("1200x650")  # Room for the name lookup
+
+    # Storage calls run here so the window never freezes on disk I/O
+    runner = TaskRunner(window)
 
     tk.Label(window, text="Patient ID:", font=("Arial", 14)).grid(row=0, column=0, padx=10, pady=10)
     patient_id_entry = tk.Entry(window, font=("Arial", 14))
@@ -245,10 +297,26 @@ def create_main_window():
     additional_prescription_entry = tk.Text(window, height=5, width=30, font=("Arial", 14))
     additional_prescription_entry.grid(row=6, column=1, padx=10, pady=10)
 
+    # Name lookup for patients who lost their ID
+    tk.Label(window, text="Find by Name:", font=("Arial", 14)).grid(row=1, column=2, padx=10, pady=10)
+    name_search_entry = tk.Entry(window, font=("Arial", 14))
+    name_search_entry.grid(row=1, column=3, columnspan=2, padx=10, pady=10)
+    name_search_entry.bind("<KeyRelease>", name_typed)
+    name_results = tk.Listbox(window, height=12, width=40, font=("Arial", 12))
+    name_results.grid(row=2, column=2, rowspan=5, columnspan=3, padx=10, pady=10)
+    name_results.bind("<Double-Button-1>", name_candidate_chosen)
+    name_results.bind("<Return>", name_candidate_chosen)
+    shown_candidates = []
+
     tk.Button(window, text="Clear Fields", command=clear_fields, font=("Arial", 14)).grid(row=7, columnspan=5, padx=10, pady=20)
 
+    if pending_biometric_hash is not None:
+        window.after(0, resolve_biometric)
+
     window.mainloop()
 
 if __name__ == "__main__":
+    start_export("doctor")
     create_patient_table()  
+    device.start()
     start_method_selection()
\ No newline at end of file
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+from file_lock import FileLock
+
+# Stand-in for what a real fingerprint reader returns until one is wired up
+SIMULATED_FINGERPRINT = "SimulatedFingerprintData"
+
+
+def hash_fingerprint(fingerprint_data):
+    """Generate a SHA-256 hash of the given fingerprint data."""
+    return hashlib.sha256(fingerprint_data.encode()).hexdigest()
+
+
+class BiometricIndex:
+    """Maps fingerprint hashes to patient IDs, so a scan finds its patient in one dict lookup.
+
+    Enrollments are appended to a JSON lines file, one {"hash", "patient_id"} per
+    line, under a lock so several desks can enroll at once. The file is read once,
+    and after that only the lines other processes appended since are read. A later
+    enrollment of the same hash wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path + ".lock")
+        self.patients = {}
+        self.offset = 0
+
+    def refresh(self):
+        """Read enrollments appended since the last call."""
+        size = os.stat(self.path).st_size if os.path.exists(self.path) else 0
+        if size < self.offset:
+            # File was replaced, start over
+            self.patients = {}
+            self.offset = 0
+        if size == self.offset:
+            return
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            chunk = file.read(size - self.offset)
+        for line in chunk.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                # Still being written, pick it up next time
+                break
+            entry = json.loads(line)
+            self.patients[entry["hash"]] = entry["patient_id"]
+            self.offset += len(line)
+
+    def lookup(self, biometric_hash):
+        """Return the patient ID enrolled for biometric_hash, or None."""
+        # Every time, as another desk may have enrolled or re-enrolled it. Only a stat when nobody did.
+        self.refresh()
+        return self.patients.get(biometric_hash)
+
+    def enroll(self, biometric_hash, patient_id):
+        """Record that biometric_hash belongs to patient_id."""
+        with self.lock:
+            self.refresh()
+            if self.patients.get(biometric_hash) == patient_id:
+                return
+            line = (json.dumps({"hash": biometric_hash, "patient_id": patient_id}) + "\n").encode()
+            with open(self.path, "ab") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+            self.patients[biometric_hash] = patient_id
+            self.offset += len(line)
@@ -0,0 +1,237 @@
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+from itertools import islice
+from id_allocator import PATIENT_ID_WIDTH
+from medications import current_medicine
+
+# Columns every imported or exported record carries
+FIELDS = ["patient_id", "name", "blood_group", "age", "gender",
+          "issued_medicine", "additional_prescription", "date", "visit_date"]
+
+BATCH_SIZE = 2000  # Records per journal write or MySQL commit
+
+MYSQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mysql_SOURCE CODE")
+
+
+def open_input(path):
+    return sys.stdin if path == "-" else open(path, "r", newline="", encoding="utf-8")
+
+
+def open_output(path):
+    return sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+
+
+def guess_format(path, file_format):
+    if file_format:
+        return file_format
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_records(path, file_format):
+    """Yield records one at a time from a CSV or JSON Lines file, never loading it whole."""
+    with open_input(path) as file:
+        if file_format == "csv":
+            for row in csv.DictReader(file):
+                yield normalize(row)
+        else:
+            for line in file:
+                if line.strip():
+                    yield normalize(json.loads(line))
+
+
+def normalize(row):
+    """Fill in the fields a record needs and derive visit_date from its timestamp."""
+    record = {field: str(row.get(field) or "") for field in FIELDS}
+    record["patient_id"] = record["patient_id"].strip()
+    record["date"] = record["date"] or datetime.datetime.now().isoformat()
+    record["visit_date"] = record["visit_date"] or record["date"][:10]
+    return record
+
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_records(records, path, file_format):
+    """Stream records out as CSV or JSON Lines."""
+    with open_output(path) as file:
+        if file_format == "csv":
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+        else:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+
+
+def import_json(records, data_file, batch_size):
+    """Append every batch to the journal with one write each, then compact once at the end."""
+    from journal_store import JournalStore
+    from id_allocator import PatientIdAllocator
+
+    store = JournalStore(data_file)
+    store.load()
+    allocator = PatientIdAllocator(data_file + ".seq")
+    allocator.seed(store.patient_ids())
+
+    count = 0
+    for batch in batches(records, batch_size):
+        missing = [record for record in batch if not record["patient_id"]]
+        if missing:
+            for record, patient_id in zip(missing, allocator.allocate_block(len(missing))):
+                record["patient_id"] = patient_id
+        numeric_ids = [int(record["patient_id"]) for record in batch if record["patient_id"].isdigit()]
+        if numeric_ids:
+            allocator.advance_past(str(max(numeric_ids)))
+
+        store.add_records((record.pop("visit_date"), record) for record in batch)
+        count += len(batch)
+    store.compact()
+    return count
+
+
+def export_json(data_file):
+    from journal_store import JournalStore
+
+    store = JournalStore(data_file, read_only=True)
+    store.load()
+    for visit_date in store.days():
+        for record in store.day(visit_date):
+            yield dict({field: record.get(field, "") for field in FIELDS},
+                       issued_medicine=current_medicine(record), visit_date=visit_date)
+
+
+def mysql_modules():
+    sys.path.insert(0, MYSQL_DIR)
+    from db_pool import pool
+    from schema import create_tables
+    return pool, create_tables
+
+
+def import_mysql(records, batch_size):
+    """Insert with executemany and commit once per batch, along with the batch's daily rollups."""
+    pool, create_tables = mysql_modules()
+    from mysql_repository import add_rollups
+    from daily_rollups import visit_keys
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    create_tables(cursor)
+    conn.commit()
+
+    count = 0
+    for batch in batches(records, batch_size):
+        missing = [record for record in batch if not record["patient_id"]]
+        if missing:
+            # Reserve a whole block of IDs in one statement, like SQLdoctor.get_new_patient_id does for one
+            cursor.execute("UPDATE patient_id_sequence SET last_id = LAST_INSERT_ID(last_id + %s) WHERE id = 1",
+                           (len(missing),))
+            cursor.execute("SELECT LAST_INSERT_ID()")
+            last_id = cursor.fetchone()[0]
+            for offset, record in enumerate(missing):
+                record["patient_id"] = str(last_id - len(missing) + 1 + offset).zfill(PATIENT_ID_WIDTH)
+        numeric_ids = [int(record["patient_id"]) for record in batch if record["patient_id"].isdigit()]
+        if numeric_ids:
+            cursor.execute("UPDATE patient_id_sequence SET last_id = GREATEST(last_id, %s) WHERE id = 1",
+                           (max(numeric_ids),))
+
+        cursor.executemany("""
+        INSERT INTO prescriptions (patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription, date, visit_date)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, [(record["patient_id"], record["name"], record["blood_group"], record["age"] or None, record["gender"],
+               record["issued_medicine"], record["additional_prescription"],
+               datetime.datetime.fromisoformat(record["date"]), record["visit_date"]) for record in batch])
+        add_rollups(cursor, [key for record in batch for key in visit_keys(record["visit_date"], record)])
+        conn.commit()
+        count += len(batch)
+
+    cursor.close()
+    conn.close()
+    return count
+
+
+def export_mysql(batch_size):
+    """Stream rows out in fetchmany chunks instead of fetching the whole table."""
+    pool, _ = mysql_modules()
+    from mysql_repository import attach_medications
+
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    # The main cursor is still streaming, so medication history is read over a second connection
+    history_conn = pool.acquire()
+    history_cursor = history_conn.cursor()
+    cursor.execute("""
+    SELECT prescription_id, patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription, date, visit_date
+    FROM prescriptions ORDER BY prescription_id
+    """)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            records = []
+            for row in rows:
+                record = dict(zip(["prescription_id"] + FIELDS, row))
+                record["age"] = "" if record["age"] is None else str(record["age"])
+                record["date"] = record["date"].isoformat() if record["date"] else ""
+                record["visit_date"] = str(record["visit_date"])
+                records.append(record)
+            for record in attach_medications(history_cursor, records):
+                yield {field: record[field] for field in FIELDS}
+    finally:
+        cursor.close()
+        conn.close()
+        history_cursor.close()
+        history_conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk import or export patient records as CSV or JSON Lines. "
+                    "Close the JSON desks while importing into the JSON backend.")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("path", help="input or output file, - for stdin/stdout")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="defaults to the file extension")
+    parser.add_argument("--backend", choices=["json", "mysql"], default="json")
+    parser.add_argument("--data-file", default="data.json", help="JSON backend data file")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    file_format = guess_format(args.path, args.format)
+    started = datetime.datetime.now()
+
+    if args.command == "import":
+        records = read_records(args.path, file_format)
+        if args.backend == "json":
+            count = import_json(records, args.data_file, args.batch_size)
+        else:
+            count = import_mysql(records, args.batch_size)
+        verb = "Imported"
+    else:
+        records = export_json(args.data_file) if args.backend == "json" else export_mysql(args.batch_size)
+        count = 0
+
+        def counted(records):
+            nonlocal count
+            for record in records:
+                count += 1
+                yield record
+
+        write_records(counted(records), args.path, file_format)
+        verb = "Exported"
+
+    seconds = (datetime.datetime.now() - started).total_seconds()
+    print(f"{verb} {count} records in {seconds:.1f}s ({count / max(seconds, 1e-9):.0f} records/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+
+POLL_MS = 50  # How often the Tk thread checks for changes
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# Events that mean a file's contents may have changed
+WRITE_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def start_inotify(directory, on_event, mask=WRITE_EVENTS):
+    """Call on_event() from a background thread whenever a file in directory changes.
+
+    Returns False where inotify isn't available (not Linux, or libc without it).
+    """
+    if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return False
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return False
+    except (OSError, AttributeError):
+        return False
+
+    def watch():
+        while True:
+            # We don't care which file changed, refresh() works that out cheaply
+            os.read(fd, 4096)
+            on_event()
+
+    threading.Thread(target=watch, daemon=True).start()
+    return True
+
+
+class ChangeFeed:
+    """Keeps a JournalStore's in-memory copy current as the doctor desk writes.
+
+    An inotify watch on the data directory flags changes as they happen. Without
+    inotify the Tk thread compares the snapshot and journal (mtime, size) every
+    POLL_MS instead. Either way the refresh itself runs on the task runner, reading
+    only the journal bytes appended since the last offset, and on_change() is then
+    called on the Tk thread.
+    """
+
+    def __init__(self, store, root, runner, on_change=None):
+        self.store = store
+        self.root = root
+        self.runner = runner
+        self.on_change = on_change
+        self.changed = threading.Event()
+        self.last_stamp = None
+        directory = os.path.dirname(os.path.abspath(store.data_file))
+        self.uses_inotify = start_inotify(directory, self.changed.set)
+        self.changed.set()  # Catch up once at start
+        self.root.after(POLL_MS, self._poll)
+
+    def _file_stamp(self):
+        stamp = []
+        for path in (self.store.data_file, self.store.journal_file):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            else:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _poll(self):
+        if not self.uses_inotify:
+            stamp = self._file_stamp()
+            if stamp != self.last_stamp:
+                self.last_stamp = stamp
+                self.changed.set()
+
+        # If a refresh is still running the flag stays set and we retry on the next poll
+        if self.changed.is_set() and self.runner.submit("refresh", self.store.refresh, on_done=lambda _: self._refreshed()):
+            self.changed.clear()
+        self.root.after(POLL_MS, self._poll)
+
+    def _refreshed(self):
+        if self.on_change is not None:
+            self.on_change()
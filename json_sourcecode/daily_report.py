@@ -0,0 +1,96 @@
+import argparse
+import datetime
+import json
+import os
+import sys
+from daily_rollups import DailyRollups, totals
+from journal_store import JournalStore, snapshot_stamp
+
+TOP_MEDICINES = 10  # Medicines listed under the daily table
+
+BLANK = "(blank)"
+
+
+def json_rollups(data_file):
+    """The JSON store's rollups, read from the file saved at the last compaction plus the journal since.
+
+    Only the journal is read, not the snapshot, unless the saved rollups are missing or stale
+    or an update in the journal changed a counted field.
+    """
+    rollups = DailyRollups()
+    if rollups.load(data_file + ".rollups", snapshot_stamp(data_file)):
+        journal_file = data_file + ".journal"
+        lines = []
+        if os.path.exists(journal_file):
+            with open(journal_file, "rb") as file:
+                # A last line without its newline is still being written
+                lines = [line for line in file if line.endswith(b"\n")]
+        if all(rollups.apply(json.loads(line)) for line in lines):
+            return rollups
+    store = JournalStore(data_file, read_only=True)
+    store.load()
+    return store.rollups
+
+
+def breakdown(values):
+    return ", ".join(f"{value or BLANK} {count}" for value, count in sorted(values.items()))
+
+
+def print_report(days, top):
+    print(f"{'date':<12}{'patients':>9}{'dispensed':>10}  blood groups / gender")
+    for day, dimensions in days.items():
+        patients = sum(dimensions.get("patients", {}).values())
+        dispensed = sum(dimensions.get("dispensed", {}).values())
+        print(f"{day:<12}{patients:>9}{dispensed:>10}  {breakdown(dimensions.get('blood_group', {}))}")
+        print(f"{'':<33}{breakdown(dimensions.get('gender', {}))}")
+
+    medicines = totals(days, "medicine").most_common(top)
+    if medicines:
+        print("\nMost issued medicines")
+        width = max(len(name) for name, _ in medicines)
+        for name, count in medicines:
+            print(f"  {name:<{width}}  {count:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print daily patient, blood group, gender, medicine and dispensing counts. "
+                    "The counts are kept up to date by every write, so no records are scanned.")
+    parser.add_argument("--backend", choices=["json", "sqlite", "mysql", "service"],
+                        default=os.environ.get("HOSPITAL_BACKEND", "json"))
+    parser.add_argument("--data-file", default="data.json", help="JSON backend data file")
+    parser.add_argument("--from", dest="start", help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", help="last day, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, help="the last DAYS days up to today, instead of --from/--to")
+    parser.add_argument("--top", type=int, default=TOP_MEDICINES, help="medicines to list")
+    parser.add_argument("--json", action="store_true", help="print the counts as JSON for dashboards")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="recount from every visit first, after imports or if the counts were lost")
+    args = parser.parse_args()
+
+    if args.days:
+        args.start = str(datetime.date.today() - datetime.timedelta(days=args.days - 1))
+        args.end = None
+
+    if args.backend == "json" and not args.rebuild:
+        days = json_rollups(args.data_file).between(args.start, args.end)
+    else:
+        from patient_repository import open_repository
+        repository = open_repository(args.backend, args.data_file)
+        repository.initialize()
+        if args.rebuild:
+            started = datetime.datetime.now()
+            repository.rebuild_rollups()
+            seconds = (datetime.datetime.now() - started).total_seconds()
+            print(f"Rebuilt daily rollups in {seconds:.1f}s", file=sys.stderr)
+        days = repository.daily_rollups(args.start, args.end)
+
+    if args.json:
+        json.dump(days, sys.stdout, indent=4)
+        print()
+    else:
+        print_report(days, args.top)
+
+
+if __name__ == "__main__":
+    main()
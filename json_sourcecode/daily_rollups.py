@@ -0,0 +1,189 @@
+import json
+import os
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    # Rebuilds count with a Counter instead, same numbers only slower
+    numpy = None
+
+# What the rollups count per day. patients and dispensed aren't broken down, their only value is TOTAL.
+DIMENSIONS = ["patients", "blood_group", "gender", "medicine", "dispensed"]
+TOTAL = "total"
+
+VALUE_LENGTH = 255  # Longest value kept, the width of daily_rollups.value in MySQL
+
+# Record fields that move a visit from one count to another when they change
+ROLLUP_FIELDS = {"blood_group", "gender", "issued_medicine", "medications"}
+
+
+def label(text):
+    return " ".join(str(text or "").split())[:VALUE_LENGTH]
+
+
+def medicine_keys(day, text):
+    """One medicine key per line of text, lowercased, so "Paracetamol  500mg" and "paracetamol 500mg" count together."""
+    for line in (text or "").splitlines():
+        name = label(line.lower())
+        if name:
+            yield day, "medicine", name
+
+
+def medication_keys(day, medication):
+    """Keys for one medication entry (see medications.new_entry) of a visit on day."""
+    yield from medicine_keys(day, medication["medicine"])
+    if medication.get("dispensed_at") and medication["medicine"]:
+        # Dispensing counts on the day it happened, not the day of the visit
+        yield medication["dispensed_at"][:10], "dispensed", TOTAL
+
+
+def visit_keys(day, record):
+    """Every (day, dimension, value) a visit counts towards.
+
+    Medicine counts the visit's starting issued_medicine text and every medication
+    entry, so a medicine the doctor issued twice in a day counts twice.
+    """
+    yield day, "patients", TOTAL
+    yield day, "blood_group", label(record.get("blood_group")).upper()
+    yield day, "gender", label(record.get("gender")).capitalize()
+    yield from medicine_keys(day, record.get("issued_medicine"))
+    for medication in record.get("medications", []):
+        yield from medication_keys(day, medication)
+
+
+def count_keys(keys):
+    """{(day, dimension, value): count} for a list of keys.
+
+    With NumPy each column is turned into integer codes and the combined codes are
+    counted with one sort, instead of hashing every key tuple in Python.
+    """
+    if numpy is None or not keys:
+        return Counter(keys)
+    names, codes = [], []
+    for column in zip(*keys):
+        unique, inverse = numpy.unique(numpy.array(column, dtype=str), return_inverse=True)
+        names.append(unique)
+        codes.append(inverse.ravel().astype(numpy.int64))
+    combined = (codes[0] * len(names[1]) + codes[1]) * len(names[2]) + codes[2]
+    found, counts = numpy.unique(combined, return_counts=True)
+    day_codes, rest = numpy.divmod(found, len(names[1]) * len(names[2]))
+    dimension_codes, value_codes = numpy.divmod(rest, len(names[2]))
+    return {(str(names[0][day]), str(names[1][dimension]), str(names[2][value])): int(count)
+            for day, dimension, value, count in zip(day_codes, dimension_codes, value_codes, counts)}
+
+
+# What the SQL backends recount from, see table_keys
+VISIT_QUERY = "SELECT visit_date, blood_group, gender, issued_medicine FROM prescriptions"
+MEDICATION_QUERY = """
+SELECT p.visit_date, h.medicine, h.dispensed_at
+FROM medication_history h JOIN prescriptions p ON p.prescription_id = h.prescription_id
+"""
+
+
+def table_keys(visit_rows, medication_rows):
+    """Keys for rows of VISIT_QUERY and MEDICATION_QUERY, the SQL backends' version of visit_keys."""
+    for visit_date, blood_group, gender, issued_medicine in visit_rows:
+        yield from visit_keys(str(visit_date), {"blood_group": blood_group, "gender": gender,
+                                                "issued_medicine": issued_medicine})
+    for visit_date, medicine, dispensed_at in medication_rows:
+        yield from medication_keys(str(visit_date), {"medicine": medicine,
+                                                     "dispensed_at": dispensed_at and str(dispensed_at)})
+
+
+class DailyRollups:
+    """Daily census and dispensing counts, kept up to date on every write so reports never scan records.
+
+    days maps "YYYY-MM-DD" -> {dimension: {value: count}}. Writers add the keys
+    of what they wrote (see visit_keys and medication_keys), and rebuild() recounts
+    everything in one vectorized pass for backfills and after imports.
+    """
+
+    def __init__(self):
+        self.days = {}
+
+    def add(self, keys, count=1):
+        """Add count (negative to take away) to each (day, dimension, value) in keys."""
+        for day, dimension, value in keys:
+            values = self.days.setdefault(day, {}).setdefault(dimension, {})
+            values[value] = values.get(value, 0) + count
+            if not values[value]:
+                del values[value]
+
+    def apply(self, entry):
+        """Count one journal entry (see journal_store.py).
+
+        Returns False for an update that changes a field in ROLLUP_FIELDS, which can
+        only be counted with the record it changes.
+        """
+        if entry["op"] == "insert":
+            self.add(visit_keys(entry["date"], entry["record"]))
+        elif entry["op"] == "medicate":
+            self.add(medication_keys(entry["date"], entry["entry"]))
+            return not ROLLUP_FIELDS & set(entry.get("fields", {}))
+        elif entry["op"] == "dispense":
+            self.add([(entry["dispensed_at"][:10], "dispensed", TOTAL)], len(entry["positions"]))
+        elif entry["op"] == "update":
+            return not ROLLUP_FIELDS & set(entry["fields"])
+        return True
+
+    def rebuild(self, data):
+        """Recount every day of the given {date: [records]} data from scratch."""
+        self.rebuild_keys([key for day, records in data.items() for record in records
+                           for key in visit_keys(day, record)])
+
+    def rebuild_keys(self, keys):
+        """Recount from scratch given every key, for backends that produce them without records."""
+        self.days = {}
+        for (day, dimension, value), count in count_keys(keys).items():
+            self.days.setdefault(day, {}).setdefault(dimension, {})[value] = count
+
+    def rows(self):
+        """Yield (day, dimension, value, count) for every non-zero count."""
+        for day, dimensions in self.days.items():
+            for dimension, values in dimensions.items():
+                for value, count in values.items():
+                    yield day, dimension, value, count
+
+    def load_rows(self, rows):
+        """Replace the counts with (day, dimension, value, count) rows, as stored by the SQL backends."""
+        self.days = {}
+        for day, dimension, value, count in rows:
+            self.days.setdefault(str(day), {}).setdefault(dimension, {})[value] = count
+
+    def between(self, start=None, end=None):
+        """{day: {dimension: {value: count}}} for days from start to end, both optional and inclusive."""
+        return {day: {dimension: dict(values) for dimension, values in dimensions.items()}
+                for day, dimensions in sorted(self.days.items())
+                if (start is None or day >= start) and (end is None or day <= end)}
+
+    def save(self, path, stamp):
+        """Write the counts next to the snapshot whose stamp they match, replacing the file atomically."""
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump({"stamp": list(stamp) if stamp else None, "days": self.days}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, path)
+
+    def load(self, path, stamp):
+        """Read counts saved for the snapshot with this stamp. Returns False if there are none."""
+        if stamp is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path, "r") as file:
+                saved = json.load(file)
+        except ValueError:
+            return False
+        if saved["stamp"] != list(stamp):
+            return False
+        self.days = saved["days"]
+        return True
+
+
+def totals(days, dimension):
+    """{value: count} of one dimension summed over the days from between()."""
+    summed = Counter()
+    for dimensions in days.values():
+        summed.update(dimensions.get(dimension, {}))
+    return summed
@@ -0,0 +1,108 @@
+import os
+import socket
+import subprocess
+import threading
+import time
+from change_feed import start_inotify, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+
+DEVICE_TTL = 30  # Seconds a probe result is trusted when no hotplug event arrives
+WMIC_TIMEOUT = 15  # wmic can take several seconds on a busy machine
+
+# Device node the Linux apps look for. Point it at any file to test without hardware.
+DEVICE_PATH = os.environ.get("BIOMETRIC_DEVICE_PATH", "/dev/biometric_device")
+# Name the Windows apps look for in the Plug and Play device list
+DRIVER_NAME = os.environ.get("BIOMETRIC_DRIVER_NAME", "Your Biometric Driver Name")
+
+NETLINK_KOBJECT_UEVENT = 15
+
+
+def path_probe(path):
+    """A probe that reports the device as connected while path exists."""
+    return lambda: os.path.exists(path)
+
+
+def wmic_probe(driver_name):
+    """A probe that looks for driver_name among the Windows Plug and Play devices."""
+    def probe():
+        try:
+            output = subprocess.run(["wmic", "path", "Win32_PnPEntity", "get", "Name"],
+                                    capture_output=True, text=True, timeout=WMIC_TIMEOUT).stdout
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"Error checking drivers: {e}")
+            return False
+        return driver_name in output
+    return probe
+
+
+def start_uevents(on_event):
+    """Call on_event() from a background thread on every kernel hotplug (udev) event.
+
+    Returns False where the netlink uevent socket isn't available (not Linux, or not allowed).
+    """
+    if not hasattr(socket, "AF_NETLINK"):
+        return False
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, 1))  # Multicast group 1 carries the kernel's uevents
+    except OSError:
+        return False
+
+    def watch():
+        while True:
+            # Any add/remove may be our device, the probe works out which
+            sock.recv(16384)
+            on_event()
+
+    threading.Thread(target=watch, daemon=True).start()
+    return True
+
+
+class DevicePresence:
+    """Answers "is the biometric device connected?" instantly from a cached probe result.
+
+    The probe runs on a background thread at start(), again once the result is
+    older than ttl, and straight away on a hotplug event (udev uevents, plus an
+    inotify watch on the device path's directory for path probes). Until the first
+    probe finishes the device counts as not connected.
+    """
+
+    def __init__(self, probe, ttl=DEVICE_TTL, watch_path=None):
+        self.probe = probe
+        self.ttl = ttl
+        self.watch_path = watch_path
+        self.connected = False
+        self.checked_at = None
+        self.wakeup = threading.Event()
+
+    def start(self):
+        start_uevents(self.invalidate)
+        if self.watch_path is not None:
+            directory = os.path.dirname(os.path.abspath(self.watch_path))
+            if os.path.isdir(directory):
+                start_inotify(directory, self.invalidate, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            self.connected = bool(self.probe())
+            self.checked_at = time.monotonic()
+            # Sleep until the result expires or a hotplug event says it already has
+            self.wakeup.wait(self.ttl)
+
+    def invalidate(self):
+        """Re-probe now, for example because a device was plugged in or out."""
+        self.wakeup.set()
+
+    def is_connected(self):
+        """The last probe result. Never blocks."""
+        return self.connected
+
+
+def biometric_device():
+    """The presence service the apps share: wmic on Windows unless BIOMETRIC_DEVICE_PATH
+    is set, the device path everywhere else. Call start() once the app is up."""
+    if os.name == "nt" and "BIOMETRIC_DEVICE_PATH" not in os.environ:
+        return DevicePresence(wmic_probe(DRIVER_NAME))
+    return DevicePresence(path_probe(DEVICE_PATH), watch_path=DEVICE_PATH)
@@ -0,0 +1,45 @@
+import os
+import threading
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """Exclusive lock shared by every desk process that opens the same lock file.
+
+    Use it as a context manager around read-modify-write sections. It also holds a
+    thread lock, so threads inside one process are serialized as well.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._file = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._file = open(self.path, "a+")
+            if os.name == "nt":
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            if os.name == "nt":
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
@@ -0,0 +1,58 @@
+import os
+from file_lock import FileLock
+
+# Patient IDs are zero-padded to this many digits. Widen it if a site outgrows it.
+PATIENT_ID_WIDTH = 6
+
+
+class PatientIdAllocator:
+    """Hands out unique patient IDs from a sequence file shared by every desk.
+
+    Each allocation locks the sequence file, bumps the counter and writes it back,
+    so two desks can never get the same ID and no lookup of existing IDs is needed.
+    IDs are unique across days, which the cross-day history lookup relies on.
+    """
+
+    def __init__(self, sequence_file, width=PATIENT_ID_WIDTH):
+        self.sequence_file = sequence_file
+        self.width = width
+        self.lock = FileLock(sequence_file + ".lock")
+
+    def _read(self):
+        with open(self.sequence_file, "r") as file:
+            return int(file.read().strip() or 0)
+
+    def _write(self, last_id):
+        tmp_file = self.sequence_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            file.write(str(last_id))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.sequence_file)
+
+    def seed(self, patient_ids):
+        """Start the sequence after the highest numeric ID among patient_ids, if not started yet."""
+        with self.lock:
+            if os.path.exists(self.sequence_file):
+                return
+            self._write(max((int(patient_id) for patient_id in patient_ids if patient_id.isdigit()), default=0))
+
+    def allocate(self):
+        """Return the next unused patient ID."""
+        return self.allocate_block(1)[0]
+
+    def allocate_block(self, count):
+        """Reserve count consecutive IDs under one lock, for bulk imports."""
+        with self.lock:
+            last_id = self._read() if os.path.exists(self.sequence_file) else 0
+            self._write(last_id + count)
+        return [str(patient_id).zfill(self.width) for patient_id in range(last_id + 1, last_id + count + 1)]
+
+    def advance_past(self, patient_id):
+        """Make sure the sequence never hands out an ID that was imported from elsewhere."""
+        if not patient_id.isdigit():
+            return
+        with self.lock:
+            last_id = self._read() if os.path.exists(self.sequence_file) else 0
+            if int(patient_id) > last_id:
+                self._write(int(patient_id))
@@ -0,0 +1,561 @@
+import bisect
+import contextlib
+import datetime
+import gzip
+import json
+import os
+from file_lock import FileLock
+from patient_index import PatientIndex
+from text_index import TextIndex
+from name_index import NameIndex
+from daily_rollups import DailyRollups, visit_keys
+from metrics import timed
+
+# Number of journal entries allowed to pile up before they are folded into the segments
+COMPACT_EVERY = 500
+
+# Marks a data file holding the segment catalog rather than every record, see JournalStore
+CATALOG_FORMAT = 2
+
+
+def read_snapshot(path):
+    """Read a snapshot file. A missing or empty file is an empty dictionary."""
+    if not os.path.exists(path) or os.stat(path).st_size == 0:
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def read_segment(path):
+    """Read one day's records from an open (.json) or archived (.json.gz) segment."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as file:
+        return json.load(file)
+
+
+def write_segment(path, records):
+    """Write one day's records durably. Archives are compressed and skip the indentation."""
+    if path.endswith(".gz"):
+        with open(path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as file:
+                file.write(json.dumps(records).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+    else:
+        with open(path, "w") as file:
+            json.dump(records, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def snapshot_stamp(path):
+    """(mtime, size, inode) of a snapshot file, or None. It changes whenever a compaction replaces it."""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def fsync_directory(path):
+    """Make a rename inside the file's directory durable. Not possible (or needed) on Windows."""
+    if os.name == "nt":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StaleRecordError(Exception):
+    """Another desk changed the record since it was read. Read it again and retry."""
+
+
+class JournalStore:
+    """Patient data kept as one segment file per day plus an append-only journal of changes.
+
+    Every write appends one line to the journal, so its cost depends on the size of
+    the record and not on the whole history. Every COMPACT_EVERY entries the days
+    the journal touched are written back to their segments in data_file + ".days".
+    Today's segment is plain JSON. Once a day is over its segment becomes a gzip
+    archive, which is only read when a lookup needs that day, so loading costs
+    what today holds rather than the whole history.
+
+    data_file itself is the catalog: the file holding each day, and every patient's
+    name and visit days, so a returning patient's last visit is found without
+    opening older segments. A compaction writes new segment files and then swaps
+    in a new catalog, so readers see either the old set of files or the new one.
+    Each compaction also saves the daily rollups next to the catalog.
+
+    Several desk processes can write to the same files. Every write takes the
+    store's lock file, catches up with the other desks' journal entries and only
+    then appends, so nobody's entry is lost. Records carry a version number that
+    update_record can check, for read-modify-write without holding the lock.
+    Read-only stores never take the lock.
+
+    data holds the days read so far, use day() and days() to reach the rest.
+    """
+
+    def __init__(self, data_file, compact_every=COMPACT_EVERY, read_only=False):
+        self.data_file = data_file
+        self.journal_file = data_file + ".journal"
+        self.rollups_file = data_file + ".rollups"
+        self.segment_dir = data_file + ".days"
+        self.compact_every = compact_every
+        # Readers such as the pharmacy never repair or compact files another process is writing
+        self.read_only = read_only
+        self.lock = FileLock(data_file + ".lock")
+        self.data = {}
+        self.index = PatientIndex()
+        # Built on the first search() and kept current from then on, so desks that never search don't pay for it
+        self.text_index = None
+        self.name_index = None
+        self.rollups = DailyRollups()
+        # The catalog: date -> segment file name, and patient_id -> {"name", "days"}
+        self.segments = {}
+        self.patients = {}
+        self.generation = 0
+        # Files the last compaction replaced, kept until the next one for readers still on the old catalog
+        self.retired = []
+        # The data file still holds every record, as it did before segments
+        self.legacy = False
+        # Days changed since the last compaction
+        self.dirty = set()
+        self.journal_entries = 0
+        self.journal_offset = 0
+        self.snapshot_stamp = None
+
+    def _snapshot_stamp(self):
+        return snapshot_stamp(self.data_file)
+
+    def _journal_size(self):
+        return os.stat(self.journal_file).st_size if os.path.exists(self.journal_file) else 0
+
+    def _writing(self):
+        """The lock for writers. Readers get a no-op so they never wait on a desk."""
+        return contextlib.nullcontext() if self.read_only else self.lock
+
+    @timed("hospital_journal_seconds", operation="load")
+    def load(self):
+        """Read the catalog and today's segment, and replay the journal on top of them."""
+        # Held so a torn line we are about to cut off can't be another desk's write in progress
+        with self._writing():
+            self._load()
+            if self.legacy and not self.read_only:
+                # Split the old single file into segments once
+                self.compact()
+            return self.data
+
+    def _load(self):
+        self.snapshot_stamp = self._snapshot_stamp()
+        snapshot = read_snapshot(self.data_file)
+        self.legacy = snapshot.get("format") != CATALOG_FORMAT
+        if self.legacy:
+            # Every record in one dict keyed by date
+            self.data = snapshot
+            self.segments = {}
+            self.generation = 0
+            self.retired = []
+            self.dirty = set(self.data)
+        else:
+            self.data = {}
+            self.segments = snapshot["days"]
+            self.generation = snapshot["generation"]
+            self.retired = snapshot["retired"]
+            self.dirty = set()
+        self.index.rebuild(self.data)
+        if self.text_index is not None:
+            self.text_index.rebuild(self.data)
+        if self.legacy:
+            self.patients = {}
+            for date in sorted(self.data):
+                for record in self.data[date]:
+                    self._catalog(date, record)
+        else:
+            self.patients = snapshot["patients"]
+            # Archives wait until something asks for their day
+            for date, name in self.segments.items():
+                if not name.endswith(".gz"):
+                    self._load_day(date)
+        if self.name_index is not None:
+            self._rebuild_names()
+        if not self.rollups.load(self.rollups_file, self.snapshot_stamp):
+            self._load_all()
+            self.rollups.rebuild(self.data)
+        self.journal_entries = 0
+        self.journal_offset = 0
+        if not os.path.exists(self.journal_file):
+            return self.data
+
+        with open(self.journal_file, "rb") as file:
+            for line in file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line after a crash (or one still being written), stop here
+                    break
+                self.journal_offset += len(line)
+                # Skip what the segments already hold, in case we crashed between swapping
+                # in a new catalog and truncating the journal during a compaction. Entries
+                # carry the catalog generation they were written on top of.
+                if "generation" in entry:
+                    if entry["generation"] < self.generation:
+                        continue
+                # Journals from before entries had one are matched against the segments
+                elif entry["op"] == "insert":
+                    if self.find(entry["date"], entry["record"]["patient_id"]) is not None:
+                        continue
+                elif entry["op"] == "medicate":
+                    # Unlike updates, appending an entry twice isn't harmless
+                    record = self.find(entry["date"], entry["patient_id"])
+                    if record is not None and any(medication["id"] == entry["entry"]["id"]
+                                                  for medication in record.get("medications", [])):
+                        continue
+                self._apply(entry)
+                self.journal_entries += 1
+
+        if not self.read_only and self.journal_offset < self._journal_size():
+            with open(self.journal_file, "r+b") as file:
+                file.truncate(self.journal_offset)
+        return self.data
+
+    def _load_day(self, date):
+        """Read one day's segment into data and the indexes."""
+        records = read_segment(os.path.join(self.segment_dir, self.segments[date]))
+        self.data[date] = records
+        self.index.rebuild_day(date, records)
+        if self.text_index is not None:
+            for record in records:
+                self.text_index.index(date, record)
+        return records
+
+    def _load_all(self):
+        """Read every day not read yet, for searches and recounts over the whole history."""
+        for date in sorted(self.segments):
+            if date not in self.data:
+                self._load_day(date)
+
+    def _catalog(self, date, record):
+        """Note a visit in the patient catalog."""
+        patient = self.patients.setdefault(record["patient_id"], {"name": record["name"], "days": []})
+        if date not in patient["days"]:
+            bisect.insort(patient["days"], date)
+        if date == patient["days"][-1]:
+            patient["name"] = record["name"]
+
+    def _rebuild_names(self):
+        # From the catalog, so finding a name never reads an archive
+        self.name_index = NameIndex()
+        for patient_id, patient in self.patients.items():
+            self.name_index.add(patient_id, patient["name"], patient["days"][-1])
+
+    @timed("hospital_journal_seconds", operation="refresh")
+    def refresh(self):
+        """Pick up changes written by other processes, reading only the new journal bytes.
+
+        Falls back to a full load when the catalog was replaced or the journal was
+        truncated, which is what a compaction does.
+        """
+        journal_size = self._journal_size()
+        if self._snapshot_stamp() != self.snapshot_stamp or journal_size < self.journal_offset:
+            return self.load()
+        if journal_size == self.journal_offset:
+            return self.data
+
+        with open(self.journal_file, "rb") as file:
+            file.seek(self.journal_offset)
+            chunk = file.read(journal_size - self.journal_offset)
+        for line in chunk.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                # The writer hasn't finished this line yet, pick it up next time
+                break
+            self._apply(json.loads(line))
+            self.journal_offset += len(line)
+            self.journal_entries += 1
+        return self.data
+
+    def _apply(self, entry):
+        """Apply one journal entry to the in-memory data."""
+        day = self.day(entry["date"], create=True)
+        self.dirty.add(entry["date"])
+        if entry["op"] == "insert":
+            day.append(entry["record"])
+            self.index.add(entry["date"], entry["record"]["patient_id"], len(day) - 1)
+            record = entry["record"]
+            self._catalog(entry["date"], record)
+            self.rollups.apply(entry)
+        elif entry["op"] == "update":
+            record = self.index.lookup(self.data, entry["date"], entry["patient_id"])
+            if record is not None:
+                self._update_fields(entry["date"], record, entry["fields"])
+        elif entry["op"] == "medicate":
+            record = self.index.lookup(self.data, entry["date"], entry["patient_id"])
+            if record is not None:
+                if entry.get("fields"):
+                    self._update_fields(entry["date"], record, entry["fields"])
+                record.setdefault("medications", []).append(entry["entry"])
+                record["version"] = record.get("version", 0) + 1
+                self.rollups.apply(entry)
+        elif entry["op"] == "dispense":
+            record = self.index.lookup(self.data, entry["date"], entry["patient_id"])
+            if record is not None:
+                for position in entry["positions"]:
+                    record["medications"][position]["dispensed_at"] = entry["dispensed_at"]
+                self.rollups.apply(entry)
+            # Nothing searchable changed
+            return
+        if self.text_index is not None and record is not None:
+            self.text_index.index(entry["date"], record)
+        if self.name_index is not None and record is not None:
+            self.name_index.add(record["patient_id"], record["name"], entry["date"])
+
+    def _update_fields(self, date, record, fields):
+        # Take the visit out of the rollups and count it again as it is now
+        self.rollups.add(visit_keys(date, record), -1)
+        record.update(fields)
+        self.rollups.add(visit_keys(date, record))
+        self._catalog(date, record)
+
+    @timed("hospital_journal_seconds", operation="write")
+    def _write(self, entries):
+        """Durably write entries to the journal with one write and fsync, then apply them.
+
+        The caller holds the lock and has refreshed, so the journal ends where our offset does
+        and self.generation is the current catalog's.
+        """
+        lines = b"".join((json.dumps(dict(entry, generation=self.generation)) + "\n").encode()
+                         for entry in entries)
+        with open(self.journal_file, "ab") as file:
+            file.write(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        for entry in entries:
+            self._apply(entry)
+        self.journal_offset += len(lines)
+        self.journal_entries += len(entries)
+
+    def _append(self, entry):
+        """Write one entry under the lock, compacting when the journal has grown long."""
+        with self.lock:
+            self.refresh()
+            self._write([entry])
+            if self.journal_entries >= self.compact_every:
+                self.compact()
+
+    def day(self, date, create=False):
+        """Return the records of the given day, reading its segment if that hasn't happened yet.
+
+        A day with no visits is an empty list, only kept in data if create is set.
+        """
+        records = self.data.get(date)
+        if records is not None:
+            return records
+        if date in self.segments:
+            return self._load_day(date)
+        return self.data.setdefault(date, []) if create else []
+
+    def days(self):
+        """Every date with visits, oldest first, read or not."""
+        return sorted(set(self.segments) | {date for date, records in self.data.items() if records})
+
+    def patient_ids(self):
+        """Every patient ID with a visit on any day."""
+        return list(self.patients)
+
+    def find(self, date, patient_id):
+        """Return the record for patient_id on the given day, or None."""
+        self.day(date)
+        return self.index.lookup(self.data, date, patient_id)
+
+    def find_history(self, patient_id):
+        """Return [(date, record), ...] for every visit of patient_id across all days, oldest first."""
+        patient = self.patients.get(patient_id)
+        if patient is None:
+            return []
+        for date in patient["days"]:
+            self.day(date)
+        return self.index.lookup_history(self.data, patient_id)
+
+    def find_latest(self, patient_id):
+        """Return (date, record) for the most recent visit of patient_id, or (None, None).
+
+        Only that visit's day is read.
+        """
+        patient = self.patients.get(patient_id)
+        if patient is None:
+            return None, None
+        date = patient["days"][-1]
+        return date, self.find(date, patient_id)
+
+    def search(self, query, date=None, limit=None):
+        """Return [(date, record), ...] whose medicine or prescription text has every word of query.
+
+        Newest first, limited to one day if date is given. Without a date every archive is read.
+        """
+        if date is None:
+            self._load_all()
+        else:
+            self.day(date)
+        if self.text_index is None:
+            self.text_index = TextIndex()
+            self.text_index.rebuild(self.data)
+        matches = self.text_index.search(query, date, limit)
+        return [(day, self.find(day, patient_id)) for day, patient_id in matches]
+
+    def search_names(self, query, limit=10):
+        """Return [(patient_id, name, last_visit_date), ...] for patients whose name matches query."""
+        if self.name_index is None:
+            self._rebuild_names()
+        return self.name_index.search(query, limit)
+
+    def rebuild_rollups(self):
+        """Recount the daily rollups from every record and save them with a fresh catalog."""
+        with self.lock:
+            self.refresh()
+            self._load_all()
+            self.rollups.rebuild(self.data)
+            self.compact()
+
+    def add_record(self, date, record, unique=False):
+        """Append a new patient record to the given day.
+
+        With unique, raises StaleRecordError if another desk already added this patient to that day.
+        """
+        with self.lock:
+            self.refresh()
+            if unique and self.find(date, record["patient_id"]) is not None:
+                raise StaleRecordError(f"Patient {record['patient_id']} already has a visit on {date}")
+            self._append({"op": "insert", "date": date, "record": record})
+
+    def add_records(self, date_records):
+        """Append many (date, record) pairs with a single write and fsync, for bulk imports.
+
+        Unlike add_record this never compacts on its own; call compact() once when done.
+        """
+        entries = [{"op": "insert", "date": date, "record": record} for date, record in date_records]
+        with self.lock:
+            self.refresh()
+            self._write(entries)
+
+    def update_record(self, date, patient_id, fields, expected_version=None):
+        """Overwrite some fields of an existing record. Fields hold final values, not deltas.
+
+        Every update bumps the record's version, unless fields set it, as a copy of another
+        store's record does. If expected_version is given and the record has moved on from
+        it, raises StaleRecordError and writes nothing.
+        """
+        with self.lock:
+            self.refresh()
+            record = self.find(date, patient_id)
+            if record is None:
+                raise StaleRecordError(f"Patient {patient_id} has no visit on {date}")
+            version = record.get("version", 0)
+            if expected_version is not None and version != expected_version:
+                raise StaleRecordError(f"Patient {patient_id} was changed by another desk")
+            fields = dict({"version": version + 1}, **fields)
+            self._append({"op": "update", "date": date, "patient_id": patient_id, "fields": fields})
+
+    def add_medication(self, date, patient_id, medication, fields=None, expected_version=None):
+        """Append one medication entry (see medications.new_entry) to a record's history.
+
+        Only the entry is written, however long the history already is. fields are changed
+        as with update_record in the same journal entry, so a crash never keeps one without
+        the other. Bumps the record's version once, and checks expected_version like update_record.
+        """
+        with self.lock:
+            self.refresh()
+            record = self.find(date, patient_id)
+            if record is None:
+                raise StaleRecordError(f"Patient {patient_id} has no visit on {date}")
+            if expected_version is not None and record.get("version", 0) != expected_version:
+                raise StaleRecordError(f"Patient {patient_id} was changed by another desk")
+            entry = {"op": "medicate", "date": date, "patient_id": patient_id, "entry": medication}
+            if fields:
+                entry["fields"] = fields
+            self._append(entry)
+
+    def dispense(self, date, patient_id, positions, dispensed_at):
+        """Mark the medication entries at the given positions of a record as dispensed."""
+        self._append({"op": "dispense", "date": date, "patient_id": patient_id,
+                      "positions": positions, "dispensed_at": dispensed_at})
+
+    @timed("hospital_journal_seconds", operation="compact")
+    def compact(self):
+        """Write the days changed since the last compaction to new segments and empty the journal.
+
+        Days before today are written as archives, and so are open segments of days that
+        have ended since, which leaves today's segment the only plain JSON one.
+        """
+        with self.lock:
+            self.refresh()
+            today = str(datetime.date.today())
+            generation = self.generation + 1
+            ended = {date for date, name in self.segments.items() if date < today and not name.endswith(".gz")}
+            os.makedirs(self.segment_dir, exist_ok=True)
+
+            # New file names every generation, so a reader on the old catalog can still open the old files
+            segments = dict(self.segments)
+            for date in sorted(self.dirty | ended):
+                records = self.day(date)
+                if not records:
+                    segments.pop(date, None)
+                    continue
+                name = f"{date}.{generation}.json" + (".gz" if date < today else "")
+                write_segment(os.path.join(self.segment_dir, name), records)
+                segments[date] = name
+            fsync_directory(os.path.join(self.segment_dir, "."))
+            retired = [name for date, name in self.segments.items() if segments.get(date) != name]
+
+            # Readers see either the old catalog or the new one, never a half-written file
+            tmp_file = self.data_file + ".tmp"
+            with open(tmp_file, "w") as file:
+                json.dump({"format": CATALOG_FORMAT, "generation": generation, "days": segments,
+                           "patients": self.patients, "retired": retired}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file, self.data_file)
+            fsync_directory(self.data_file)
+            with open(self.journal_file, "w") as file:
+                os.fsync(file.fileno())
+
+            # Nobody is on the catalog before the last one any more
+            for name in self.retired:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.segment_dir, name))
+            self.segments = segments
+            self.generation = generation
+            self.retired = retired
+            self.legacy = False
+            self.dirty = set()
+            self.snapshot_stamp = self._snapshot_stamp()
+            # Saved only once the journal is empty, so rollups matching the catalog never
+            # count a journal entry that replaying would count again
+            self.rollups.save(self.rollups_file, self.snapshot_stamp)
+            self.journal_entries = 0
+            self.journal_offset = 0
+
+    def replace(self, data):
+        """Replace everything with the given {date: [records]} data and compact straight away.
+
+        data has to hold every day, as days missing from it are dropped.
+        """
+        with self.lock:
+            # Emptied days lose their segments
+            self.dirty = set(data) | set(self.segments)
+            self.data = {date: data.get(date, []) for date in self.dirty}
+            self.index.rebuild(self.data)
+            self.patients = {}
+            for date in sorted(self.data):
+                for record in self.data[date]:
+                    self._catalog(date, record)
+            if self.text_index is not None:
+                self.text_index.rebuild(self.data)
+            if self.name_index is not None:
+                self._rebuild_names()
+            self.rollups.rebuild(self.data)
+            # Skip compact()'s refresh, it would load the other desks' copy back over ours
+            self.snapshot_stamp = self._snapshot_stamp()
+            self.journal_offset = self._journal_size()
+            self.compact()
@@ -1,27 +1,45 @@
 import tkinter as tk
 from tkinter import messagebox
-import json
 import os
 import datetime
-import hashlib
+from patient_repository import open_repository
+from task_runner import TaskRunner
+from patient_cache import PatientCache
+from change_feed import ChangeFeed
+from metrics import start_export
+from prescription_feed import PrescriptionFeed, publish
+from device_presence import biometric_device
+from biometric_index import BiometricIndex, hash_fingerprint, SIMULATED_FINGERPRINT
+from medications import undispensed_positions
 
 # JSON file to store patient data
 DATA_FILE = "data.json"
 
-def load_data():
-    """Load data from the JSON file. If the file is empty or corrupted, initialize it with an empty dictionary."""
-    if not os.path.exists(DATA_FILE):
-        return {}
-    
-    with open(DATA_FILE, "r") as file:
-        if os.stat(DATA_FILE).st_size == 0:
-            return {}
-        return json.load(file)
+# Storage backend: "json" (data.json plus its journal), "sqlite", "mysql", "hybrid" (MySQL that keeps
+# working offline) or "service" (a shared patient_service.py), see patient_repository.py
+BACKEND = os.environ.get("HOSPITAL_BACKEND", "json")
+# The pharmacy writes too (it marks medicine dispensed), sharing the desks' lock, see journal_store.py
+repository = open_repository(BACKEND, DATA_FILE)
+
+# Patients fetched again while dispensing come from here, checked against their version, see patient_cache.py
+cache = PatientCache(repository)
+
+# Probed in the background so the biometric button answers instantly
+device = biometric_device()
+
+# Fingerprint hash -> patient ID, enrolled by the doctor desk
+biometrics = BiometricIndex(DATA_FILE + ".biometrics")
+
+# Patient currently on screen, redrawn when the doctor desk changes their record
+shown_patient_id = None
+
+# Today's patients with medicine still to hand over, by patient ID in the order they came in
+pending = {}
 
 def is_biometric_device_connected():
-    """Check if a biometric device is connected."""
-    # This is a placeholder; replace it with actual device detection logic.
-    return os.path.exists("/dev/biometric_device")  # Adjust this path as needed for your system
+    """Check if a biometric device is connected, from the background probe's cached result."""
+    # Set BIOMETRIC_DEVICE_PATH to point the probe at your device node, see device_presence.py
+    return device.is_connected()
 
 def fetch_patient_details(patient_id):
     """Fetch and display patient details based on Patient ID."""
@@ -29,28 +47,42 @@ def fetch_patient_details(patient_id):
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    data = load_data()
-    today = str(datetime.date.today())
-
-    if today in data:
-        for record in data[today]:
-            if record["patient_id"] == patient_id:
-                # Clear previous details
-                details_text.delete("1.0", tk.END)
-                details_text.insert(tk.END, f"Patient ID: {record['patient_id']}\n")
-                details_text.insert(tk.END, f"Name: {record['name']}\n")
-                details_text.insert(tk.END, f"Blood Group: {record['blood_group']}\n")
-                details_text.insert(tk.END, f"Age: {record['age']}\n")
-                details_text.insert(tk.END, f"Gender: {record['gender']}\n")
-                details_text.insert(tk.END, f"Issued Medicine:\n{record['issued_medicine']}\n")
-                details_text.insert(tk.END, f"Additional Prescription:\n{record['additional_prescription']}\n")
-                return
-
-    messagebox.showwarning("Not Found", "Patient ID not found.")
-
-def hash_fingerprint(fingerprint_data):
-    """Generate a SHA-256 hash of the given fingerprint data."""
-    return hashlib.sha256(fingerprint_data.encode()).hexdigest()
+    runner.submit(("fetch", patient_id), cache.fetch, patient_id, on_done=show_patient_details)
+
+def show_patient_details(result, quiet=False):
+    """Display a looked-up patient's details."""
+    global shown_patient_id
+    visit_date, record = result
+
+    if record is not None:
+        shown_patient_id = record["patient_id"]
+        # Clear previous details
+        details_text.delete("1.0", tk.END)
+        if visit_date != str(datetime.date.today()):
+            details_text.insert(tk.END, f"Last Visit: {visit_date}\n")
+        details_text.insert(tk.END, f"Patient ID: {record['patient_id']}\n")
+        details_text.insert(tk.END, f"Name: {record['name']}\n")
+        details_text.insert(tk.END, f"Blood Group: {record['blood_group']}\n")
+        details_text.insert(tk.END, f"Age: {record['age']}\n")
+        details_text.insert(tk.END, f"Gender: {record['gender']}\n")
+        if undispensed_only.get():
+            details_text.insert(tk.END, "Not Yet Dispensed:\n")
+            for position in undispensed_positions(record):
+                entry = record["medications"][position]
+                details_text.insert(tk.END, f"{entry['issued_at']} ({entry['issued_by']}): {entry['medicine']}\n")
+        else:
+            details_text.insert(tk.END, f"Issued Medicine:\n{record['issued_medicine']}\n")
+        details_text.insert(tk.END, f"Additional Prescription:\n{record['additional_prescription']}\n")
+        return
+
+    if not quiet:
+        messagebox.showwarning("Not Found", "Patient ID not found.")
+
+def redraw_shown_patient():
+    """Redraw the patient on screen after the change feed picked up new data."""
+    if shown_patient_id is not None:
+        runner.submit(("fetch", shown_patient_id), cache.fetch, shown_patient_id,
+                      on_done=lambda result: show_patient_details(result, quiet=True))
 
 def scan_biometric():
     """Simulate a biometric scan to get a fingerprint ID."""
@@ -60,12 +92,88 @@ def scan_biometric():
 
     # Simulate getting a unique fingerprint from a fingerprint scanner
     # In a real application, replace this with actual biometric device interaction
-    simulated_fingerprint = "SimulatedFingerprintData"  # Placeholder for actual fingerprint data
+    simulated_fingerprint = SIMULATED_FINGERPRINT  # Placeholder for actual fingerprint data
     biometric_id = hash_fingerprint(simulated_fingerprint)
 
-    messagebox.showinfo("Biometric Scan", f"Biometric ID scanned: {biometric_id}")
-    # Fetch patient details based on the scanned biometric ID
-    fetch_patient_details(biometric_id)
+    # Resolve the fingerprint to the patient it was enrolled for, then fetch their details
+    runner.submit(("biometric", biometric_id), biometrics.lookup, biometric_id, on_done=biometric_resolved)
+
+def biometric_resolved(patient_id):
+    """Fetch the details of the patient a scanned fingerprint belongs to."""
+    if patient_id is None:
+        messagebox.showwarning("Not Found", "This fingerprint is not enrolled. Enroll it at the doctor desk first.")
+        return
+    fetch_patient_details(patient_id)
+
+def search_medicine(event=None):
+    """Search every prescription, or only today's, for the words in the search box."""
+    query = search_entry.get().strip()
+    if not query:
+        messagebox.showwarning("Input Error", "Please enter a medicine or word to search for.")
+        return
+
+    date = str(datetime.date.today()) if today_only.get() else None
+    runner.submit(("search", query, date), repository.search, query, date,
+                  on_done=lambda matches: show_search_results(query, matches))
+
+def show_search_results(query, matches):
+    """List the patients whose prescriptions matched a search."""
+    global shown_patient_id
+    shown_patient_id = None  # Nothing for the change feed to redraw
+    details_text.delete("1.0", tk.END)
+    details_text.insert(tk.END, f"{len(matches)} prescription(s) matching \"{query}\":\n\n")
+    for visit_date, record in matches:
+        details_text.insert(tk.END, f"{visit_date}  Patient ID: {record['patient_id']}  Name: {record['name']}\n")
+        details_text.insert(tk.END, f"    Issued Medicine: {' / '.join(record['issued_medicine'].splitlines())}\n")
+        if record["additional_prescription"]:
+            details_text.insert(tk.END, f"    Additional Prescription: {record['additional_prescription']}\n")
+
+def mark_dispensed():
+    """Mark the medicine of the patient on screen as dispensed."""
+    if shown_patient_id is None:
+        messagebox.showwarning("Input Error", "Please fetch a patient first.")
+        return
+    patient_id = shown_patient_id
+    runner.submit(("dispense", patient_id), repository.dispense, patient_id,
+                  on_done=lambda count: medicine_dispensed(patient_id, count))
+
+def medicine_dispensed(patient_id, count):
+    """Confirm what was dispensed and redraw the patient."""
+    cache.invalidate(patient_id)
+    pending.pop(patient_id, None)
+    redraw_pending()
+    # Other pharmacies drop them from their pending lists too
+    publish(patient_id, "dispense")
+    messagebox.showinfo("Dispensed", f"Marked {count} medicine entries dispensed for Patient ID: {patient_id}")
+    redraw_shown_patient()
+
+def prescription_arrived(visit_date, record):
+    """Add a patient the doctor desk just prescribed for to the pending list, or drop one with nothing left to hand over."""
+    if record is None:
+        return
+    patient_id = record["patient_id"]
+    # Just read after the change, so it is the freshest copy there is
+    cache.put(patient_id, (visit_date, record))
+    if visit_date == str(datetime.date.today()) and undispensed_positions(record):
+        pending[patient_id] = record
+    else:
+        pending.pop(patient_id, None)
+    redraw_pending()
+    if patient_id == shown_patient_id:
+        show_patient_details((visit_date, record), quiet=True)
+
+def redraw_pending():
+    """Show the pending list with each patient's medicine still to hand over."""
+    pending_list.delete(0, tk.END)
+    for patient_id, record in pending.items():
+        medicine = " / ".join(record["medications"][position]["medicine"] for position in undispensed_positions(record))
+        pending_list.insert(tk.END, f"{patient_id}  {record['name']}: {medicine}")
+
+def pending_chosen(event=None):
+    """Fetch the patient picked from the pending list."""
+    selection = pending_list.curselection()
+    if selection:
+        fetch_patient_details(list(pending)[selection[0]])
 
 def ask_patient_id_or_biometric():
     """Ask the user if they want to enter a Patient ID or scan a Biometric ID."""
@@ -80,11 +188,20 @@ def ask_patient_id_or_biometric():
 
 def create_main_window():
     """Create the main GUI window."""
-    global patient_id_entry, details_text
+    global patient_id_entry, details_text, runner, search_entry, today_only, undispensed_only, pending_list
 
     window = tk.Tk()
     window.title("Patient Details Display")
-    window.geometry("800x600")  # Increase window size
+    window.geometry("800x960")  # Room for the search box, dispensing and the pending list
+
+    # Storage calls run here so the window never freezes on disk I/O
+    runner = TaskRunner(window)
+    if BACKEND == "json":
+        # Keep the in-memory copy current as the doctor desk writes
+        ChangeFeed(repository.store, window, runner, on_change=redraw_shown_patient)
+    # Build today's part of the search index now rather than on the first search.
+    # Older days are read in when a search over every day first needs them.
+    runner.submit("search", repository.search, "", str(datetime.date.today()))
 
     # Patient ID Entry
     tk.Label(window, text="Patient ID:", font=("Arial", 14)).grid(row=0, column=0, padx=10, pady=10)
@@ -99,7 +216,34 @@ def create_main_window():
     details_text = tk.Text(window, height=20, width=70, font=("Arial", 12))
     details_text.grid(row=2, column=0, columnspan=3, padx=10, pady=10)
 
+    # Medicine / Prescription Search
+    tk.Label(window, text="Search Medicine:", font=("Arial", 14)).grid(row=3, column=0, padx=10, pady=10)
+    search_entry = tk.Entry(window, font=("Arial", 14))
+    search_entry.grid(row=3, column=1, padx=10, pady=10)
+    search_entry.bind("<Return>", search_medicine)
+    tk.Button(window, text="Search", command=search_medicine, font=("Arial", 14)).grid(row=3, column=2, padx=10, pady=10)
+    today_only = tk.BooleanVar(value=True)
+    tk.Checkbutton(window, text="Today only", variable=today_only, font=("Arial", 12)).grid(row=4, column=1, padx=10)
+
+    # Dispensing
+    undispensed_only = tk.BooleanVar(value=False)
+    tk.Checkbutton(window, text="Undispensed only", variable=undispensed_only, command=redraw_shown_patient,
+                   font=("Arial", 12)).grid(row=5, column=0, padx=10, pady=10)
+    tk.Button(window, text="Mark Dispensed", command=mark_dispensed, font=("Arial", 14)).grid(row=5, column=1, padx=10, pady=10)
+
+    # Prescriptions waiting to be handed over, filled in as the doctor desks save them.
+    # Double-click one to fetch it.
+    tk.Label(window, text="Pending Prescriptions:", font=("Arial", 14)).grid(row=6, column=0, columnspan=3, padx=10)
+    pending_list = tk.Listbox(window, height=6, width=80, font=("Arial", 12))
+    pending_list.grid(row=7, column=0, columnspan=3, padx=10, pady=10)
+    pending_list.bind("<Double-Button-1>", pending_chosen)
+    feed = PrescriptionFeed(repository, window, runner, prescription_arrived)
+
     window.mainloop()
+    feed.close()
 
 if __name__ == "__main__":
+    start_export("pharmacy")
+    repository.initialize()
+    device.start()
     create_main_window()
\ No newline at end of file
@@ -0,0 +1,86 @@
+import datetime
+import os
+import socket
+import uuid
+
+# Recorded as issued_by on every medication entry. Set HOSPITAL_DESK to tell desks on one machine apart.
+DESK_NAME = os.environ.get("HOSPITAL_DESK", socket.gethostname())
+
+
+def new_entry(medicine, clears=False):
+    """One medication entry for a record's "medications" list.
+
+    clears marks the point where the doctor chose to clear the old medicine, so
+    everything before it (and the record's own issued_medicine text) is history.
+    """
+    return {
+        "id": uuid.uuid4().hex,
+        "medicine": medicine,
+        "issued_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "issued_by": DESK_NAME,
+        "clears": clears,
+        "dispensed_at": None,
+    }
+
+
+def current_positions(record):
+    """Positions in record["medications"] since the last entry that cleared the old medicine."""
+    entries = record.get("medications", [])
+    start = 0
+    for position, entry in enumerate(entries):
+        if entry["clears"]:
+            start = position
+    return range(start, len(entries))
+
+
+def current_medicine(record):
+    """The medicine text the patient is on now, one line per entry, as issued_medicine used to hold it.
+
+    issued_medicine itself is only the text a record started with (records from before
+    medication entries, imports, or the carried-over medicine of a returning patient).
+    """
+    entries = record.get("medications", [])
+    positions = current_positions(record)
+    cleared = any(entry["clears"] for entry in entries)
+    lines = [] if cleared or not record.get("issued_medicine") else [record["issued_medicine"]]
+    lines.extend(entries[position]["medicine"] for position in positions if entries[position]["medicine"])
+    return "\n".join(lines)
+
+
+def undispensed_positions(record):
+    """Positions of current entries the pharmacy hasn't dispensed yet."""
+    entries = record.get("medications", [])
+    return [position for position in current_positions(record)
+            if entries[position]["dispensed_at"] is None and entries[position]["medicine"]]
+
+
+def dispensed_count(record):
+    """How many of the record's entries the pharmacy has dispensed. It only ever goes up."""
+    return sum(entry["dispensed_at"] is not None for entry in record.get("medications", []))
+
+
+def with_medicine(record):
+    """A copy of record whose issued_medicine is the current medicine text, for display and export.
+
+    The entries are copied too, so a later dispense in the store doesn't change a copy handed out.
+    """
+    return dict(record, issued_medicine=current_medicine(record),
+                medications=[dict(entry) for entry in record.get("medications", [])])
+
+
+# medication_history columns in the order entry_from_row expects, for the SQL backends
+HISTORY_COLUMNS = "entry_id, prescription_id, medicine, issued_at, issued_by, clears_previous, dispensed_at"
+
+
+def entry_from_row(row):
+    """A medication_history row (in HISTORY_COLUMNS order) as a medications entry."""
+    entry_id, _, medicine, issued_at, issued_by, clears, dispensed_at = row
+    return {
+        "id": str(entry_id),
+        "medicine": medicine,
+        "issued_at": issued_at if isinstance(issued_at, str) else issued_at.isoformat(timespec="seconds"),
+        "issued_by": issued_by,
+        "clears": bool(clears),
+        "dispensed_at": dispensed_at if dispensed_at is None or isinstance(dispensed_at, str)
+                        else dispensed_at.isoformat(timespec="seconds"),
+    }
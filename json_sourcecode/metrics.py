@@ -0,0 +1,159 @@
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Operations slower than this many milliseconds are logged to stderr
+SLOW_MS = float(os.environ.get("HOSPITAL_SLOW_MS", 250))
+
+# Where start_export() writes APP.prom every EXPORT_INTERVAL seconds, for node_exporter's
+# textfile collector. Give desks of the same app on one machine directories of their own.
+METRICS_DIR = os.environ.get("HOSPITAL_METRICS_DIR")
+# Port start_export() serves /metrics on, on this machine only. Unset for none.
+METRICS_PORT = os.environ.get("HOSPITAL_METRICS_PORT")
+
+EXPORT_INTERVAL = 15  # Seconds between metrics file writes
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def label_text(labels):
+    """(label, value) pairs as Prometheus writes them, {name="value",...}."""
+    if not labels:
+        return ""
+    escaped = ((name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """Latency histograms and counters kept in this process, rendered in Prometheus text format.
+
+    Series are keyed by metric name and a sorted tuple of (label, value) pairs. Keep label
+    values to a small fixed set, such as operation names, never patient IDs.
+    """
+
+    def __init__(self, slow_ms=SLOW_MS, buckets=BUCKETS):
+        self.slow_ms = slow_ms
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> [count per bucket..., count over the last, sum]
+        self.counters = {}  # (name, labels) -> value
+
+    def observe(self, name, seconds, **labels):
+        """Record one operation that took seconds, and log it if it was slow."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+        if seconds * 1000 >= self.slow_ms:
+            print(f"Slow {name}{label_text(key[1])}: {seconds * 1000:.1f} ms", file=sys.stderr)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the with block as one name operation. Failures also count towards name's _errors_total."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count(name.replace("_seconds", "") + "_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """Every series in Prometheus text exposition format."""
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        typed = set()
+        for (name, labels), values in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                bucket_labels = labels + (("le", bound),)
+                lines.append(f"{name}_bucket{label_text(bucket_labels)} {cumulative}")
+            lines.append(f"{name}_sum{label_text(labels)} {values[-1]}")
+            lines.append(f"{name}_count{label_text(labels)} {cumulative}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_file(self, path):
+        """Write render() to path, swapped in whole so a scrape never reads half a file."""
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as file:
+            file.write(self.render())
+        os.replace(tmp_file, path)
+
+
+# Shared by everything in the process, like db_pool.pool
+registry = Metrics()
+
+
+def timed(name, **labels):
+    """Decorator timing every call of a function with registry.timer."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with registry.timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        payload = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the slow log
+        pass
+
+
+def start_export(app, directory=METRICS_DIR, port=METRICS_PORT):
+    """Export registry as directory/app.prom and on http://127.0.0.1:port/metrics, whichever are set."""
+    if directory:
+        path = os.path.join(directory, f"{app}.prom")
+
+        def export_forever():
+            while True:
+                try:
+                    registry.write_file(path)
+                except OSError as error:
+                    print(f"Metrics export to {path} failed: {error}", file=sys.stderr)
+                time.sleep(EXPORT_INTERVAL)
+
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=export_forever, daemon=True).start()
+    if port:
+        server = ThreadingHTTPServer(("127.0.0.1", int(port)), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
@@ -0,0 +1,179 @@
+import heapq
+import re
+
+FUZZY_THRESHOLD = 0.4  # Least trigram similarity for a word to count as a typo of another
+TYPO_EDITS = 1  # Edits (insert, delete, change, swap) short words may be off by and still match
+
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def name_words(name):
+    return WORD.findall(name.lower())
+
+
+def trigrams(word):
+    """Padded trigrams, so "ann" is {"  a", " an", "ann", "nn "} and short words still match."""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(grams, other):
+    shared = len(grams & other)
+    return shared / (len(grams) + len(other) - shared)
+
+
+def edit_distance(a, b):
+    """Edits to turn a into b, counting a swap of neighbouring letters as one ("jhon" -> "john")."""
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[len(b)]
+
+
+class NameIndex:
+    """Finds patients by name for desks where the patient has forgotten their ID.
+
+    Names are split into words, and words maps each distinct word to the patients
+    whose name contains it. A prefix trie over the words finds "smith" from "smi"
+    by walking three nodes. For typos, the trigram index picks the words sharing
+    some trigrams with the query word, and those close by trigram overlap or within
+    TYPO_EDITS edits ("jhon" for "john") match. Both work on distinct words rather than patients, so they stay small
+    however many patients share a common name. patients keeps each patient's latest
+    (name, visit date), and a new visit only touches the index if the name changed.
+    """
+
+    def __init__(self):
+        self.patients = {}
+        self.words = {}
+        self.trie = {}
+        self.grams = {}
+
+    def rebuild(self, data):
+        """Index every day of the given data from scratch."""
+        self.patients = {}
+        self.words = {}
+        self.trie = {}
+        self.grams = {}
+        for date in sorted(data):
+            for record in data[date]:
+                self.add(record["patient_id"], record["name"], date)
+
+    def add(self, patient_id, name, visit_date):
+        """Index a visit, replacing what the patient was indexed under if their name changed."""
+        old = self.patients.get(patient_id)
+        if old is not None and old[1] > visit_date:
+            return
+        self.patients[patient_id] = (name, visit_date)
+        if old is not None and old[0] == name:
+            return
+        if old is not None:
+            for word in name_words(old[0]):
+                self.words[word].discard(patient_id)
+        for word in name_words(name):
+            if word not in self.words:
+                self.words[word] = set()
+                node = self.trie
+                for char in word:
+                    node = node.setdefault(char, {})
+                node[""] = word
+                for gram in trigrams(word):
+                    self.grams.setdefault(gram, set()).add(word)
+            self.words[word].add(patient_id)
+
+    def _prefix_words(self, prefix):
+        """Every indexed word starting with prefix."""
+        node = self.trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        found = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for key, child in node.items():
+                if key == "":
+                    found.append(child)
+                else:
+                    stack.append(child)
+        return found
+
+    def _close_words(self, word):
+        """{indexed word: similarity} for words that look like a typo of word."""
+        grams = trigrams(word)
+        candidates = set()
+        for gram in grams:
+            candidates.update(self.grams.get(gram, ()))
+        scores = {}
+        for candidate in candidates:
+            score = similarity(grams, trigrams(candidate))
+            if score >= FUZZY_THRESHOLD:
+                scores[candidate] = score
+            elif abs(len(candidate) - len(word)) <= TYPO_EDITS and edit_distance(word, candidate) <= TYPO_EDITS:
+                scores[candidate] = FUZZY_THRESHOLD
+        return scores
+
+    def _patients(self, words):
+        ids = set()
+        for word in words:
+            ids.update(self.words[word])
+        return ids
+
+    def _ranked(self, ids, limit, key):
+        return [(patient_id,) + self.patients[patient_id] for patient_id in heapq.nsmallest(limit, ids, key=key)]
+
+    def search(self, query, limit=10):
+        """Return [(patient_id, name, last_visit_date), ...], prefix matches first, then typo matches.
+
+        Every word of query has to match a word of the name.
+        """
+        words = name_words(query)
+        if not words:
+            return []
+
+        if len(words) == 1:
+            # Walk the matching words in order and stop once there are enough patients,
+            # so a one-letter query doesn't gather half the hospital
+            prefix = set()
+            for word in sorted(self._prefix_words(words[0])):
+                prefix.update(heapq.nsmallest(limit - len(prefix), self.words[word] - prefix))
+                if len(prefix) >= limit:
+                    break
+        else:
+            prefix = None
+            for word in sorted(words, key=len, reverse=True):
+                ids = self._patients(self._prefix_words(word))
+                prefix = ids if prefix is None else prefix & ids
+                if not prefix:
+                    break
+        found = self._ranked(prefix, limit, key=lambda patient_id: (self.patients[patient_id][0].lower(), patient_id))
+        if len(found) == limit:
+            return found
+
+        # Not enough prefix matches, so allow each word to be a typo too
+        fuzzy = None
+        word_scores = []
+        for word in words:
+            scores = self._close_words(word)
+            scores.update((prefix_word, 1.0) for prefix_word in self._prefix_words(word))
+            word_scores.append(scores)
+            ids = self._patients(scores)
+            fuzzy = ids if fuzzy is None else fuzzy & ids
+            if not fuzzy:
+                return found
+        fuzzy -= prefix
+
+        # Many patients share a name, so score each distinct name once
+        name_scores = {}
+
+        def score(patient_id):
+            name = self.patients[patient_id][0]
+            if name not in name_scores:
+                parts = name_words(name)
+                name_scores[name] = -sum(max(scores.get(part, 0) for part in parts) for scores in word_scores)
+            return name_scores[name]
+        return found + self._ranked(fuzzy, limit - len(found), key=lambda patient_id: (score(patient_id), patient_id))
@@ -0,0 +1,111 @@
+import json
+import os
+import uuid
+from file_lock import FileLock
+
+
+class Outbox:
+    """A durable first-in first-out queue of writes waiting to go to a server, one JSON line each.
+
+    put() fsyncs before returning, like the journal does, so a queued write survives a
+    crash. A sender takes pending() writes, applies them and then ack()s them. The
+    acknowledged offset lives in its own small file, replaced atomically, and the queue
+    file is emptied once everything in it is acknowledged. A crash between applying
+    and ack() sends the same writes again, so each one gets a "key" to skip repeats by.
+
+    put() only holds lock, and senders hold send_lock from pending() to ack(), so a
+    desk never waits on a send and two processes never send the same queue at once.
+
+    The writes read so far stay in memory, so pending() only reads what was put since,
+    however often a status line asks. The acked file also counts how many times the
+    queue was emptied, which tells a process another one emptied it in the meantime.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.acked_file = path + ".acked"
+        self.lock = FileLock(path + ".lock")
+        self.send_lock = FileLock(path + ".send.lock")
+        self.writes = []  # (offset, write) read from the file and not acknowledged yet
+        self.read_to = 0  # File offset self.writes goes up to
+        self.resets = 0  # Times the queue was emptied when self.writes was read
+
+    def put(self, operation):
+        """Queue one write (a JSON-able dict) and return its idempotency key."""
+        operation = dict(operation, key=uuid.uuid4().hex)
+        line = (json.dumps(operation) + "\n").encode()
+        with self.lock:
+            with open(self.path, "a+b") as file:
+                size = file.seek(0, os.SEEK_END)
+                if size:
+                    file.seek(size - 1)
+                    if file.read(1) != b"\n":
+                        # A put() torn by a crash, end it so it stays a line of its own
+                        line = b"\n" + line
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        return operation["key"]
+
+    def _acked(self):
+        """(offset acknowledged up to, times the queue was emptied)."""
+        try:
+            with open(self.acked_file, "r") as file:
+                parts = file.read().split()
+        except FileNotFoundError:
+            parts = []
+        # Files from before the count hold only the offset
+        return int(parts[0]) if parts else 0, int(parts[1]) if len(parts) > 1 else 0
+
+    def _write_acked(self, offset, resets):
+        tmp_file = self.acked_file + ".tmp"
+        with open(tmp_file, "w") as file:
+            file.write(f"{offset} {resets}")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.acked_file)
+
+    def pending(self, limit=None):
+        """Return [(offset, write), ...] for the oldest unacknowledged writes, at most limit of them.
+
+        Pass the last offset to ack() once they have been applied.
+        """
+        with self.lock:
+            self._catch_up()
+            return self.writes[:limit]
+
+    def _catch_up(self):
+        # The caller holds lock
+        acked, resets = self._acked()
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if resets != self.resets or size < self.read_to:
+            # Emptied since we last looked, start over
+            self.writes, self.read_to, self.resets = [], 0, resets
+        if size > self.read_to:
+            with open(self.path, "rb") as file:
+                file.seek(self.read_to)
+                chunk = file.read(size - self.read_to)
+            for line in chunk.splitlines(keepends=True):
+                self.read_to += len(line)
+                try:
+                    self.writes.append((self.read_to, json.loads(line)))
+                except ValueError:
+                    # Torn by a crash mid-put(), so the desk was never told it was queued
+                    pass
+        done = 0
+        while done < len(self.writes) and self.writes[done][0] <= acked:
+            done += 1
+        del self.writes[:done]
+
+    def ack(self, offset):
+        """Mark every write up to offset (from pending()) as applied."""
+        with self.lock:
+            _, resets = self._acked()
+            if offset >= os.path.getsize(self.path):
+                # All applied. Reset the offset before emptying the file: a crash in
+                # between only resends writes, the other way round would skip new ones.
+                self._write_acked(0, resets + 1)
+                with open(self.path, "w"):
+                    pass
+            else:
+                self._write_acked(offset, resets)
@@ -0,0 +1,94 @@
+import collections
+import threading
+import time
+from patient_repository import visit_version
+
+CACHE_SIZE = 200  # Most patients kept, least recently fetched dropped first
+CACHE_TTL = 300  # Seconds a cached visit is kept at most, so patients seen once don't hold a place all day
+
+
+class PatientCache:
+    """Read-through LRU cache in front of repository.get, for the pharmacy's repeat lookups.
+
+    fetch() serves a cached visit only while repository.get_version still gives its
+    visit date, version and dispensed count, so a change made anywhere, a dispense at
+    another counter included, is never shown stale. That check is one small query instead of the visit and
+    its whole medication history. A patient's entry is also dropped by invalidate() when
+    this desk changes them, and every patient has a write count: a load that began before
+    a write doesn't fill the cache, so a slow read never puts back what a write just dropped.
+
+    Call fetch() and load() from the task runner. Not-found patients aren't cached, as
+    they may be registered any moment.
+    """
+
+    def __init__(self, repository, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.repository = repository
+        self.size = size
+        self.ttl = ttl
+        self.visits = collections.OrderedDict()  # patient_id -> (visit, filled_at), most recently used last
+        self.writes = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "expired": 0, "evicted": 0, "invalidated": 0}
+
+    def _seen(self, patient_id):
+        return self.writes.get(patient_id, 0)
+
+    def get(self, patient_id):
+        """Return the cached (visit_date, record) for patient_id, or None, without checking it's current."""
+        with self.lock:
+            cached = self.visits.get(patient_id)
+            if cached is not None and time.monotonic() - cached[1] > self.ttl:
+                del self.visits[patient_id]
+                self.counters["expired"] += 1
+                cached = None
+            if cached is None:
+                return None
+            self.visits.move_to_end(patient_id)
+            return cached[0]
+
+    def put(self, patient_id, visit, seen=None):
+        """Cache visit as the patient's latest. With seen, only if nothing was written since it was taken."""
+        with self.lock:
+            if seen is not None and seen != self._seen(patient_id):
+                return
+            self.visits[patient_id] = (visit, time.monotonic())
+            self.visits.move_to_end(patient_id)
+            while len(self.visits) > self.size:
+                self.visits.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def load(self, patient_id):
+        """Read the patient from the repository and cache them. Returns (visit_date, record)."""
+        with self.lock:
+            seen = self._seen(patient_id)
+        visit = self.repository.get(patient_id)
+        if visit[1] is not None:
+            self.put(patient_id, visit, seen)
+        return visit
+
+    def fetch(self, patient_id):
+        """get() if the cached visit is still the patient's latest version, load() otherwise."""
+        visit = self.get(patient_id)
+        if visit is None:
+            outcome = "misses"
+        elif self.repository.get_version(patient_id) == visit_version(*visit):
+            outcome = "hits"
+        else:
+            outcome = "stale"
+        with self.lock:
+            self.counters[outcome] += 1
+        return visit if outcome == "hits" else self.load(patient_id)
+
+    def invalidate(self, patient_id):
+        """Drop the patient after a write, including any load of them still running."""
+        with self.lock:
+            if self.visits.pop(patient_id, None) is not None:
+                self.counters["invalidated"] += 1
+            self.writes[patient_id] = self.writes.get(patient_id, 0) + 1
+
+    def get_stats(self):
+        """Current size and lifetime counters, for sizing CACHE_SIZE and CACHE_TTL."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(size=len(self.visits), capacity=self.size)
+        return stats
@@ -0,0 +1,71 @@
+class PatientIndex:
+    """In-process patient_id -> record position index.
+
+    days maps date -> {patient_id: offset} for same-day lookups, and history maps
+    patient_id -> [(date, offset), ...] across every day so a returning patient is
+    found without scanning older days. Both are updated on every write. If the
+    index is found to be missing or stale for a day (the day has more records than
+    were indexed, or a position no longer holds that patient) it rebuilds that day.
+    """
+
+    def __init__(self):
+        self.days = {}
+        self.counts = {}
+        self.history = {}
+
+    def rebuild(self, data):
+        """Index every day of the given data from scratch."""
+        self.days = {}
+        self.counts = {}
+        self.history = {}
+        for date, records in data.items():
+            self.rebuild_day(date, records)
+
+    def rebuild_day(self, date, records):
+        """Index one day's records. The first record wins if a patient_id repeats."""
+        for patient_id in self.days.get(date, {}):
+            visits = [visit for visit in self.history.get(patient_id, []) if visit[0] != date]
+            if visits:
+                self.history[patient_id] = visits
+            else:
+                self.history.pop(patient_id, None)
+
+        positions = {}
+        for offset, record in enumerate(records):
+            positions.setdefault(record["patient_id"], offset)
+            self.history.setdefault(record["patient_id"], []).append((date, offset))
+        self.days[date] = positions
+        self.counts[date] = len(records)
+
+    def add(self, date, patient_id, offset):
+        """Record that a new record for patient_id sits at offset in the given day."""
+        self.days.setdefault(date, {}).setdefault(patient_id, offset)
+        self.counts[date] = self.counts.get(date, 0) + 1
+        self.history.setdefault(patient_id, []).append((date, offset))
+
+    def lookup(self, data, date, patient_id):
+        """Return the record for patient_id on the given day, or None."""
+        records = data.get(date, [])
+        if self.counts.get(date) != len(records):
+            self.rebuild_day(date, records)
+
+        offset = self.days.get(date, {}).get(patient_id)
+        if offset is not None and (offset >= len(records) or records[offset]["patient_id"] != patient_id):
+            self.rebuild_day(date, records)
+            offset = self.days[date].get(patient_id)
+
+        if offset is None:
+            return None
+        return records[offset]
+
+    def lookup_history(self, data, patient_id):
+        """Return [(date, record), ...] for every visit of patient_id, oldest first."""
+        visits = []
+        for date, offset in sorted(self.history.get(patient_id, [])):
+            records = data.get(date, [])
+            if offset >= len(records) or records[offset]["patient_id"] != patient_id:
+                # Stale entry, rebuild that day and start over
+                self.rebuild_day(date, records)
+                return self.lookup_history(data, patient_id)
+            visits.append((date, records[offset]))
+        return visits
@@ -0,0 +1,656 @@
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+from journal_store import JournalStore, StaleRecordError
+from id_allocator import PatientIdAllocator, PATIENT_ID_WIDTH
+from text_index import tokenize
+from name_index import NameIndex
+from medications import (new_entry, with_medicine, undispensed_positions, dispensed_count, HISTORY_COLUMNS,
+                         entry_from_row)
+from daily_rollups import (DailyRollups, visit_keys, medication_keys, table_keys, TOTAL,
+                           VISIT_QUERY, MEDICATION_QUERY)
+from metrics import timed
+
+MYSQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mysql_SOURCE CODE")
+
+# Fields a caller supplies for a new patient. The repository adds patient_id and date.
+PATIENT_FIELDS = ["name", "blood_group", "age", "gender", "issued_medicine", "additional_prescription"]
+
+# Times update_medicine re-reads and retries when another desk changed the record first
+UPDATE_ATTEMPTS = 5
+
+SEARCH_LIMIT = 200  # Most matches a medicine search returns
+NAME_LIMIT = 10  # Most candidates a name lookup returns
+
+# What update_medicine_many reports for each update
+UPDATED = "updated"
+NOT_FOUND = "not found"
+STALE = "stale"  # The visit changed since the caller read it, nothing was written
+
+
+class PatientRepository:
+    """The storage operations every front end needs, whatever the backend.
+
+    Records are plain dicts with the keys the JSON file has always used (patient_id,
+    name, blood_group, age, gender, issued_medicine, additional_prescription, date),
+    plus "medications", the visit's list of timestamped medication entries (see
+    medications.py). In records returned to callers issued_medicine is the current
+    medicine text worked out from those entries. Visit dates are "YYYY-MM-DD" strings.
+    "version" goes up with every change to a visit, and a new visit for a returning
+    patient starts one past the old one, so callers can tell if what they read is stale.
+    """
+
+    def initialize(self):
+        """Create whatever files or tables the backend needs."""
+
+    def create(self, fields, patient_id=None):
+        """Store a new patient visit for today and return its patient ID."""
+        raise NotImplementedError
+
+    def create_many(self, patients):
+        """Store several new visits given as (fields, patient_id) pairs and return their patient IDs.
+
+        Backends override it to write the whole batch at once.
+        """
+        return [self.create(fields, patient_id) for fields, patient_id in patients]
+
+    def get(self, patient_id):
+        """Return (visit_date, record) for the patient's latest visit on any day, or (None, None)."""
+        raise NotImplementedError
+
+    def get_version(self, patient_id):
+        """Return (visit_date, version, dispensed) of the patient's latest visit, or None.
+
+        dispensed counts its dispensed entries, as dispensing doesn't bump the version.
+        Compare it with visit_version() of a copy from get() to tell if that copy is still
+        current. Backends override it with something cheaper than get().
+        """
+        return visit_version(*self.get(patient_id))
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        """Add medicine to the patient's latest visit, or replace it if clear_old. Returns False if not found.
+
+        The medicine is appended as one new entry, the history before it is kept. A patient
+        last seen on an earlier day gets a new visit today, starting from that visit's medicine.
+        If expected_version is given and the latest visit's version isn't it any more, raises
+        StaleRecordError and writes nothing.
+        """
+        raise NotImplementedError
+
+    def update_medicine_many(self, updates):
+        """Apply several update_medicine calls, given as tuples of its arguments, and return
+        UPDATED, NOT_FOUND or STALE for each.
+
+        Backends override it to write the whole batch at once.
+        """
+        statuses = []
+        for update in updates:
+            try:
+                statuses.append(UPDATED if self.update_medicine(*update) else NOT_FOUND)
+            except StaleRecordError:
+                statuses.append(STALE)
+        return statuses
+
+    def dispense(self, patient_id):
+        """Mark every undispensed entry of the patient's latest visit as dispensed. Returns how many."""
+        raise NotImplementedError
+
+    def list_day(self, date):
+        """Return every record for the given day."""
+        raise NotImplementedError
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        """Return [(visit_date, record), ...] whose issued_medicine or additional_prescription
+        contains every word of query, newest first. Only that day's visits if date is given."""
+        raise NotImplementedError
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        """Return [(patient_id, name, last_visit_date), ...] for patients whose name starts
+        with or is close to query, for patients who lost their ID."""
+        raise NotImplementedError
+
+    def pending_prescriptions(self, since=None):
+        """Return (mark, [(visit_date, record), ...]) for today's visits given medicine after since.
+
+        since is the mark an earlier call returned, None for all of today. Marks only mean
+        something to the backend that made them. A visit can come back more than once, so
+        callers key what they keep by patient ID. See prescription_feed.py.
+        """
+        raise NotImplementedError
+
+    def daily_rollups(self, start=None, end=None):
+        """Return {day: {dimension: {value: count}}} for days from start to end (see daily_rollups.py).
+
+        The counts are kept up to date by every write, so this never scans visits.
+        """
+        raise NotImplementedError
+
+    def rebuild_rollups(self):
+        """Recount the daily rollups from every visit, after imports or if they were lost."""
+        raise NotImplementedError
+
+
+def today():
+    return str(datetime.date.today())
+
+
+def visit_version(visit_date, record):
+    """What get_version returns for a (visit_date, record) from get()."""
+    if record is None:
+        return None
+    return visit_date, record.get("version", 0), dispensed_count(record)
+
+
+def full_update(update):
+    """An update_medicine_many tuple with clear_old and expected_version filled in."""
+    return tuple(update) + (False, None)[len(update) - 3:]
+
+
+def check_version(patient_id, version, expected_version):
+    if expected_version is not None and version != expected_version:
+        raise StaleRecordError(f"Patient {patient_id} was changed by another desk")
+
+
+class JsonRepository(PatientRepository):
+    """The data.json catalog, per-day segments and journal, see journal_store.py."""
+
+    def __init__(self, data_file, read_only=False):
+        self.data_file = data_file
+        self.store = JournalStore(data_file, read_only=read_only)
+        self.allocator = PatientIdAllocator(data_file + ".seq")
+
+    def initialize(self):
+        if not self.store.read_only:
+            with self.store.lock:
+                if not os.path.exists(self.data_file) or os.stat(self.data_file).st_size == 0:
+                    with open(self.data_file, "w") as file:
+                        json.dump({}, file)
+        self.store.load()
+        if not self.store.read_only:
+            self.allocator.seed(self.store.patient_ids())
+
+    def _new_record(self, fields, patient_id):
+        record = {"patient_id": patient_id}
+        record.update((field, fields[field]) for field in PATIENT_FIELDS)
+        record["date"] = datetime.datetime.now().isoformat()
+        # The first prescription is the first medication entry
+        record["medications"] = [new_entry(record["issued_medicine"])] if record["issued_medicine"] else []
+        record["issued_medicine"] = ""
+        return record
+
+    def create(self, fields, patient_id=None):
+        record = self._new_record(fields, patient_id or self.allocator.allocate())
+        self.store.add_record(today(), record)
+        return record["patient_id"]
+
+    def create_many(self, patients):
+        # IDs reserved as one block and every record in one journal write and fsync
+        new_ids = iter(self.allocator.allocate_block(sum(1 for _, patient_id in patients if not patient_id)))
+        records = [self._new_record(fields, patient_id or next(new_ids)) for fields, patient_id in patients]
+        with self.store.lock:
+            self.store.add_records((today(), record) for record in records)
+            if self.store.journal_entries >= self.store.compact_every:
+                self.store.compact()
+        return [record["patient_id"] for record in records]
+
+    def get(self, patient_id):
+        # Cheap when nothing changed, and picks up other processes' writes when something did
+        self.store.refresh()
+        visit_date, record = self.store.find_latest(patient_id)
+        return visit_date, record and with_medicine(record)
+
+    def get_version(self, patient_id):
+        self.store.refresh()
+        # Without with_medicine's copy
+        return visit_version(*self.store.find_latest(patient_id))
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        entry = new_entry(issued_medicine, clear_old) if issued_medicine or clear_old else None
+        return self.add_medicine(patient_id, entry, additional_prescription, clear_old, expected_version)
+
+    def update_medicine_many(self, updates):
+        # One lock hold for the batch, so other desks see all of it or none of it yet
+        with self.store.lock:
+            return super().update_medicine_many(updates)
+
+    def add_medicine(self, patient_id, entry, additional_prescription, clear_old=False, expected_version=None):
+        """update_medicine with a medication entry the caller made (None for none), see offline_repository.py."""
+        if expected_version is not None:
+            # Whatever another desk changed is for the caller to look at, not for us to retry over
+            return self._add_medicine(patient_id, entry, additional_prescription, clear_old, expected_version)
+        # Optimistic: a returning patient's new visit is added without holding the lock,
+        # and we start over if another desk added it first
+        for _ in range(UPDATE_ATTEMPTS):
+            try:
+                return self._add_medicine(patient_id, entry, additional_prescription, clear_old)
+            except StaleRecordError:
+                pass
+        # Still losing the race, so hold the lock for the whole read-write
+        with self.store.lock:
+            return self._add_medicine(patient_id, entry, additional_prescription, clear_old)
+
+    def _add_medicine(self, patient_id, entry, additional_prescription, clear_old, expected_version=None):
+        visit_date, record = self.get(patient_id)
+        if record is None:
+            return False
+        if visit_date == today():
+            # One journal entry either way, checked against expected_version under the store's lock
+            fields = {"additional_prescription": additional_prescription}
+            if entry is not None:
+                changed = additional_prescription != record["additional_prescription"]
+                self.store.add_medication(visit_date, patient_id, entry, fields if changed else None,
+                                          expected_version)
+            else:
+                self.store.update_record(visit_date, patient_id, fields, expected_version)
+        else:
+            check_version(patient_id, record.get("version", 0), expected_version)
+            self.store.add_record(today(), dict(
+                record,
+                # Carry the medicine they were on over as the new visit's starting text
+                issued_medicine="" if clear_old else record["issued_medicine"],
+                medications=[entry] if entry is not None else [],
+                additional_prescription=additional_prescription,
+                date=datetime.datetime.now().isoformat(),
+                version=record.get("version", 0) + 1
+            ), unique=True)
+        return True
+
+    def dispense(self, patient_id):
+        with self.store.lock:
+            self.store.refresh()
+            visit_date, record = self.store.find_latest(patient_id)
+            if record is None:
+                return 0
+            positions = undispensed_positions(record)
+            if positions:
+                self.store.dispense(visit_date, patient_id, positions,
+                                    datetime.datetime.now().isoformat(timespec="seconds"))
+            return len(positions)
+
+    def list_day(self, date):
+        self.store.refresh()
+        return [with_medicine(record) for record in self.store.day(date)]
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        self.store.refresh()
+        return [(visit_date, with_medicine(record)) for visit_date, record in self.store.search(query, date, limit)]
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        self.store.refresh()
+        return self.store.search_names(query, limit)
+
+    def pending_prescriptions(self, since=None):
+        # The mark is the latest issued_at seen. Entries issued in that same second come
+        # back again, which callers put up with, rather than ever missing one.
+        self.store.refresh()
+        mark, visits = since or "", []
+        for record in self.store.day(today()):
+            issued = max((entry["issued_at"] for entry in record.get("medications", [])), default="")
+            if issued and issued >= (since or ""):
+                visits.append((today(), with_medicine(record)))
+                mark = max(mark, issued)
+        return mark, visits
+
+    def daily_rollups(self, start=None, end=None):
+        self.store.refresh()
+        return self.store.rollups.between(start, end)
+
+    def rebuild_rollups(self):
+        self.store.rebuild_rollups()
+
+
+# Same shape as the MySQL prescriptions table in mysql_SOURCE CODE/schema.py
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prescriptions (
+    prescription_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id TEXT,
+    name TEXT,
+    blood_group TEXT,
+    age TEXT,
+    gender TEXT,
+    issued_medicine TEXT,
+    additional_prescription TEXT,
+    date TEXT,
+    last_login TEXT,
+    visit_date TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_visit_patient ON prescriptions (visit_date, patient_id);
+CREATE INDEX IF NOT EXISTS idx_patient_visit ON prescriptions (patient_id, visit_date);
+CREATE TABLE IF NOT EXISTS patient_id_sequence (
+    id INTEGER PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO patient_id_sequence (id, last_id) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS medication_history (
+    entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prescription_id INTEGER NOT NULL,
+    medicine TEXT NOT NULL,
+    issued_at TEXT NOT NULL,
+    issued_by TEXT,
+    clears_previous INTEGER NOT NULL DEFAULT 0,
+    dispensed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_prescription ON medication_history (prescription_id, entry_id);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    day TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, dimension, value)
+);
+"""
+
+# SQLite's default cap on ? parameters in one statement is 999 on older builds
+IN_CHUNK = 500
+
+ROLLUP_UPSERT = """
+INSERT INTO daily_rollups (day, dimension, value, count) VALUES (?, ?, ?, ?)
+ON CONFLICT (day, dimension, value) DO UPDATE SET count = count + excluded.count
+"""
+
+RECORD_COLUMNS = "patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription, date, version"
+
+
+class SqliteRepository(PatientRepository):
+    """Embedded SQLite in WAL mode, for single-site installs that want indexes without a server.
+
+    WAL lets the pharmacy read while a desk writes. Each thread gets its own
+    connection, as sqlite3 connections can't be shared between threads.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        # Fed from rows past the highest prescription_id seen, see find_by_name
+        self.names = NameIndex()
+        self.names_seen = 0
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def initialize(self):
+        conn = self.connect()
+        conn.executescript(SQLITE_SCHEMA)
+        # Databases made before row versions have no version column yet
+        if "version" not in [column["name"] for column in conn.execute("PRAGMA table_info(prescriptions)")]:
+            conn.execute("ALTER TABLE prescriptions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _record(self, row):
+        return {key: row[key] for key in RECORD_COLUMNS.split(", ")}
+
+    def _records(self, conn, rows):
+        """Records for prescriptions rows, with their medication history attached."""
+        rows = list(rows)
+        history = {}
+        ids = [row["prescription_id"] for row in rows]
+        for start in range(0, len(ids), IN_CHUNK):
+            chunk = ids[start:start + IN_CHUNK]
+            for entry in conn.execute(f"""
+            SELECT {HISTORY_COLUMNS} FROM medication_history
+            WHERE prescription_id IN ({", ".join("?" * len(chunk))}) ORDER BY entry_id
+            """, chunk):
+                history.setdefault(entry["prescription_id"], []).append(entry_from_row(tuple(entry)))
+        return [with_medicine(dict(self._record(row), medications=history.get(row["prescription_id"], [])))
+                for row in rows]
+
+    def _add_entry(self, conn, prescription_id, entry):
+        conn.execute(f"""
+        INSERT INTO medication_history ({HISTORY_COLUMNS.split(", ", 1)[1]}) VALUES (?, ?, ?, ?, ?, ?)
+        """, (prescription_id, entry["medicine"], entry["issued_at"], entry["issued_by"], entry["clears"], None))
+
+    def _count(self, conn, keys):
+        """Add keys (see daily_rollups.py) to the daily_rollups table, in the caller's transaction."""
+        rollups = DailyRollups()
+        rollups.add(keys)
+        conn.executemany(ROLLUP_UPSERT, list(rollups.rows()))
+
+    def _latest(self, conn, patient_id):
+        return conn.execute("""
+        SELECT * FROM prescriptions
+        WHERE patient_id = ? ORDER BY visit_date DESC, prescription_id DESC LIMIT 1
+        """, (patient_id,)).fetchone()
+
+    def _insert(self, conn, record, visit_date):
+        return conn.execute(f"""
+        INSERT INTO prescriptions ({RECORD_COLUMNS}, visit_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, tuple(record[key] for key in RECORD_COLUMNS.split(", ")) + (visit_date,)).lastrowid
+
+    def _create(self, conn, fields, patient_id):
+        if patient_id is None:
+            conn.execute("UPDATE patient_id_sequence SET last_id = last_id + 1 WHERE id = 1")
+            last_id = conn.execute("SELECT last_id FROM patient_id_sequence WHERE id = 1").fetchone()[0]
+            patient_id = str(last_id).zfill(PATIENT_ID_WIDTH)
+        record = {"patient_id": patient_id, "date": datetime.datetime.now().isoformat(), "version": 0}
+        record.update((field, fields[field]) for field in PATIENT_FIELDS)
+        record["issued_medicine"] = ""
+        prescription_id = self._insert(conn, record, today())
+        entry = new_entry(fields["issued_medicine"]) if fields["issued_medicine"] else None
+        if entry is not None:
+            self._add_entry(conn, prescription_id, entry)
+        self._count(conn, visit_keys(today(), dict(record, medications=[entry] if entry is not None else [])))
+        return patient_id
+
+    def create(self, fields, patient_id=None):
+        return self.create_many([(fields, patient_id)])[0]
+
+    def create_many(self, patients):
+        conn = self.connect()
+        # BEGIN IMMEDIATE takes the write lock up front, so two desks can't read the same sequence value
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            patient_ids = [self._create(conn, fields, patient_id) for fields, patient_id in patients]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return patient_ids
+
+    def get(self, patient_id):
+        conn = self.connect()
+        row = self._latest(conn, patient_id)
+        if row is None:
+            return None, None
+        return row["visit_date"], self._records(conn, [row])[0]
+
+    def get_version(self, patient_id):
+        row = self.connect().execute("""
+        SELECT visit_date, version, (SELECT COUNT(dispensed_at) FROM medication_history history
+                                     WHERE history.prescription_id = prescriptions.prescription_id) AS dispensed
+        FROM prescriptions
+        WHERE patient_id = ? ORDER BY visit_date DESC, prescription_id DESC LIMIT 1
+        """, (patient_id,)).fetchone()
+        return row and (row["visit_date"], row["version"], row["dispensed"])
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        status, = self.update_medicine_many([(patient_id, issued_medicine, additional_prescription, clear_old,
+                                              expected_version)])
+        if status == STALE:
+            raise StaleRecordError(f"Patient {patient_id} was changed by another desk")
+        return status == UPDATED
+
+    def update_medicine_many(self, updates):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            statuses = [self._update_medicine(conn, *full_update(update)) for update in updates]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return statuses
+
+    def _update_medicine(self, conn, patient_id, issued_medicine, additional_prescription, clear_old,
+                         expected_version):
+        """One update of update_medicine_many, in the caller's transaction."""
+        row = self._latest(conn, patient_id)
+        if row is None:
+            return NOT_FOUND
+        if expected_version is not None and row["version"] != expected_version:
+            return STALE
+        entry = new_entry(issued_medicine, clear_old) if issued_medicine or clear_old else None
+        prescription_id = row["prescription_id"]
+        if row["visit_date"] == today():
+            conn.execute("UPDATE prescriptions SET additional_prescription = ?, version = version + 1 "
+                         "WHERE prescription_id = ?", (additional_prescription, prescription_id))
+            if entry is not None:
+                self._count(conn, medication_keys(today(), entry))
+        else:
+            # Carry the medicine they were on over as the new visit's starting text
+            record = self._records(conn, [row])[0]
+            record.update(issued_medicine="" if clear_old else record["issued_medicine"],
+                          additional_prescription=additional_prescription,
+                          date=datetime.datetime.now().isoformat(),
+                          version=row["version"] + 1)
+            prescription_id = self._insert(conn, record, today())
+            self._count(conn, visit_keys(today(), dict(record, medications=[entry] if entry is not None else [])))
+        if entry is not None:
+            self._add_entry(conn, prescription_id, entry)
+        return UPDATED
+
+    def dispense(self, patient_id):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._latest(conn, patient_id)
+            record = self._records(conn, [row])[0] if row is not None else {}
+            entry_ids = [int(record["medications"][position]["id"]) for position in undispensed_positions(record)]
+            for start in range(0, len(entry_ids), IN_CHUNK):
+                chunk = entry_ids[start:start + IN_CHUNK]
+                conn.execute(f"""
+                UPDATE medication_history SET dispensed_at = ? WHERE entry_id IN ({", ".join("?" * len(chunk))})
+                """, [datetime.datetime.now().isoformat(timespec="seconds")] + chunk)
+            self._count(conn, [(today(), "dispensed", TOTAL)] * len(entry_ids))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(entry_ids)
+
+    def list_day(self, date):
+        conn = self.connect()
+        rows = conn.execute("SELECT * FROM prescriptions WHERE visit_date = ? ORDER BY prescription_id", (date,))
+        return self._records(conn, rows)
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # No full-text index here, so each word is a substring match on both columns and the history
+        sql = "SELECT * FROM prescriptions p WHERE "
+        sql += " AND ".join(["""(p.issued_medicine LIKE ? OR p.additional_prescription LIKE ? OR EXISTS (
+            SELECT 1 FROM medication_history h WHERE h.prescription_id = p.prescription_id AND h.medicine LIKE ?))"""]
+                            * len(terms))
+        params = [f"%{term}%" for term in terms for _ in range(3)]
+        if date is not None:
+            sql += " AND p.visit_date = ?"
+            params.append(date)
+        sql += " ORDER BY p.visit_date DESC, p.prescription_id DESC LIMIT ?"
+        conn = self.connect()
+        rows = conn.execute(sql, params + [limit]).fetchall()
+        return [(row["visit_date"], record) for row, record in zip(rows, self._records(conn, rows))]
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        rows = self.connect().execute("""
+        SELECT prescription_id, patient_id, name, visit_date FROM prescriptions
+        WHERE prescription_id > ? ORDER BY prescription_id
+        """, (self.names_seen,))
+        for row in rows:
+            self.names.add(row["patient_id"], row["name"] or "", row["visit_date"])
+            self.names_seen = row["prescription_id"]
+        return self.names.search(query, limit)
+
+    def pending_prescriptions(self, since=None):
+        # Writers are serialized by BEGIN IMMEDIATE, so entry IDs commit in order
+        conn = self.connect()
+        mark = conn.execute("SELECT COALESCE(MAX(entry_id), 0) FROM medication_history").fetchone()[0]
+        rows = conn.execute("""
+        SELECT * FROM prescriptions WHERE visit_date = ? AND prescription_id IN (
+            SELECT prescription_id FROM medication_history WHERE entry_id > ? AND entry_id <= ?)
+        ORDER BY prescription_id
+        """, (today(), int(since or 0), mark)).fetchall()
+        return mark, [(row["visit_date"], record) for row, record in zip(rows, self._records(conn, rows))]
+
+    def daily_rollups(self, start=None, end=None):
+        rollups = DailyRollups()
+        rollups.load_rows(self.connect().execute("""
+        SELECT day, dimension, value, count FROM daily_rollups WHERE day BETWEEN ? AND ?
+        """, (start or "0000-00-00", end or "9999-99-99")))
+        return rollups.between()
+
+    def rebuild_rollups(self):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            keys = list(table_keys(conn.execute(VISIT_QUERY), []))
+            keys.extend(table_keys([], conn.execute(MEDICATION_QUERY)))
+            rollups = DailyRollups()
+            rollups.rebuild_keys(keys)
+            conn.execute("DELETE FROM daily_rollups")
+            conn.executemany(ROLLUP_UPSERT, list(rollups.rows()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class TimedRepository:
+    """Passes everything through to a repository, timing the PatientRepository operations.
+
+    Each call goes to hospital_storage_seconds by backend and operation, see metrics.py.
+    """
+
+    def __init__(self, wrapped, backend):
+        self.wrapped = wrapped
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if not name.startswith("_") and callable(getattr(PatientRepository, name, None)):
+            attribute = timed("hospital_storage_seconds", backend=self.backend, operation=name)(attribute)
+            # Found without __getattr__ from now on
+            setattr(self, name, attribute)
+        return attribute
+
+
+def open_repository(backend, data_file="data.json", read_only=False):
+    """Return the repository for backend "json", "sqlite", "mysql", "hybrid" (MySQL behind a local
+    queue, see offline_repository.py) or "service" (see patient_service.py), with its operations
+    timed by TimedRepository."""
+    return TimedRepository(make_repository(backend, data_file, read_only), backend)
+
+
+def make_repository(backend, data_file="data.json", read_only=False):
+    """The repository open_repository returns, without the timing."""
+    if backend == "json":
+        return JsonRepository(data_file, read_only=read_only)
+    if backend == "sqlite":
+        return SqliteRepository(os.path.splitext(data_file)[0] + ".db")
+    if backend == "mysql":
+        if MYSQL_DIR not in sys.path:
+            sys.path.insert(0, MYSQL_DIR)
+        from mysql_repository import MySQLRepository
+        return MySQLRepository()
+    if backend == "hybrid":
+        if MYSQL_DIR not in sys.path:
+            sys.path.insert(0, MYSQL_DIR)
+        from offline_repository import OfflineFirstRepository
+        return OfflineFirstRepository(os.path.splitext(data_file)[0] + ".local.json")
+    if backend == "service":
+        from service_client import HttpRepository
+        return HttpRepository()
+    raise ValueError(f"Unknown storage backend: {backend}")
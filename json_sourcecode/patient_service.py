@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from patient_repository import open_repository, today, SEARCH_LIMIT, NAME_LIMIT, UPDATED, STALE
+from journal_store import StaleRecordError
+from metrics import start_export
+
+HOST = "127.0.0.1"  # Local only, the service has no authentication
+PORT = 8765
+
+BATCH_WAIT = 0.005  # Seconds the writer waits for more writes to share a batch with
+BATCH_SIZE = 200  # Most writes in one batch
+MAX_BODY = 1 << 20  # Largest request body accepted, in bytes
+
+
+class ServiceError(Exception):
+    """A request the service turns down, with the HTTP status to answer with."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TodayCache:
+    """Today's visits by patient ID, shared by every desk and pharmacy using the service.
+
+    Writes drop the patient's entry and the next read fills it again. A read that
+    started before a write may finish after it, so fills carry the write count they
+    saw and are ignored if a write came in between. Everything is dropped when the
+    day changes.
+    """
+
+    def __init__(self):
+        self.day = None
+        self.visits = {}
+        self.writes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _roll(self):
+        if self.day != today():
+            self.day = today()
+            self.visits = {}
+            self.writes = {}
+
+    def get(self, patient_id):
+        self._roll()
+        visit = self.visits.get(patient_id)
+        if visit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return visit
+
+    def seen(self, patient_id):
+        """The write count to pass to fill() for a read starting now."""
+        return self.writes.get(patient_id, 0)
+
+    def fill(self, patient_id, visit, seen):
+        self._roll()
+        if visit[0] == self.day and self.writes.get(patient_id, 0) == seen:
+            self.visits[patient_id] = visit
+
+    def invalidate(self, patient_id):
+        self._roll()
+        self.visits.pop(patient_id, None)
+        self.writes[patient_id] = self.writes.get(patient_id, 0) + 1
+
+
+class PatientService:
+    """Patient operations over local HTTP/JSON, for desks that share one backend and one cache.
+
+    The repository is only ever called from one worker thread, as the stores aren't
+    thread safe. Reads of today's patients come from the cache without reaching it.
+    Writes queue up and are handed over in batches, and new patients in a batch are
+    stored with a single create_many (one journal fsync or one transaction). Medicine
+    updates in a row go through one update_medicine_many in the same way.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.cache = TodayCache()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.writes = None
+
+    async def serve(self, host=HOST, port=PORT):
+        self.writes = asyncio.Queue()
+        await self._call(self.repository.initialize)
+        asyncio.get_running_loop().create_task(self._writer())
+        server = await asyncio.start_server(self._handle, host, port)
+        print(f"Patient service on http://{host}:{port}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _write(self, op, *args):
+        """Queue a write for the writer and wait for its result."""
+        done = asyncio.get_running_loop().create_future()
+        await self.writes.put((op, args, done))
+        return await done
+
+    async def _writer(self):
+        while True:
+            batch = [await self.writes.get()]
+            await asyncio.sleep(BATCH_WAIT)
+            while len(batch) < BATCH_SIZE and not self.writes.empty():
+                batch.append(self.writes.get_nowait())
+            results = await self._call(self._run_batch, [(op, args) for op, args, _ in batch])
+            for (op, args, done), (error, result) in zip(batch, results):
+                # A new visit of a known patient changes what they look up as too
+                self.cache.invalidate(result if op == "create" else args[0])
+                if error is not None:
+                    done.set_exception(error)
+                else:
+                    done.set_result(result)
+
+    def _run_batch(self, batch):
+        """Run a batch of writes on the worker thread. Returns (error, result) for each."""
+        results = []
+        # Only writes that came in a row are combined, so the batch still runs in arrival order
+        for op, writes in itertools.groupby(batch, key=lambda write: write[0]):
+            calls = [args for _, args in writes]
+            if op == "create":
+                results.extend(self._run_creates(calls))
+            elif op == "update_medicine":
+                results.extend(self._run_updates(calls))
+            else:
+                for args in calls:
+                    try:
+                        results.append((None, getattr(self.repository, op)(*args)))
+                    except Exception as error:
+                        results.append((error, None))
+        return results
+
+    def _run_creates(self, creates):
+        """Run create calls that came in a row as one create_many."""
+        try:
+            return [(None, patient_id) for patient_id in self.repository.create_many(creates)]
+        except Exception as error:
+            return [(error, None) for _ in creates]
+
+    def _run_updates(self, updates):
+        """Run update_medicine calls that came in a row as one update_medicine_many."""
+        try:
+            statuses = self.repository.update_medicine_many(updates)
+        except Exception as error:
+            return [(error, None) for _ in updates]
+        return [(StaleRecordError(f"Patient {args[0]} was changed by another desk"), None) if status == STALE
+                else (None, status == UPDATED) for args, status in zip(updates, statuses)]
+
+    async def _get(self, patient_id):
+        visit = self.cache.get(patient_id)
+        if visit is None:
+            seen = self.cache.seen(patient_id)
+            visit = await self._call(self.repository.get, patient_id)
+            self.cache.fill(patient_id, visit, seen)
+        return visit
+
+    async def dispatch(self, method, target, body):
+        """Route one request to the repository. Returns the JSON-able answer."""
+        url = urllib.parse.urlsplit(target)
+        parts = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        limit = int(query["limit"]) if "limit" in query else None
+
+        if method == "GET" and parts == ["health"]:
+            return {"status": "ok", "cached": len(self.cache.visits),
+                    "hits": self.cache.hits, "misses": self.cache.misses}
+        if parts[0] == "patients":
+            if method == "POST" and len(parts) == 1:
+                patient_id = await self._write("create", body["fields"], body.get("patient_id"))
+                return {"patient_id": patient_id}
+            if method == "GET" and len(parts) == 2:
+                visit_date, record = await self._get(parts[1])
+                return {"visit_date": visit_date, "record": record}
+            if method == "POST" and len(parts) == 3 and parts[2] == "medicine":
+                try:
+                    updated = await self._write("update_medicine", parts[1], body["issued_medicine"],
+                                                body["additional_prescription"], body.get("clear_old", False),
+                                                body.get("expected_version"))
+                except StaleRecordError as error:
+                    raise ServiceError(HTTPStatus.CONFLICT, str(error))
+                return {"updated": updated}
+            if method == "POST" and len(parts) == 3 and parts[2] == "dispense":
+                return {"dispensed": await self._write("dispense", parts[1])}
+        if method == "GET" and parts[0] == "days" and len(parts) == 2:
+            return {"records": await self._call(self.repository.list_day, parts[1])}
+        if method == "GET" and parts == ["search"]:
+            matches = await self._call(self.repository.search, query.get("q", ""), query.get("date"),
+                                       limit or SEARCH_LIMIT)
+            return {"matches": matches}
+        if method == "GET" and parts == ["names"]:
+            return {"patients": await self._call(self.repository.find_by_name, query.get("q", ""),
+                                                 limit or NAME_LIMIT)}
+        if method == "GET" and parts == ["pending"]:
+            mark, visits = await self._call(self.repository.pending_prescriptions, query.get("since"))
+            return {"mark": mark, "visits": visits}
+        if method == "GET" and parts == ["rollups"]:
+            return {"days": await self._call(self.repository.daily_rollups, query.get("from"), query.get("to"))}
+        if method == "POST" and parts == ["rollups", "rebuild"]:
+            await self._call(self.repository.rebuild_rollups)
+            return {}
+        raise ServiceError(HTTPStatus.NOT_FOUND, f"No such operation: {method} {url.path}")
+
+    async def _handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+
+                try:
+                    if length > MAX_BODY:
+                        raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+                    body = json.loads(await reader.readexactly(length)) if length else {}
+                    status, answer = HTTPStatus.OK, await self.dispatch(method, target, body)
+                except ServiceError as error:
+                    status, answer = error.status, {"error": str(error)}
+                except (KeyError, ValueError) as error:
+                    status, answer = HTTPStatus.BAD_REQUEST, {"error": f"Bad request: {error}"}
+                except Exception as error:
+                    status, answer = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(error)}
+
+                payload = json.dumps(answer).encode()
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+                             .encode() + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve patient operations over local HTTP/JSON. "
+                    "Start the desks with HOSPITAL_BACKEND=service to use it.")
+    parser.add_argument("--backend", choices=["json", "sqlite", "mysql"],
+                        default=os.environ.get("HOSPITAL_SERVICE_BACKEND", "json"),
+                        help="where the service stores patients")
+    parser.add_argument("--data-file", default="data.json", help="JSON backend data file")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
+    start_export("patient-service")
+    service = PatientService(open_repository(args.backend, args.data_file))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import json
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+
+# Every pharmacy on this machine listens on a socket in here, see PrescriptionFeed
+FEED_DIR = os.environ.get("HOSPITAL_FEED_DIR", os.path.join(tempfile.gettempdir(), "hospital-prescriptions"))
+
+POLL_MS = 50  # How often the Tk thread picks up pushed prescriptions
+RESYNC_MS = 5000  # How often the pending list is caught up from storage, for anything the push missed
+MAX_MESSAGE = 4096
+
+
+def publish(patient_id, event):
+    """Tell every pharmacy listening on this machine that patient_id's prescription changed.
+
+    event is "new", "update" or "dispense". Best effort and never blocks or raises:
+    a pharmacy that misses it catches up on its next resync.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    try:
+        names = [name for name in os.listdir(FEED_DIR) if name.endswith(".sock")]
+    except OSError:
+        return
+    message = json.dumps({"patient_id": patient_id, "event": event}).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(FEED_DIR, name)
+            try:
+                sock.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a pharmacy that didn't shut down cleanly
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except OSError:
+                # Its queue is full, it will resync
+                pass
+
+
+def listen(on_message):
+    """Call on_message(dict) from a background thread for everything published. Returns the socket path.
+
+    Returns None where Unix sockets aren't available.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    path = os.path.join(FEED_DIR, f"{os.getpid()}.sock")
+    try:
+        os.makedirs(FEED_DIR, exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+    except OSError:
+        return None
+
+    def receive():
+        while True:
+            # One bad datagram, or a failed recv, mustn't end the listener for the rest of the day
+            try:
+                on_message(json.loads(sock.recv(MAX_MESSAGE)))
+            except (ValueError, KeyError, TypeError, OSError) as error:
+                print(f"Prescription feed message dropped: {error!r}", file=sys.stderr)
+
+    threading.Thread(target=receive, daemon=True).start()
+    return path
+
+
+class PrescriptionFeed:
+    """Tells the pharmacy about new and changed prescriptions as the doctor desks save them.
+
+    The desks publish() each change over a Unix socket and the patient is then fetched
+    on the task runner. Every RESYNC_MS the feed also asks the repository for today's
+    visits given medicine since the last mark, which catches whatever the push missed
+    and is all there is on other machines or without Unix sockets. on_prescription
+    (visit_date, record) is called on the Tk thread, possibly more than once per change.
+    """
+
+    def __init__(self, repository, root, runner, on_prescription):
+        self.repository = repository
+        self.root = root
+        self.runner = runner
+        self.on_prescription = on_prescription
+        self.pushed = queue.SimpleQueue()
+        self.waiting = set()
+        self.mark = None
+        self.last_error = None
+        self.path = listen(lambda message: self.pushed.put(message["patient_id"]))
+        self._resync()
+        self.root.after(POLL_MS, self._poll)
+
+    def _poll(self):
+        while not self.pushed.empty():
+            self.waiting.add(self.pushed.get())
+        for patient_id in list(self.waiting):
+            # If this patient is still being fetched they stay waiting and we retry on the next poll
+            if self.runner.submit(("pushed", patient_id), self.repository.get, patient_id,
+                                  on_done=lambda visit: self.on_prescription(*visit), on_error=self._missed):
+                self.waiting.discard(patient_id)
+        self.root.after(POLL_MS, self._poll)
+
+    def _resync(self):
+        self.runner.submit("resync", self.repository.pending_prescriptions, self.mark,
+                           on_done=self._resynced, on_error=self._missed)
+        self.root.after(RESYNC_MS, self._resync)
+
+    def _missed(self, error):
+        # No dialog every few seconds while storage is down, the next resync picks up from the same mark.
+        # Printed once until a resync works again, so a lasting failure shows without flooding stderr.
+        if repr(error) != self.last_error:
+            self.last_error = repr(error)
+            print(f"Prescription feed lookup failed: {error!r}", file=sys.stderr)
+
+    def _resynced(self, pending):
+        self.last_error = None
+        self.mark, visits = pending
+        for visit_date, record in visits:
+            self.on_prescription(visit_date, record)
+
+    def close(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,88 @@
+import json
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+from http import HTTPStatus
+from patient_repository import PatientRepository, SEARCH_LIMIT, NAME_LIMIT
+from journal_store import StaleRecordError
+
+# Where patient_service.py listens. It only ever runs on this machine or the local network.
+SERVICE_URL = os.environ.get("HOSPITAL_SERVICE_URL", "http://127.0.0.1:8765")
+
+TIMEOUT = 30  # Seconds to wait for the service before giving up on a request
+
+
+class ServiceUnavailableError(Exception):
+    """The patient service could not be reached or turned the request down."""
+
+
+class HttpRepository(PatientRepository):
+    """A thin client of patient_service.py, so every desk shares its cache and batched writes.
+
+    Each call is one HTTP request. The service owns the real backend, so there is
+    nothing to initialize here.
+    """
+
+    def __init__(self, url=SERVICE_URL):
+        self.url = url.rstrip("/")
+
+    def _call(self, method, path, body=None, **query):
+        query = {key: value for key, value in query.items() if value is not None}
+        url = self.url + "/" + "/".join(urllib.parse.quote(part, safe="") for part in path)
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(url, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as error:
+            try:
+                message = json.load(error)["error"]
+            except (ValueError, KeyError):
+                message = str(error)
+            if error.code == HTTPStatus.CONFLICT:
+                raise StaleRecordError(message) from error
+            raise ServiceUnavailableError(f"Patient service: {message}") from error
+        except (urllib.error.URLError, OSError) as error:
+            raise ServiceUnavailableError(f"Patient service at {self.url} is not reachable: {error}") from error
+
+    def create(self, fields, patient_id=None):
+        return self._call("POST", ["patients"], {"fields": fields, "patient_id": patient_id})["patient_id"]
+
+    def get(self, patient_id):
+        answer = self._call("GET", ["patients", patient_id])
+        return answer["visit_date"], answer["record"]
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        return self._call("POST", ["patients", patient_id, "medicine"], {
+            "issued_medicine": issued_medicine,
+            "additional_prescription": additional_prescription,
+            "clear_old": clear_old,
+            "expected_version": expected_version
+        })["updated"]
+
+    def dispense(self, patient_id):
+        return self._call("POST", ["patients", patient_id, "dispense"], {})["dispensed"]
+
+    def list_day(self, date):
+        return self._call("GET", ["days", date])["records"]
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        return [tuple(match) for match in self._call("GET", ["search"], q=query, date=date, limit=limit)["matches"]]
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        return [tuple(match) for match in self._call("GET", ["names"], q=query, limit=limit)["patients"]]
+
+    def pending_prescriptions(self, since=None):
+        answer = self._call("GET", ["pending"], since=since)
+        return answer["mark"], [tuple(visit) for visit in answer["visits"]]
+
+    def daily_rollups(self, start=None, end=None):
+        return self._call("GET", ["rollups"], **{"from": start, "to": end})["days"]
+
+    def rebuild_rollups(self):
+        self._call("POST", ["rollups", "rebuild"], {})
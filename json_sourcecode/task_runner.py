@@ -0,0 +1,66 @@
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import messagebox
+from metrics import registry
+
+POLL_MS = 20  # How often the Tk thread picks up finished tasks
+
+
+class TaskRunner:
+    """Runs storage and database calls off the Tk thread and posts results back to it.
+
+    Tk widgets may only be touched from the thread running mainloop, so workers never
+    call back directly. They put finished tasks on a queue that the Tk thread drains
+    every POLL_MS via after(). Tasks submitted under a key that is still running are
+    dropped, so a double click fires only one write. Each task's wait from submit to its
+    result being handled, and how long on_done held up the Tk thread, go to metrics.py
+    under the first part of its key.
+
+    A single worker keeps storage calls in order and means the stores themselves need
+    no locking against each other.
+    """
+
+    def __init__(self, root, max_workers=1):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.finished = queue.Queue()
+        self.pending = set()
+        self.root.after(POLL_MS, self._poll)
+
+    def submit(self, key, func, *args, on_done=None, on_error=None):
+        """Run func(*args) on a worker. on_done(result) or on_error(exc) then run on the Tk thread.
+
+        Returns False if a task with the same key is already running.
+        """
+        if key in self.pending:
+            return False
+        self.pending.add(key)
+        submitted = time.perf_counter()
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda future: self.finished.put((key, submitted, future, on_done, on_error)))
+        return True
+
+    def _poll(self):
+        while True:
+            try:
+                key, submitted, future, on_done, on_error = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(key)
+            task = key[0] if isinstance(key, tuple) else key
+            with registry.timer("hospital_ui_callback_seconds", task=task):
+                error = future.exception()
+                if error is not None:
+                    (on_error or show_error)(error)
+                elif on_done is not None:
+                    on_done(future.result())
+            registry.observe("hospital_ui_task_seconds", time.perf_counter() - submitted, task=task)
+        self.root.after(POLL_MS, self._poll)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def show_error(error):
+    messagebox.showerror("Storage Error", str(error))
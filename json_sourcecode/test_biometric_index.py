@@ -0,0 +1,17 @@
+from biometric_index import BiometricIndex, hash_fingerprint
+
+
+def test_re_enrollment_at_another_desk_wins(tmp_path):
+    path = str(tmp_path / "data.json.biometrics")
+    desk_a, desk_b = BiometricIndex(path), BiometricIndex(path)
+    fingerprint = hash_fingerprint("left thumb")
+    desk_a.enroll(fingerprint, "000001")
+    assert desk_b.lookup(fingerprint) == "000001"
+
+    desk_a.enroll(fingerprint, "000002")
+    assert desk_b.lookup(fingerprint) == "000002"
+    assert BiometricIndex(path).lookup(fingerprint) == "000002"
+
+
+def test_unknown_fingerprint_is_none(tmp_path):
+    assert BiometricIndex(str(tmp_path / "data.json.biometrics")).lookup(hash_fingerprint("nobody")) is None
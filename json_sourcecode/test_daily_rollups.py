@@ -0,0 +1,86 @@
+import pytest
+import daily_rollups
+from daily_rollups import TOTAL, DailyRollups, totals, visit_keys
+from medications import new_entry
+
+
+def visit(patient_id, blood_group, gender, issued_medicine="", medicines=(), dispensed_at=None):
+    medications = [dict(new_entry(medicine), dispensed_at=dispensed_at) for medicine in medicines]
+    return {"patient_id": patient_id, "blood_group": blood_group, "gender": gender,
+            "issued_medicine": issued_medicine, "medications": medications}
+
+
+DATA = {
+    "2024-01-01": [visit("1", "a+", "female", "Paracetamol  500mg\nrest", ["paracetamol 500mg"],
+                         "2024-01-02T09:30:00"),
+                   visit("2", "O-", "male")],
+    "2024-01-02": [visit("3", "A+", "Female", "", ["ibuprofen"])],
+}
+
+
+def test_visit_keys_count_dispensing_on_the_day_it_happened():
+    keys = list(visit_keys("2024-01-01", DATA["2024-01-01"][0]))
+    assert keys == [
+        ("2024-01-01", "patients", TOTAL),
+        ("2024-01-01", "blood_group", "A+"),
+        ("2024-01-01", "gender", "Female"),
+        ("2024-01-01", "medicine", "paracetamol 500mg"),
+        ("2024-01-01", "medicine", "rest"),
+        ("2024-01-01", "medicine", "paracetamol 500mg"),
+        ("2024-01-02", "dispensed", TOTAL),
+    ]
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+def test_rebuild_counts_every_day(monkeypatch, with_numpy):
+    if with_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(daily_rollups, "numpy", None)
+    rollups = DailyRollups()
+    rollups.rebuild(DATA)
+
+    assert rollups.between() == {
+        "2024-01-01": {"patients": {TOTAL: 2}, "blood_group": {"A+": 1, "O-": 1},
+                       "gender": {"Female": 1, "Male": 1},
+                       "medicine": {"paracetamol 500mg": 2, "rest": 1}},
+        "2024-01-02": {"patients": {TOTAL: 1}, "blood_group": {"A+": 1}, "gender": {"Female": 1},
+                       "medicine": {"ibuprofen": 1}, "dispensed": {TOTAL: 1}},
+    }
+
+
+def test_adding_matches_rebuilding_and_taking_away_drops_zero_counts():
+    rollups = DailyRollups()
+    for day, records in DATA.items():
+        for record in records:
+            rollups.add(visit_keys(day, record))
+    rebuilt = DailyRollups()
+    rebuilt.rebuild(DATA)
+    assert rollups.between() == rebuilt.between()
+
+    rollups.add(visit_keys("2024-01-01", DATA["2024-01-01"][1]), -1)
+    assert "O-" not in rollups.days["2024-01-01"]["blood_group"]
+    assert rollups.days["2024-01-01"]["patients"] == {TOTAL: 1}
+
+
+def test_between_and_totals():
+    rollups = DailyRollups()
+    rollups.rebuild(DATA)
+    assert list(rollups.between("2024-01-02")) == ["2024-01-02"]
+    assert list(rollups.between(end="2024-01-01")) == ["2024-01-01"]
+    assert totals(rollups.between(), "blood_group") == {"A+": 2, "O-": 1}
+    assert totals(rollups.between("2024-01-02", "2024-01-02"), "medicine") == {"ibuprofen": 1}
+
+
+def test_saved_counts_load_only_for_the_same_stamp(tmp_path):
+    path = str(tmp_path / "rollups.json")
+    rollups = DailyRollups()
+    rollups.rebuild(DATA)
+    rollups.save(path, (3, 120))
+
+    loaded = DailyRollups()
+    assert not loaded.load(path, (3, 121))
+    assert not loaded.load(path, None)
+    assert loaded.load(path, (3, 120))
+    assert loaded.between() == rollups.between()
+    assert not DailyRollups().load(str(tmp_path / "missing.json"), (3, 120))
@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import os
+import pytest
+from journal_store import JournalStore, StaleRecordError
+from medications import new_entry
+
+DAY = "2024-01-02"
+WRITES = 25  # Writes each process makes in the concurrency tests
+
+
+def patient(patient_id):
+    return {"patient_id": patient_id, "name": f"Patient {patient_id}", "blood_group": "A+", "age": "40",
+            "gender": "Female", "issued_medicine": "", "additional_prescription": "", "version": 0}
+
+
+def new_store(data_file, compact_every=1000):
+    store = JournalStore(data_file, compact_every=compact_every)
+    store.load()
+    return store
+
+
+def add_patients(data_file, prefix, compact_every):
+    store = new_store(data_file, compact_every)
+    for number in range(WRITES):
+        store.add_record(DAY, patient(f"{prefix}{number}"))
+
+
+def add_medications(data_file, compact_every):
+    store = new_store(data_file, compact_every)
+    for _ in range(WRITES):
+        store.add_medication(DAY, "shared", new_entry("paracetamol"))
+
+
+def run_together(target, args_list):
+    # spawn, so each store really is a separate process with its own lock file handle
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+
+@pytest.mark.parametrize("compact_every", [1000, 7])
+def test_processes_adding_patients_lose_nothing(tmp_path, compact_every):
+    data_file = str(tmp_path / "data.json")
+    run_together(add_patients, [(data_file, "a", compact_every), (data_file, "b", compact_every)])
+
+    store = new_store(data_file)
+    assert sorted(record["patient_id"] for record in store.day(DAY)) == sorted(
+        f"{prefix}{number}" for prefix in "ab" for number in range(WRITES))
+
+
+@pytest.mark.parametrize("compact_every", [1000, 7])
+def test_processes_medicating_one_patient_lose_nothing(tmp_path, compact_every):
+    data_file = str(tmp_path / "data.json")
+    new_store(data_file).add_record(DAY, patient("shared"))
+    run_together(add_medications, [(data_file, compact_every), (data_file, compact_every)])
+
+    record = new_store(data_file).find(DAY, "shared")
+    assert len(record["medications"]) == 2 * WRITES
+    assert len({medication["id"] for medication in record["medications"]}) == 2 * WRITES
+    assert record["version"] == 2 * WRITES
+
+
+def test_stores_in_one_process_see_each_others_writes(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    first, second = new_store(data_file), new_store(data_file)
+    first.add_record(DAY, patient("1"))
+    second.add_record(DAY, patient("2"))
+    first.update_record(DAY, "2", {"additional_prescription": "rest"})
+
+    second.refresh()
+    assert [record["patient_id"] for record in second.day(DAY)] == ["1", "2"]
+    assert second.find(DAY, "2")["additional_prescription"] == "rest"
+
+
+def test_torn_last_line_is_dropped_on_load(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    store = new_store(data_file)
+    store.add_record(DAY, patient("1"))
+    store.add_medication(DAY, "1", new_entry("ibuprofen"))
+    complete_size = os.path.getsize(store.journal_file)
+    # A crash halfway through the next write
+    line = json.dumps({"op": "insert", "date": DAY, "record": patient("2"), "generation": store.generation})
+    with open(store.journal_file, "ab") as file:
+        file.write(line[:len(line) // 2].encode())
+
+    store = new_store(data_file)
+    assert [record["patient_id"] for record in store.day(DAY)] == ["1"]
+    assert [medication["medicine"] for medication in store.find(DAY, "1")["medications"]] == ["ibuprofen"]
+    assert os.path.getsize(store.journal_file) == complete_size
+
+    # The next write starts on a line of its own and survives a reload
+    store.add_record(DAY, patient("3"))
+    assert [record["patient_id"] for record in new_store(data_file).day(DAY)] == ["1", "3"]
+
+
+def test_torn_last_line_is_left_for_a_writer_still_on_it(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    reader = new_store(data_file)
+    new_store(data_file).add_record(DAY, patient("1"))
+    with open(reader.journal_file, "ab") as file:
+        file.write(b'{"op": "insert"')
+
+    reader.refresh()
+    assert [record["patient_id"] for record in reader.day(DAY)] == ["1"]
+
+
+def test_same_day_duplicates_survive_replay(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    store = new_store(data_file)
+    store.add_record(DAY, patient("1"))
+    store.add_record(DAY, patient("1"))
+    assert len(new_store(data_file).day(DAY)) == 2
+
+
+def test_stale_expected_version_is_rejected(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    store = new_store(data_file)
+    store.add_record(DAY, patient("1"))
+    other_desk = new_store(data_file)
+    version = store.find(DAY, "1")["version"]
+    other_desk.update_record(DAY, "1", {"additional_prescription": "rest"}, expected_version=version)
+    journal_size = os.path.getsize(store.journal_file)
+
+    with pytest.raises(StaleRecordError):
+        store.update_record(DAY, "1", {"additional_prescription": "fluids"}, expected_version=version)
+    with pytest.raises(StaleRecordError):
+        store.add_medication(DAY, "1", new_entry("ibuprofen"), expected_version=version)
+
+    assert os.path.getsize(store.journal_file) == journal_size
+    record = new_store(data_file).find(DAY, "1")
+    assert record["additional_prescription"] == "rest"
+    assert record["version"] == version + 1
+    assert "medications" not in record
+
+
+def test_current_expected_version_is_accepted(tmp_path):
+    store = new_store(str(tmp_path / "data.json"))
+    store.add_record(DAY, patient("1"))
+    store.add_medication(DAY, "1", new_entry("ibuprofen"), {"additional_prescription": "rest"}, expected_version=0)
+    store.update_record(DAY, "1", {"additional_prescription": "fluids"}, expected_version=1)
+    assert store.find(DAY, "1")["version"] == 2
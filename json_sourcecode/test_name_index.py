@@ -0,0 +1,54 @@
+from name_index import NameIndex, edit_distance
+
+
+def visit(patient_id, name):
+    return {"patient_id": patient_id, "name": name}
+
+
+def new_index():
+    index = NameIndex()
+    index.rebuild({
+        "2024-01-01": [visit("1", "John Smith"), visit("2", "Johnson Lee")],
+        "2024-01-02": [visit("3", "Jon Doe"), visit("4", "Asha Rao")],
+    })
+    return index
+
+
+def ids(found):
+    return [patient_id for patient_id, _, _ in found]
+
+
+def test_prefix_matches_come_first_in_name_order():
+    found = new_index().search("john")
+    assert found[:2] == [("1", "John Smith", "2024-01-01"), ("2", "Johnson Lee", "2024-01-01")]
+    # "jon" is one edit from "john", so it follows as a typo match
+    assert ids(found) == ["1", "2", "3"]
+    assert ids(new_index().search("jo", limit=2)) == ["1", "2"]
+
+
+def test_every_query_word_has_to_match():
+    index = new_index()
+    assert ids(index.search("smi jo")) == ["1"]
+    assert index.search("smith rao") == []
+
+
+def test_typos_are_matched_by_trigrams_and_edits():
+    index = new_index()
+    assert ids(index.search("smiht")) == ["1"]
+    assert ids(index.search("jhon")) == ["1", "3"]
+    assert index.search("zzz") == []
+
+
+def test_edit_distance_counts_a_swap_as_one_edit():
+    assert edit_distance("jhon", "john") == 1
+    assert edit_distance("kitten", "sitting") == 3
+    assert edit_distance("", "rao") == 3
+
+
+def test_latest_visit_decides_the_name():
+    index = new_index()
+    index.add("4", "Asha Menon", "2024-02-01")
+    index.add("4", "Asha Rao", "2024-01-15")
+
+    assert index.search("rao") == []
+    assert index.search("menon") == [("4", "Asha Menon", "2024-02-01")]
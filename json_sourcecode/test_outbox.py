@@ -0,0 +1,71 @@
+import multiprocessing
+from outbox import Outbox
+
+PUTS = 25  # Writes each process queues in the concurrency test
+
+
+def put_writes(path, desk):
+    outbox = Outbox(path)
+    for number in range(PUTS):
+        outbox.put({"op": "create", "desk": desk, "number": number})
+
+
+def test_processes_putting_lose_nothing(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    # spawn, so each outbox really is a separate process with its own lock file handle
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=put_writes, args=(path, desk)) for desk in ("a", "b")]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    writes = [write for _, write in Outbox(path).pending()]
+    assert sorted((write["desk"], write["number"]) for write in writes) == sorted(
+        (desk, number) for desk in "ab" for number in range(PUTS))
+    assert len({write["key"] for write in writes}) == 2 * PUTS
+
+
+def test_torn_last_line_is_skipped_and_put_starts_a_new_line(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    outbox.put({"op": "create", "number": 1})
+    # A crash halfway through the next put()
+    with open(path, "ab") as file:
+        file.write(b'{"op": "upd')
+
+    assert [write["number"] for _, write in outbox.pending()] == [1]
+    outbox.put({"op": "create", "number": 2})
+    assert [write["number"] for _, write in outbox.pending()] == [1, 2]
+
+
+def test_acked_writes_are_not_sent_again(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    for number in range(3):
+        outbox.put({"op": "create", "number": number})
+
+    offset, _ = outbox.pending(limit=2)[-1]
+    outbox.ack(offset)
+    assert [write["number"] for _, write in outbox.pending()] == [2]
+
+    offset, _ = outbox.pending()[-1]
+    outbox.ack(offset)
+    assert outbox.pending() == []
+    outbox.put({"op": "create", "number": 3})
+    assert [write["number"] for _, write in outbox.pending()] == [3]
+
+
+def test_pending_follows_another_process_emptying_the_queue(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    desk, sender = Outbox(path), Outbox(path)
+    for number in range(3):
+        desk.put({"op": "create", "number": number})
+    assert len(desk.pending()) == 3
+
+    sender.ack(sender.pending()[-1][0])
+    # Longer than what desk read before, so only the reset count tells it the file started over
+    for number in range(3, 7):
+        sender.put({"op": "create", "number": number})
+    assert [write["number"] for _, write in desk.pending()] == [3, 4, 5, 6]
@@ -0,0 +1,96 @@
+import pytest
+from patient_repository import open_repository
+from patient_cache import PatientCache
+from medications import undispensed_positions
+
+
+def fields(name, issued_medicine=""):
+    return {"name": name, "blood_group": "A+", "age": "40", "gender": "Female",
+            "issued_medicine": issued_medicine, "additional_prescription": ""}
+
+
+def two_desks(tmp_path, backend):
+    """Two repositories on one store, as two desks on their own machines would have."""
+    desks = [open_repository(backend, str(tmp_path / "data.json")) for _ in range(2)]
+    for desk in desks:
+        desk.initialize()
+    return desks
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_dispense_at_another_desk_is_seen(tmp_path, backend):
+    desk_a, desk_b = two_desks(tmp_path, backend)
+    patient_id = desk_a.create(fields("Asha", "paracetamol"))
+    cache = PatientCache(desk_a)
+    assert undispensed_positions(cache.fetch(patient_id)[1]) == [0]
+
+    assert desk_b.dispense(patient_id) == 1
+    assert undispensed_positions(cache.fetch(patient_id)[1]) == []
+    assert cache.get_stats()["stale"] == 1
+
+
+def test_unchanged_visit_is_a_hit(tmp_path):
+    desk, _ = two_desks(tmp_path, "json")
+    patient_id = desk.create(fields("Asha", "paracetamol"))
+    cache = PatientCache(desk)
+    first = cache.fetch(patient_id)
+    assert cache.fetch(patient_id) is first
+    stats = cache.get_stats()
+    assert (stats["misses"], stats["hits"], stats["stale"], stats["size"]) == (1, 1, 0, 1)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_change_at_another_desk_is_stale(tmp_path, backend):
+    desk_a, desk_b = two_desks(tmp_path, backend)
+    patient_id = desk_a.create(fields("Asha", "paracetamol"))
+    cache = PatientCache(desk_a)
+    cache.fetch(patient_id)
+
+    # Only additional_prescription, which no notification carries
+    desk_b.update_medicine(patient_id, "", "Bed rest")
+    assert cache.fetch(patient_id)[1]["additional_prescription"] == "Bed rest"
+    assert cache.get_stats()["stale"] == 1
+
+
+def test_invalidate_drops_the_patient_and_loads_started_before(tmp_path):
+    desk, _ = two_desks(tmp_path, "json")
+    patient_id = desk.create(fields("Asha"))
+    cache = PatientCache(desk)
+    cache.fetch(patient_id)
+    seen = cache._seen(patient_id)
+    visit = desk.get(patient_id)
+
+    cache.invalidate(patient_id)
+    assert cache.get(patient_id) is None
+    # A load that read before the write finishes after it
+    cache.put(patient_id, visit, seen)
+    assert cache.get(patient_id) is None
+    cache.put(patient_id, visit, cache._seen(patient_id))
+    assert cache.get(patient_id) == visit
+    assert cache.get_stats()["invalidated"] == 1
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    desk, _ = two_desks(tmp_path, "json")
+    patient_ids = [desk.create(fields(name)) for name in ("Asha", "Ravi", "Meera")]
+    cache = PatientCache(desk, size=2)
+    cache.fetch(patient_ids[0])
+    cache.fetch(patient_ids[1])
+    cache.fetch(patient_ids[0])
+    cache.fetch(patient_ids[2])
+
+    assert cache.get(patient_ids[1]) is None
+    assert cache.get(patient_ids[0]) is not None
+    assert cache.get_stats()["evicted"] == 1
+
+
+def test_expired_and_unknown_patients_are_not_served(tmp_path):
+    desk, _ = two_desks(tmp_path, "json")
+    patient_id = desk.create(fields("Asha"))
+    cache = PatientCache(desk, ttl=0)
+    cache.fetch(patient_id)
+    assert cache.get(patient_id) is None
+    assert cache.get_stats()["expired"] == 1
+
+    assert cache.fetch("999999") == (None, None)
+    assert cache.get("999999") is None
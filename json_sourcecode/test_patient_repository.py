@@ -0,0 +1,25 @@
+from patient_repository import open_repository, today
+
+
+def fields(name, issued_medicine=""):
+    return {"name": name, "blood_group": "A+", "age": "40", "gender": "Female",
+            "issued_medicine": issued_medicine, "additional_prescription": ""}
+
+
+def new_repository(tmp_path, backend="json"):
+    repository = open_repository(backend, str(tmp_path / "data.json"))
+    repository.initialize()
+    return repository
+
+
+def test_pending_prescriptions_reads_records_without_medications(tmp_path):
+    repository = new_repository(tmp_path)
+    # As visits from before medication entries, and bulk_io imports, are stored
+    legacy = dict(fields("Legacy", "aspirin"), patient_id="000900", date="", version=0)
+    repository.store.add_record(today(), legacy)
+    patient_id = repository.create(fields("Current"))
+    repository.update_medicine(patient_id, "ibuprofen", "")
+
+    mark, visits = repository.pending_prescriptions()
+    assert [record["patient_id"] for _, record in visits] == [patient_id]
+    assert repository.pending_prescriptions(mark)[1][0][1]["issued_medicine"] == "ibuprofen"
@@ -0,0 +1,112 @@
+import asyncio
+import socket
+import threading
+import time
+import pytest
+from journal_store import StaleRecordError
+from medications import undispensed_positions
+from patient_repository import open_repository
+from patient_service import PatientService
+from service_client import HttpRepository, ServiceUnavailableError
+
+
+def fields(name, issued_medicine=""):
+    return {"name": name, "blood_group": "A+", "age": "40", "gender": "Female",
+            "issued_medicine": issued_medicine, "additional_prescription": ""}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def client(tmp_path):
+    """A service on a JSON store in tmp_path, running in the background, and a desk talking to it."""
+    port = free_port()
+    service = PatientService(open_repository("json", str(tmp_path / "data.json")))
+    running = {}
+
+    async def serve():
+        running["loop"], running["task"] = asyncio.get_running_loop(), asyncio.current_task()
+        await service.serve("127.0.0.1", port)
+
+    def run():
+        # asyncio.run also cancels the writer task on the way out
+        try:
+            asyncio.run(serve())
+        except asyncio.CancelledError:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    desk = HttpRepository(f"http://127.0.0.1:{port}")
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    yield desk
+
+    running["loop"].call_soon_threadsafe(running["task"].cancel)
+    thread.join(10)
+    service.executor.shutdown()
+
+
+def test_desk_creates_medicates_and_dispenses(client):
+    patient_id = client.create(fields("Asha", "paracetamol"))
+    visit_date, record = client.get(patient_id)
+    assert record["name"] == "Asha"
+    assert undispensed_positions(record) == [0]
+
+    assert client.update_medicine(patient_id, "ibuprofen", "rest", expected_version=client.get_version(patient_id)[1])
+    _, record = client.get(patient_id)
+    assert record["additional_prescription"] == "rest"
+    assert undispensed_positions(record) == [0, 1]
+
+    assert client.dispense(patient_id) == 2
+    _, record = client.get(patient_id)
+    assert undispensed_positions(record) == []
+    assert [patient["patient_id"] for patient in client.list_day(visit_date)] == [patient_id]
+    assert client.find_by_name("ash")[0][0] == patient_id
+
+
+def test_stale_expected_version_is_a_conflict(client):
+    patient_id = client.create(fields("Asha"))
+    version = client.get_version(patient_id)[1]
+    client.update_medicine(patient_id, "ibuprofen", "", expected_version=version)
+
+    with pytest.raises(StaleRecordError):
+        client.update_medicine(patient_id, "aspirin", "", expected_version=version)
+    assert client.get(patient_id)[1]["issued_medicine"] == "ibuprofen"
+
+
+def test_unknown_routes_and_bad_requests_are_turned_down(client):
+    with pytest.raises(ServiceUnavailableError, match="No such operation"):
+        client._call("GET", ["nowhere"])
+    with pytest.raises(ServiceUnavailableError, match="Bad request"):
+        client._call("POST", ["patients"], {})
+
+
+def test_batch_runs_in_arrival_order(tmp_path):
+    repository = open_repository("json", str(tmp_path / "data.json"))
+    repository.initialize()
+    service = PatientService(repository)
+    first = repository.create(fields("Asha", "paracetamol"))
+
+    results = service._run_batch([
+        ("update_medicine", (first, "ibuprofen", "", False, 0)),
+        ("update_medicine", (first, "aspirin", "", False, 0)),
+        ("dispense", (first,)),
+        ("create", (fields("Ravi"), None)),
+        ("create", (fields("Meera"), None)),
+        ("update_medicine", ("999999", "aspirin", "", False, None)),
+    ])
+
+    assert results[0] == (None, True)
+    assert isinstance(results[1][0], StaleRecordError)
+    assert results[2] == (None, 2)
+    created = [result for _, result in results[3:5]]
+    assert [repository.get(patient_id)[1]["name"] for patient_id in created] == ["Ravi", "Meera"]
+    assert results[5] == (None, False)
@@ -0,0 +1,50 @@
+from medications import new_entry
+from text_index import TextIndex, tokenize
+
+
+def record(patient_id, issued_medicine="", additional_prescription="", medicines=()):
+    return {"patient_id": patient_id, "issued_medicine": issued_medicine,
+            "additional_prescription": additional_prescription,
+            "medications": [new_entry(medicine) for medicine in medicines]}
+
+
+def new_index():
+    index = TextIndex()
+    index.rebuild({
+        "2024-01-01": [record("1", "Amoxicillin 500mg", "after food"), record("2", "paracetamol")],
+        "2024-01-02": [record("3", "amoxicillin 250mg"), record("4", "", "rest", ["Paracetamol"])],
+    })
+    return index
+
+
+def test_tokenize_lowercases_words_and_numbers():
+    assert tokenize("Amoxicillin 500mg, after-food") == ["amoxicillin", "500mg", "after", "food"]
+
+
+def test_every_query_word_has_to_match():
+    index = new_index()
+    assert index.search("amoxicillin 500mg") == [("2024-01-01", "1")]
+    assert index.search("amoxicillin food") == [("2024-01-01", "1")]
+    assert index.search("amoxicillin ibuprofen") == []
+    assert index.search("") == []
+
+
+def test_newest_day_first_and_date_and_limit_filters():
+    index = new_index()
+    assert index.search("amoxicillin") == [("2024-01-02", "3"), ("2024-01-01", "1")]
+    assert index.search("amoxicillin", date="2024-01-01") == [("2024-01-01", "1")]
+    assert index.search("paracetamol", limit=1) == [("2024-01-02", "4")]
+
+
+def test_medication_entries_are_searched():
+    assert new_index().search("PARACETAMOL rest") == [("2024-01-02", "4")]
+
+
+def test_reindexing_drops_words_no_longer_in_the_record():
+    index = new_index()
+    index.index("2024-01-01", record("1", "ibuprofen"))
+
+    assert index.search("ibuprofen") == [("2024-01-01", "1")]
+    assert index.search("500mg") == []
+    assert "500mg" not in index.postings
+    assert index.search("amoxicillin") == [("2024-01-02", "3")]
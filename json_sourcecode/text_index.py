@@ -0,0 +1,81 @@
+import re
+
+# Record fields the pharmacy searches
+SEARCH_FIELDS = ["issued_medicine", "additional_prescription"]
+
+TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Lowercase words and numbers, so "Amoxicillin 500mg" is ["amoxicillin", "500mg"]."""
+    return TOKEN.findall(text.lower())
+
+
+class TextIndex:
+    """Inverted index over the medicine and prescription text of every record, medication history included.
+
+    postings maps token -> {date: {patient_id, ...}}, so a query limited to one day
+    only touches that day's sets. tokens remembers what each (date, patient_id) was
+    indexed under, so a medicine update swaps out just the words that changed.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.tokens = {}
+
+    def rebuild(self, data):
+        """Index every day of the given data from scratch."""
+        self.postings = {}
+        self.tokens = {}
+        for date, records in data.items():
+            for record in records:
+                self.index(date, record)
+
+    def index(self, date, record):
+        """Add or re-index one record."""
+        key = (date, record["patient_id"])
+        new = set()
+        for field in SEARCH_FIELDS:
+            new.update(tokenize(record.get(field) or ""))
+        for medication in record.get("medications", []):
+            new.update(tokenize(medication["medicine"]))
+        old = self.tokens.get(key, set())
+
+        for token in old - new:
+            days = self.postings[token]
+            days[date].discard(key[1])
+            if not days[date]:
+                del days[date]
+            if not days:
+                del self.postings[token]
+        for token in new - old:
+            self.postings.setdefault(token, {}).setdefault(date, set()).add(key[1])
+        self.tokens[key] = new
+
+    def search(self, query, date=None, limit=None):
+        """Return [(date, patient_id), ...] for records containing every word of query, newest first.
+
+        Stops after limit matches, so a common word doesn't walk the whole year.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        postings = [self.postings.get(term) for term in terms]
+        if not all(postings):
+            return []
+        # Intersect starting from the rarest word
+        postings.sort(key=lambda days: sum(len(ids) for ids in days.values()))
+
+        rarest = postings[0]
+        dates = [date] if date is not None else sorted(rarest, reverse=True)
+        matches = []
+        for day in dates:
+            ids = set(rarest.get(day, ()))
+            for days in postings[1:]:
+                if not ids:
+                    break
+                ids &= days.get(day, set())
+            matches.extend((day, patient_id) for patient_id in sorted(ids))
+            if limit is not None and len(matches) >= limit:
+                return matches[:limit]
+        return matches
@@ -1,50 +1,30 @@
 import tkinter as tk
 from tkinter import messagebox
-import mysql.connector
-import random
 import pyperclip
 import datetime
 import os
+import sys
 
+# Shared helpers (task_runner.py, ...) live next to the JSON apps
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+from task_runner import TaskRunner, show_error
+from journal_store import StaleRecordError
+from patient_repository import open_repository
+from metrics import start_export
+from prescription_feed import publish
 
-def connect_db():
-    return mysql.connector.connect(
-        host="localhost",
-        port=4444,  # Your specified port
-        user="root",
-        password="0303",  # Your MySQL password
-        database="hospital_db",
-        auth_plugin="mysql_native_password"
-    )
+# All SQL lives behind the repository, see mysql_repository.py. HOSPITAL_BACKEND=hybrid keeps
+# working while the server is down (offline_repository.py), and HOSPITAL_BACKEND=service goes
+# through a shared patient_service.py instead.
+BACKEND = os.environ.get("HOSPITAL_BACKEND", "mysql")
+repository = open_repository(BACKEND)
+
+STATUS_MS = 2000  # How often the sync status line is redrawn in hybrid mode
 
 def create_patient_table():
-    conn = connect_db()
-    cursor = conn.cursor()
-    today = datetime.date.today()
-    table_name = f"prescriptions_{today}".replace('-', '_')
-    cursor.execute(f"""
-    CREATE TABLE IF NOT EXISTS {table_name} (
-        prescription_id INT AUTO_INCREMENT PRIMARY KEY,
-        patient_id VARCHAR(3),
-        name VARCHAR(255),
-        blood_group VARCHAR(10),
-        age INT,
-        gender VARCHAR(10),
-        issued_medicine TEXT,
-        additional_prescription TEXT,
-        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_login TIMESTAMP NULL
-    )
-    """)
-    conn.commit()
-    cursor.close()
-    conn.close()
-
-def get_random_patient_id():
-    return str(random.randint(100, 999)).zfill(3)
+    repository.initialize()
 
 def submit_new_patient():
-    patient_id = get_random_patient_id()
     name = name_entry.get()
     blood_group = blood_group_entry.get()
     age = age_entry.get()
@@ -56,20 +36,19 @@ def submit_new_patient():
         messagebox.showwarning("Input Error", "Please fill all fields.")
         return
 
-    conn = connect_db()
-    cursor = conn.cursor()
-    today = datetime.date.today()
-    table_name = f"prescriptions_{today}".replace('-', '_')
-
-    cursor.execute(f"""
-    INSERT INTO {table_name} (patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription)
-    VALUES (%s, %s, %s, %s, %s, %s, %s)
-    """, (patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription))
-
-    conn.commit()
-    cursor.close()
-    conn.close()
-
+    fields = {
+        "name": name,
+        "blood_group": blood_group,
+        "age": age,
+        "gender": gender,
+        "issued_medicine": issued_medicine,
+        "additional_prescription": additional_prescription
+    }
+    runner.submit("submit", repository.create, fields, on_done=new_patient_saved)
+
+def new_patient_saved(patient_id):
+    # Saved, so the pharmacy can put them on its pending list straight away
+    publish(patient_id, "new")
     messagebox.showinfo("Success", f"New patient added with Patient ID: {patient_id}")
     clear_fields()
 
@@ -79,54 +58,45 @@ def check_old_patient():
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    conn = connect_db()
-    cursor = conn.cursor()
-    today = datetime.date.today()
-    table_name = f"prescriptions_{today}".replace('-', '_')
-
-    cursor.execute(f"SELECT * FROM {table_name} WHERE patient_id = %s", (patient_id,))
-    result = cursor.fetchone()
+    runner.submit(("check", patient_id), repository.get, patient_id,
+                  on_done=lambda visit: show_old_patient(patient_id, *visit))
 
-    if result:
+def show_old_patient(patient_id, visit_date, record):
+    if record:
         name_entry.delete(0, tk.END)
-        name_entry.insert(0, result[2])
+        name_entry.insert(0, record["name"])
         blood_group_entry.delete(0, tk.END)
-        blood_group_entry.insert(0, result[3])
+        blood_group_entry.insert(0, record["blood_group"])
         age_entry.delete(0, tk.END)
-        age_entry.insert(0, result[4])
+        age_entry.insert(0, record["age"])
         gender_entry.delete(0, tk.END)
-        gender_entry.insert(0, result[5])
+        gender_entry.insert(0, record["gender"])
         issued_medicine_entry.delete("1.0", tk.END)
-        issued_medicine_entry.insert("1.0", result[6])
+        issued_medicine_entry.insert("1.0", record["issued_medicine"])
         additional_prescription_entry.delete("1.0", tk.END)
-        additional_prescription_entry.insert("1.0", result[7])
+        additional_prescription_entry.insert("1.0", record["additional_prescription"])
 
         pyperclip.copy(patient_id)
-        messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found and copied to clipboard.")
+        if visit_date == str(datetime.date.today()):
+            messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found and copied to clipboard.")
+        else:
+            messagebox.showinfo("Patient Found", f"Patient ID {patient_id} found (last visit {visit_date}) and copied to clipboard.")
     else:
         messagebox.showwarning("Not Found", "Patient ID not found.")
 
-    cursor.close()
-    conn.close()
-
 def update_old_patient_medicine():
     patient_id = patient_id_entry.get()
     if not patient_id:
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    conn = connect_db()
-    cursor = conn.cursor()
-    today = datetime.date.today()
-    table_name = f"prescriptions_{today}".replace('-', '_')
+    runner.submit(("update", patient_id), repository.get, patient_id,
+                  on_done=lambda visit: confirm_medicine_update(patient_id, *visit))
 
-    cursor.execute(f"SELECT * FROM {table_name} WHERE patient_id = %s", (patient_id,))
-    result = cursor.fetchone()
-
-    if not result:
+def confirm_medicine_update(patient_id, visit_date, record):
+    # No connection is held while the dialog waits on the user
+    if not record:
         messagebox.showwarning("Not Found", "Patient ID not found.")
-        cursor.close()
-        conn.close()
         return
 
     issued_medicine = issued_medicine_entry.get("1.0", tk.END).strip()
@@ -134,31 +104,69 @@ def update_old_patient_medicine():
 
     if not issued_medicine and not additional_prescription:
         messagebox.showwarning("Input Error", "Please enter new medicine or additional prescriptions to update.")
-        cursor.close()
-        conn.close()
         return
 
     clear_old = messagebox.askyesno("Clear Old Records", "Do you want to clear old medicine records?")
 
-    if clear_old:
-        issued_medicine = issued_medicine
-    else:
-        existing_medicine = result[6]
-        issued_medicine = existing_medicine + "\n" + issued_medicine
-
-    cursor.execute(f"""
-    UPDATE {table_name} 
-    SET issued_medicine = %s, additional_prescription = %s
-    WHERE patient_id = %s
-    """, (issued_medicine, additional_prescription, patient_id))
+    # Only saved if nobody changed the visit since it was shown here
+    runner.submit(("update", patient_id), repository.update_medicine,
+                  patient_id, issued_medicine, additional_prescription, clear_old, record.get("version", 0),
+                  on_done=lambda found: medicine_updated(patient_id, found),
+                  on_error=medicine_update_failed)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def medicine_update_failed(error):
+    if isinstance(error, StaleRecordError):
+        messagebox.showwarning("Changed Elsewhere",
+                               "Patient was changed at another desk. Check the patient again before updating.")
+        return
+    show_error(error)
 
+def medicine_updated(patient_id, found):
+    if not found:
+        messagebox.showwarning("Not Found", "Patient ID not found.")
+        return
+    publish(patient_id, "update")
     messagebox.showinfo("Success", f"Medicine updated for Patient ID: {patient_id}")
     clear_fields()
 
+def name_typed(event=None):
+    # Look up patients by name as the user types, for patients who lost their ID
+    query = name_search_entry.get().strip()
+    if not query:
+        name_results.delete(0, tk.END)
+        return
+    # If a lookup is already running, show_name_candidates starts another for the latest text
+    runner.submit("names", repository.find_by_name, query,
+                  on_done=lambda candidates: show_name_candidates(query, candidates))
+
+def show_name_candidates(query, candidates):
+    if name_search_entry.get().strip() != query:
+        name_typed()
+        return
+    name_results.delete(0, tk.END)
+    shown_candidates[:] = candidates
+    for patient_id, name, last_visit in candidates:
+        name_results.insert(tk.END, f"{patient_id}  {name}  (last visit {last_visit})")
+
+def name_candidate_chosen(event=None):
+    # Fill the form with the patient picked from the name lookup
+    selection = name_results.curselection()
+    if not selection:
+        return
+    patient_id_entry.delete(0, tk.END)
+    patient_id_entry.insert(0, shown_candidates[selection[0]][0])
+    check_old_patient()
+
+def show_sync_status():
+    # Hybrid mode only: whether the server is reachable and what is still waiting to go to it
+    queued, online, conflicts = repository.sync_status()
+    text = "Online" if online else "Offline, working locally"
+    text += f", {queued} change(s) waiting to sync" if queued else ", all changes synced"
+    if conflicts:
+        text += f", {conflicts} conflict(s) recorded in sync_conflicts"
+    sync_status_label.config(text=text)
+    sync_status_label.after(STATUS_MS, show_sync_status)
+
 def clear_fields():
     patient_id_entry.delete(0, tk.END)
     name_entry.delete(0, tk.END)
@@ -170,11 +178,15 @@ def clear_fields():
 
 def create_main_window():
     global patient_id_entry, name_entry, blood_group_entry, age_entry, gender_entry
-    global issued_medicine_entry, additional_prescription_entry
+    global issued_medicine_entry, additional_prescription_entry, runner, sync_status_label
+    global name_search_entry, name_results, shown_candidates
 
     window = tk.Tk()
     window.title("Hospital Database")
-    window.geometry("700x500")  # Set the window size to 700x500 for larger space
+    window.geometry("900x500")  # Room for the name lookup next to the form
+
+    # Database calls run here so the window never freezes on a round trip
+    runner = TaskRunner(window)
 
     tk.Label(window, text="Patient ID:").grid(row=0, column=0)
     patient_id_entry = tk.Entry(window)
@@ -208,10 +220,27 @@ def create_main_window():
     additional_prescription_entry = tk.Text(window, height=5, width=30)
     additional_prescription_entry.grid(row=6, column=1)
 
+    # Name lookup for patients who lost their ID, double-click a candidate to fill the form
+    tk.Label(window, text="Find by Name:").grid(row=1, column=2)
+    name_search_entry = tk.Entry(window)
+    name_search_entry.grid(row=1, column=3, columnspan=2)
+    name_search_entry.bind("<KeyRelease>", name_typed)
+    name_results = tk.Listbox(window, height=12, width=40)
+    name_results.grid(row=2, column=2, rowspan=5, columnspan=3)
+    name_results.bind("<Double-Button-1>", name_candidate_chosen)
+    name_results.bind("<Return>", name_candidate_chosen)
+    shown_candidates = []
+
     tk.Button(window, text="Clear Fields", command=clear_fields).grid(row=7, columnspan=5)
 
+    if BACKEND == "hybrid":
+        sync_status_label = tk.Label(window, text="")
+        sync_status_label.grid(row=8, columnspan=5)
+        show_sync_status()
+
     window.mainloop()
 
 if __name__ == "__main__":
+    start_export("sql-doctor")
     create_patient_table()
     create_main_window()
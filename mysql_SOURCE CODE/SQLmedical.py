@@ -1,18 +1,39 @@
 import tkinter as tk
 from tkinter import messagebox
-import mysql.connector
 import datetime
 import os
+import sys
 
-def connect_db():
-    return mysql.connector.connect(
-        host="localhost",
-        port=4444,  # Your specified port
-        user="root",
-        password="0303",  # Your MySQL password
-        database="hospital_db",
-        auth_plugin="mysql_native_password"
-    )
+# Shared helpers (task_runner.py, ...) live next to the JSON apps
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+from task_runner import TaskRunner
+from patient_cache import PatientCache
+from device_presence import biometric_device
+from medications import undispensed_positions
+from patient_repository import open_repository
+from metrics import start_export
+from prescription_feed import PrescriptionFeed, publish
+
+# All SQL lives behind the repository, see mysql_repository.py. HOSPITAL_BACKEND=hybrid keeps
+# working while the server is down (offline_repository.py), and HOSPITAL_BACKEND=service goes
+# through a shared patient_service.py instead.
+BACKEND = os.environ.get("HOSPITAL_BACKEND", "mysql")
+repository = open_repository(BACKEND)
+
+# Patients fetched again while dispensing are served after a one-row version check instead of
+# reading their whole medication history again, see patient_cache.py
+cache = PatientCache(repository)
+
+STATUS_MS = 2000  # How often the sync status line is redrawn in hybrid mode
+
+# wmic takes seconds, so it runs in the background and clicks read the cached answer
+device = biometric_device()
+
+# Patient currently on screen, for Mark Dispensed
+shown_patient_id = None
+
+# Today's patients with medicine still to hand over, by patient ID in the order they came in
+pending = {}
 
 def fetch_patient_details():
     patient_id = patient_id_entry.get()
@@ -20,43 +41,100 @@ def fetch_patient_details():
         messagebox.showwarning("Input Error", "Please enter a Patient ID.")
         return
 
-    conn = connect_db()
-    cursor = conn.cursor()
-    today = datetime.date.today()
-    table_name = f"prescriptions_{today}".replace('-', '_')
-    
-    cursor.execute(f"SELECT * FROM {table_name} WHERE patient_id = %s", (patient_id,))
-    result = cursor.fetchone()
-    
-    if result:
+    runner.submit(("fetch", patient_id), cache.fetch, patient_id, on_done=show_patient_details)
+
+def show_patient_details(visit):
+    global shown_patient_id
+    visit_date, record = visit
+
+    if record:
+        shown_patient_id = record["patient_id"]
         # Clear previous details
         details_text.delete("1.0", tk.END)
-        details_text.insert(tk.END, f"Patient ID: {result[1]}\n")
-        details_text.insert(tk.END, f"Name: {result[2]}\n")
-        details_text.insert(tk.END, f"Blood Group: {result[3]}\n")
-        details_text.insert(tk.END, f"Age: {result[4]}\n")
-        details_text.insert(tk.END, f"Gender: {result[5]}\n")
-        details_text.insert(tk.END, f"Issued Medicine:\n{result[6]}\n")
-        details_text.insert(tk.END, f"Additional Prescription:\n{result[7]}\n")
+        if visit_date != str(datetime.date.today()):
+            details_text.insert(tk.END, f"Last Visit: {visit_date}\n")
+        details_text.insert(tk.END, f"Patient ID: {record['patient_id']}\n")
+        details_text.insert(tk.END, f"Name: {record['name']}\n")
+        details_text.insert(tk.END, f"Blood Group: {record['blood_group']}\n")
+        details_text.insert(tk.END, f"Age: {record['age']}\n")
+        details_text.insert(tk.END, f"Gender: {record['gender']}\n")
+        if undispensed_only.get():
+            # Only what the pharmacy still has to hand over, from medication_history
+            details_text.insert(tk.END, "Not Yet Dispensed:\n")
+            for position in undispensed_positions(record):
+                entry = record["medications"][position]
+                details_text.insert(tk.END, f"{entry['issued_at']} ({entry['issued_by']}): {entry['medicine']}\n")
+        else:
+            details_text.insert(tk.END, f"Issued Medicine:\n{record['issued_medicine']}\n")
+        details_text.insert(tk.END, f"Additional Prescription:\n{record['additional_prescription']}\n")
     else:
         messagebox.showwarning("Not Found", "Patient ID not found.")
-    
-    cursor.close()
-    conn.close()
+
+def mark_dispensed():
+    if shown_patient_id is None:
+        messagebox.showwarning("Input Error", "Please fetch a patient first.")
+        return
+    patient_id = shown_patient_id
+    runner.submit(("dispense", patient_id), repository.dispense, patient_id,
+                  on_done=lambda count: medicine_dispensed(patient_id, count))
+
+def medicine_dispensed(patient_id, count):
+    cache.invalidate(patient_id)
+    pending.pop(patient_id, None)
+    redraw_pending()
+    # Other pharmacies drop them from their pending lists too
+    publish(patient_id, "dispense")
+    messagebox.showinfo("Dispensed", f"Marked {count} medicine entries dispensed for Patient ID: {patient_id}")
+    redraw_shown_patient()
+
+def redraw_shown_patient():
+    if shown_patient_id is not None:
+        runner.submit(("fetch", shown_patient_id), cache.fetch, shown_patient_id, on_done=show_patient_details)
+
+def prescription_arrived(visit_date, record):
+    # A doctor desk just prescribed for this patient, or the resync found them
+    if record is None:
+        return
+    patient_id = record["patient_id"]
+    # Just read after the change, so it is the freshest copy there is
+    cache.put(patient_id, (visit_date, record))
+    if visit_date == str(datetime.date.today()) and undispensed_positions(record):
+        pending[patient_id] = record
+    else:
+        pending.pop(patient_id, None)
+    redraw_pending()
+    if patient_id == shown_patient_id:
+        show_patient_details((visit_date, record))
+
+def redraw_pending():
+    pending_list.delete(0, tk.END)
+    for patient_id, record in pending.items():
+        medicine = " / ".join(record["medications"][position]["medicine"] for position in undispensed_positions(record))
+        pending_list.insert(tk.END, f"{patient_id}  {record['name']}: {medicine}")
+
+def pending_chosen(event=None):
+    # Fetch the patient picked from the pending list
+    selection = pending_list.curselection()
+    if not selection:
+        return
+    patient_id_entry.delete(0, tk.END)
+    patient_id_entry.insert(0, list(pending)[selection[0]])
+    fetch_patient_details()
+
+def show_sync_status():
+    # Hybrid mode only: whether the server is reachable and what is still waiting to go to it
+    queued, online, conflicts = repository.sync_status()
+    text = "Online" if online else "Offline, working locally"
+    text += f", {queued} change(s) waiting to sync" if queued else ", all changes synced"
+    if conflicts:
+        text += f", {conflicts} conflict(s) recorded in sync_conflicts"
+    sync_status_label.config(text=text)
+    sync_status_label.after(STATUS_MS, show_sync_status)
 
 def check_biometric_driver():
-    # Check if a specific biometric driver is connected
-    # Adjust this check based on your actual biometric device driver
-    # Example: Check if a specific driver is listed in device manager
-    try:
-        drivers = os.popen('wmic path Win32_PnPEntity get Name').read()
-        if "Your Biometric Driver Name" in drivers:
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error checking drivers: {e}")
-        return False
+    # Check if the biometric driver is connected
+    # Set BIOMETRIC_DRIVER_NAME to your driver's name as listed in device manager, see device_presence.py
+    return device.is_connected()
 
 def biometric_prompt():
     if not check_biometric_driver():
@@ -71,11 +149,15 @@ def biometric_prompt():
         messagebox.showinfo("Success", "Biometric driver is connected. Implement biometric logic here.")
 
 def create_patient_id_window():
-    global patient_id_entry, details_text
+    global patient_id_entry, details_text, runner
+    global undispensed_only, pending_list, sync_status_label
 
     window = tk.Tk()
     window.title("Patient Details Display")
-    window.geometry("600x400")  # Set window size to 600x400
+    window.geometry("600x650")  # Room for dispensing and the pending list
+
+    # Database calls run here so the window never freezes on a round trip
+    runner = TaskRunner(window)
 
     # Patient ID Entry
     tk.Label(window, text="Patient ID:").grid(row=0, column=0)
@@ -90,7 +172,26 @@ def create_patient_id_window():
     details_text = tk.Text(window, height=15, width=50)
     details_text.grid(row=2, column=0, columnspan=3)
 
+    # Dispensing
+    undispensed_only = tk.BooleanVar(value=False)
+    tk.Checkbutton(window, text="Undispensed only", variable=undispensed_only, command=redraw_shown_patient).grid(row=5, column=0)
+    tk.Button(window, text="Mark Dispensed", command=mark_dispensed).grid(row=5, column=1)
+
+    # Prescriptions waiting to be handed over, filled in as the doctor desks save them.
+    # Double-click one to fetch it.
+    tk.Label(window, text="Pending Prescriptions:").grid(row=6, column=0, columnspan=3)
+    pending_list = tk.Listbox(window, height=8, width=60)
+    pending_list.grid(row=7, column=0, columnspan=3)
+    pending_list.bind("<Double-Button-1>", pending_chosen)
+    feed = PrescriptionFeed(repository, window, runner, prescription_arrived)
+
+    if BACKEND == "hybrid":
+        sync_status_label = tk.Label(window, text="")
+        sync_status_label.grid(row=8, column=0, columnspan=3)
+        show_sync_status()
+
     window.mainloop()
+    feed.close()
 
 def exit_program():
     # Close the program
@@ -112,4 +213,7 @@ def main_menu():
     menu_window.mainloop()
 
 if __name__ == "__main__":
+    start_export("sql-pharmacy")
+    repository.initialize()
+    device.start()
     main_menu()  # Start the main menu
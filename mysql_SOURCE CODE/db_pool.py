@@ -0,0 +1,163 @@
+import threading
+import time
+import mysql.connector
+from mysql.connector import errors
+# Next to the JSON apps, which importers put on sys.path first
+from metrics import timed
+
+# Connection settings shared by SQLdoctor.py and SQLmedical.py
+DB_CONFIG = {
+    "host": "localhost",
+    "port": 4444,  # Your specified port
+    "user": "root",
+    "password": "0303",  # Your MySQL password
+    "database": "hospital_db",
+    "auth_plugin": "mysql_native_password"
+}
+
+POOL_SIZE = 5  # Most connections open at once
+IDLE_TIMEOUT = 300  # Seconds an unused connection is kept before it is closed
+ACQUIRE_TIMEOUT = 10  # Seconds to wait for a free connection before giving up
+
+
+class PooledConnection:
+    """A pooled MySQL connection. close() hands it back to the pool instead of closing it."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    """Bounded pool of MySQL connections with health checks and an idle timeout."""
+
+    def __init__(self, config, size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, acquire_timeout=ACQUIRE_TIMEOUT):
+        self.config = config
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # (connection, released_at), most recently used last
+        self._open = 0
+        self._cond = threading.Condition()
+        self.counters = {"created": 0, "reused": 0, "reconnected": 0, "expired": 0, "waits": 0, "timeouts": 0}
+
+    def _expire_idle(self, now):
+        # Takes idle connections past idle_timeout out of the pool and returns them. The caller
+        # holds _cond and closes them after letting go of it, as a close can wait on the network.
+        expired = []
+        # Oldest idle connections sit at the front of the list
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            self._open -= 1
+            self.counters["expired"] += 1
+            expired.append(conn)
+        return expired
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except errors.Error:
+            pass
+
+    @timed("hospital_mysql_connect_seconds")
+    def _connect(self):
+        try:
+            conn = mysql.connector.connect(**self.config)
+        except errors.Error:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.counters["created"] += 1
+        return conn
+
+    @timed("hospital_pool_acquire_seconds")
+    def acquire(self):
+        """Return a PooledConnection, reusing an idle one when possible."""
+        deadline = time.monotonic() + self.acquire_timeout
+        expired = []
+        try:
+            with self._cond:
+                while True:
+                    expired.extend(self._expire_idle(time.monotonic()))
+                    if self._idle:
+                        conn, _ = self._idle.pop()
+                        break
+                    if self._open < self.size:
+                        self._open += 1
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise errors.PoolError(f"No free database connection after {self.acquire_timeout} seconds")
+                    self.counters["waits"] += 1
+                    self._cond.wait(remaining)
+        finally:
+            for stale in expired:
+                self._close_quietly(stale)
+
+        if conn is None:
+            return PooledConnection(self, self._connect())
+
+        # Health check before handing out a connection that sat idle
+        try:
+            conn.ping(reconnect=False)
+            counter = "reused"
+        except errors.Error:
+            self._close_quietly(conn)
+            conn = self._connect()
+            counter = "reconnected"
+        with self._cond:
+            self.counters[counter] += 1
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Put a connection back, dropping it if it can't be reset."""
+        try:
+            # Don't leak an open transaction into the next borrower
+            conn.rollback()
+        except errors.Error:
+            self._close_quietly(conn)
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def get_stats(self):
+        """Current pool occupancy and lifetime counters, for sizing POOL_SIZE."""
+        with self._cond:
+            stats = dict(self.counters)
+            stats.update(size=self.size, open=self._open, idle=len(self._idle), in_use=self._open - len(self._idle))
+        return stats
+
+    def close_all(self):
+        """Close every idle connection, e.g. when the window is closed."""
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._open -= len(idle)
+            self._idle.clear()
+        for conn in idle:
+            self._close_quietly(conn)
+
+
+# Shared pool used by both apps
+pool = ConnectionPool(DB_CONFIG)
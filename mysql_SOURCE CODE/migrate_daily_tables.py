@@ -0,0 +1,67 @@
+import argparse
+import datetime
+import os
+import sys
+
+# db_pool's metrics.py lives next to the JSON apps
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+from db_pool import pool
+from schema import create_tables
+from mysql_repository import rebuild_rollups
+
+# Columns shared by the old prescriptions_YYYY_MM_DD tables and the prescriptions table
+COLUMNS = "patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription, date, last_login"
+
+
+def daily_tables(cursor):
+    cursor.execute("SHOW TABLES LIKE 'prescriptions\\_%'")
+    tables = []
+    for (table_name,) in cursor.fetchall():
+        try:
+            visit_date = datetime.datetime.strptime(table_name[len("prescriptions_"):], "%Y_%m_%d").date()
+        except ValueError:
+            continue
+        tables.append((visit_date, table_name))
+    return sorted(tables)
+
+
+def migrate(drop_old=False):
+    """Bulk-copy every daily table into prescriptions, one transaction per table."""
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    create_tables(cursor)
+    conn.commit()
+
+    cursor.execute("SELECT table_name FROM prescription_migrations")
+    done = {table_name for (table_name,) in cursor.fetchall()}
+
+    for visit_date, table_name in daily_tables(cursor):
+        if table_name not in done:
+            # INSERT ... SELECT keeps the copy on the server, no rows travel to the client
+            cursor.execute(f"""
+            INSERT INTO prescriptions ({COLUMNS}, visit_date)
+            SELECT {COLUMNS}, %s FROM {table_name} ORDER BY prescription_id
+            """, (visit_date,))
+            copied = cursor.rowcount
+            cursor.execute("INSERT INTO prescription_migrations (table_name, rows_copied) VALUES (%s, %s)",
+                           (table_name, copied))
+            conn.commit()
+            print(f"{table_name}: copied {copied} rows")
+        if drop_old:
+            cursor.execute(f"DROP TABLE {table_name}")
+            print(f"{table_name}: dropped")
+
+    # The per-day lookup index is not needed once everything lives in prescriptions
+    cursor.execute("DROP TABLE IF EXISTS patient_visits")
+    # Copied rows went straight into prescriptions, so count them into the daily rollups
+    rebuild_rollups(cursor)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy prescriptions_YYYY_MM_DD tables into the prescriptions table.")
+    parser.add_argument("--drop-old", action="store_true", help="drop each daily table once it has been copied")
+    args = parser.parse_args()
+    migrate(drop_old=args.drop_old)
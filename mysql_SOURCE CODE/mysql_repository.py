@@ -0,0 +1,415 @@
+import datetime
+import json
+import os
+import sys
+
+# PatientRepository and friends live next to the JSON apps, and db_pool needs their metrics.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+from db_pool import pool
+from schema import create_tables
+from patient_repository import (PatientRepository, PATIENT_FIELDS, SEARCH_LIMIT, NAME_LIMIT, UPDATED, STALE,
+                                full_update)
+from journal_store import StaleRecordError
+from text_index import tokenize
+from name_index import NameIndex
+from id_allocator import PATIENT_ID_WIDTH
+from medications import new_entry, with_medicine, undispensed_positions, HISTORY_COLUMNS, entry_from_row
+from daily_rollups import (DailyRollups, visit_keys, medication_keys, table_keys, TOTAL,
+                           VISIT_QUERY, MEDICATION_QUERY)
+
+# medication_history rows re-read behind the caller's mark, as AUTO_INCREMENT IDs are handed
+# out at insert but become visible at commit, not always in ID order
+PENDING_OVERLAP = 50
+
+RECORD_COLUMNS = ["prescription_id", "patient_id", "name", "blood_group", "age", "gender",
+                  "issued_medicine", "additional_prescription", "date", "last_login", "visit_date", "version"]
+
+
+def to_record(row):
+    """Map a SELECT * row of prescriptions to the dict shape the JSON store uses."""
+    record = dict(zip(RECORD_COLUMNS, row))
+    record["age"] = "" if record["age"] is None else str(record["age"])
+    record["date"] = record["date"].isoformat() if record["date"] else ""
+    record["visit_date"] = str(record["visit_date"])
+    return record
+
+
+def find_latest_visit(cursor, patient_id, for_update=False):
+    # Most recent prescription row for a patient on any day, served by idx_patient_visit.
+    # for_update locks it until the caller commits.
+    cursor.execute("""
+    SELECT * FROM prescriptions
+    WHERE patient_id = %s ORDER BY visit_date DESC, prescription_id DESC LIMIT 1
+    """ + (" FOR UPDATE" if for_update else ""), (patient_id,))
+    result = cursor.fetchone()
+    if not result:
+        return None
+    return to_record(result)
+
+
+def attach_medications(cursor, records):
+    """Fetch the medication history of records (from to_record) in one query and work out issued_medicine."""
+    history = {}
+    if records:
+        ids = [record["prescription_id"] for record in records]
+        cursor.execute(f"""
+        SELECT {HISTORY_COLUMNS} FROM medication_history
+        WHERE prescription_id IN ({", ".join(["%s"] * len(ids))}) ORDER BY entry_id
+        """, ids)
+        for row in cursor.fetchall():
+            history.setdefault(row[1], []).append(entry_from_row(row))
+    return [with_medicine(dict(record, medications=history.get(record["prescription_id"], [])))
+            for record in records]
+
+
+def add_medication(cursor, prescription_id, entry):
+    # One row per entry, so an update never rewrites the history before it
+    cursor.execute("""
+    INSERT INTO medication_history (prescription_id, patient_id, medicine, issued_at, issued_by, clears_previous)
+    SELECT prescription_id, patient_id, %s, %s, %s, %s FROM prescriptions WHERE prescription_id = %s
+    """, (entry["medicine"], datetime.datetime.fromisoformat(entry["issued_at"]), entry["issued_by"],
+          entry["clears"], prescription_id))
+
+
+def add_medicine(cursor, record, day, entry, additional_prescription, clear_old=False):
+    """Add entry (None for none) to record, a find_latest_visit row, as of day. The caller commits.
+
+    A record from an earlier day gets a new visit on day, carrying over the medicine they were on.
+    Either way the visit's version ends up one past record's.
+    """
+    prescription_id = record["prescription_id"]
+    if record["visit_date"] == day:
+        cursor.execute("""
+        UPDATE prescriptions SET additional_prescription = %s, version = version + 1 WHERE prescription_id = %s
+        """, (additional_prescription, prescription_id))
+        if entry is not None:
+            add_rollups(cursor, medication_keys(day, entry))
+    else:
+        record = attach_medications(cursor, [record])[0]
+        record.update(issued_medicine="" if clear_old else record["issued_medicine"],
+                      additional_prescription=additional_prescription,
+                      medications=[entry] if entry is not None else [],
+                      version=record["version"] + 1)
+        prescription_id = insert_prescription(cursor, record["patient_id"], record, day)
+        add_rollups(cursor, visit_keys(day, record))
+    if entry is not None:
+        add_medication(cursor, prescription_id, entry)
+
+
+def dispense_entries(cursor, entry_ids, dispensed_at):
+    """Mark medication_history entries dispensed at dispensed_at (a datetime). The caller commits.
+
+    Returns how many weren't dispensed already, which is what the rollups count.
+    """
+    if not entry_ids:
+        return 0
+    cursor.execute(f"""
+    UPDATE medication_history SET dispensed_at = %s
+    WHERE entry_id IN ({", ".join(["%s"] * len(entry_ids))}) AND dispensed_at IS NULL
+    """, [dispensed_at] + entry_ids)
+    dispensed = cursor.rowcount
+    add_rollups(cursor, [(str(dispensed_at.date()), "dispensed", TOTAL)] * dispensed)
+    return dispensed
+
+
+def rollup_rows(keys):
+    """daily_rollups rows (day, dimension, value, count) adding up keys, see daily_rollups.py."""
+    rollups = DailyRollups()
+    rollups.add(keys)
+    return list(rollups.rows())
+
+
+def add_rollups(cursor, keys):
+    # Counts for what the caller is writing, in its transaction so they never drift from the rows
+    rows = rollup_rows(keys)
+    if rows:
+        cursor.executemany("""
+        INSERT INTO daily_rollups (day, dimension, value, count) VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+        """, rows)
+
+
+def rebuild_rollups(cursor):
+    """Recount daily_rollups from every prescription and medication_history row. The caller commits."""
+    cursor.execute(VISIT_QUERY)
+    keys = list(table_keys(cursor.fetchall(), []))
+    cursor.execute(MEDICATION_QUERY)
+    keys.extend(table_keys([], cursor.fetchall()))
+    rollups = DailyRollups()
+    rollups.rebuild_keys(keys)
+    cursor.execute("DELETE FROM daily_rollups")
+    add_rollups(cursor, rollups.rows())
+
+
+def get_new_patient_id(cursor):
+    # LAST_INSERT_ID(expr) bumps and reads the counter atomically for this connection,
+    # and the row lock is held until commit, so two desks never get the same ID
+    cursor.execute("UPDATE patient_id_sequence SET last_id = LAST_INSERT_ID(last_id + 1) WHERE id = 1")
+    cursor.execute("SELECT LAST_INSERT_ID()")
+    return str(cursor.fetchone()[0]).zfill(PATIENT_ID_WIDTH)
+
+
+def reserve_patient_ids(cursor, count):
+    """Take count consecutive IDs from the sequence, for a desk to hand out while offline.
+
+    Returns (first, last) as numbers. The caller commits.
+    """
+    cursor.execute("UPDATE patient_id_sequence SET last_id = LAST_INSERT_ID(last_id + %s) WHERE id = 1", (count,))
+    cursor.execute("SELECT LAST_INSERT_ID()")
+    last = cursor.fetchone()[0]
+    return last - count + 1, last
+
+
+def insert_prescription(cursor, patient_id, record, visit_date):
+    cursor.execute("""
+    INSERT INTO prescriptions (patient_id, name, blood_group, age, gender, issued_medicine, additional_prescription,
+                               visit_date, version)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, (patient_id, record["name"], record["blood_group"], record["age"] or None, record["gender"],
+          record["issued_medicine"], record["additional_prescription"], visit_date, record.get("version", 0)))
+    return cursor.lastrowid
+
+
+class MySQLRepository(PatientRepository):
+    """The shared prescriptions table on the MySQL server, through the connection pool."""
+
+    def __init__(self):
+        # Name lookups run on every keystroke, so they are served from a local index
+        # fed with only the rows past the highest prescription_id seen
+        self.names = NameIndex()
+        self.names_seen = 0
+
+    def initialize(self):
+        conn = pool.acquire()
+        cursor = conn.cursor()
+        # One prescriptions table for every day, see schema.py and migrate_daily_tables.py
+        create_tables(cursor)
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def create(self, fields, patient_id=None):
+        return self.create_many([(fields, patient_id)])[0]
+
+    def create_many(self, patients):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        patient_ids = []
+        try:
+            # One transaction and one commit for the whole batch
+            for fields, patient_id in patients:
+                patient_id = patient_id or get_new_patient_id(cursor)
+                record = {field: fields[field] for field in PATIENT_FIELDS}
+                # The first prescription is the first medication entry
+                prescription_id = insert_prescription(cursor, patient_id, dict(record, issued_medicine=""),
+                                                      datetime.date.today())
+                entry = new_entry(record["issued_medicine"]) if record["issued_medicine"] else None
+                if entry is not None:
+                    add_medication(cursor, prescription_id, entry)
+                add_rollups(cursor, visit_keys(str(datetime.date.today()), dict(
+                    record, issued_medicine="", medications=[entry] if entry is not None else [])))
+                patient_ids.append(patient_id)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+        return patient_ids
+
+    def get(self, patient_id):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            record = find_latest_visit(cursor, patient_id)
+            if record is None:
+                return None, None
+            record = attach_medications(cursor, [record])[0]
+        finally:
+            cursor.close()
+            conn.close()
+        return record["visit_date"], record
+
+    def get_version(self, patient_id):
+        # One row found through idx_patient_visit, and its medication_history counted on idx_history_prescription
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute("""
+            SELECT visit_date, version, (SELECT COUNT(dispensed_at) FROM medication_history history
+                                         WHERE history.prescription_id = prescriptions.prescription_id)
+            FROM prescriptions
+            WHERE patient_id = %s ORDER BY visit_date DESC, prescription_id DESC LIMIT 1
+            """, (patient_id,))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+        if not row:
+            return None
+        return str(row[0]), row[1], row[2]
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        status, = self.update_medicine_many([(patient_id, issued_medicine, additional_prescription, clear_old,
+                                              expected_version)])
+        if status == STALE:
+            raise StaleRecordError(f"Patient {patient_id} was changed by another desk")
+        return status == UPDATED
+
+    def update_medicine_many(self, updates):
+        if not updates:
+            return []
+        day = str(datetime.date.today())
+        updates = [full_update(update) for update in updates]
+        entries = [new_entry(issued_medicine, clear_old) if issued_medicine or clear_old else None
+                   for _, issued_medicine, _, clear_old, _ in updates]
+        batch = []
+        for (patient_id, _, additional_prescription, _, expected_version), entry in zip(updates, entries):
+            item = {"patient_id": patient_id, "day": day, "additional_prescription": additional_prescription,
+                    "rollups": rollup_rows(medication_keys(day, entry)) if entry is not None else []}
+            # Left out rather than null, as the procedure tests for a missing key
+            if expected_version is not None:
+                item["expected_version"] = expected_version
+            if entry is not None:
+                item["entry"] = dict(entry, issued_at=entry["issued_at"].replace("T", " "), clears=int(entry["clears"]))
+            batch.append(item)
+
+        conn = pool.acquire()
+        # Prepared cursors can't call procedures, so the call has a plain one of its own
+        call_cursor = conn.cursor()
+        cursor = conn.cursor(prepared=True)
+        try:
+            # Today's visits are checked and written by update_medicine_batch (see schema.py) in
+            # one round trip. It doesn't commit, so the whole batch, carried-over visits too, is
+            # one transaction, and a failure anywhere leaves none of it applied (the pool rolls
+            # back a connection handed back without a commit).
+            call_cursor.callproc("update_medicine_batch", (json.dumps(batch),))
+            statuses = [status for status, _ in json.loads(next(call_cursor.stored_results()).fetchone()[0])]
+            # Returning patients from an earlier day get today's visit, which the procedure leaves to us
+            carried = [position for position, status in enumerate(statuses) if status == "earlier"]
+            for position in carried:
+                patient_id, _, additional_prescription, clear_old, expected_version = updates[position]
+                record = find_latest_visit(cursor, patient_id, for_update=True)
+                if expected_version is not None and record["version"] != expected_version:
+                    statuses[position] = STALE
+                    continue
+                add_medicine(cursor, record, day, entries[position], additional_prescription, clear_old)
+                statuses[position] = UPDATED
+            conn.commit()
+        finally:
+            call_cursor.close()
+            cursor.close()
+            conn.close()
+        return statuses
+
+    def dispense(self, patient_id):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            record = find_latest_visit(cursor, patient_id)
+            if record is None:
+                return 0
+            record = attach_medications(cursor, [record])[0]
+            entry_ids = [int(record["medications"][position]["id"]) for position in undispensed_positions(record)]
+            dispensed = dispense_entries(cursor, entry_ids, datetime.datetime.now().replace(microsecond=0))
+            conn.commit()
+            return dispensed
+        finally:
+            cursor.close()
+            conn.close()
+
+    def list_day(self, date):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute("SELECT * FROM prescriptions WHERE visit_date = %s ORDER BY prescription_id", (date,))
+            return attach_medications(cursor, [to_record(row) for row in cursor.fetchall()])
+        finally:
+            cursor.close()
+            conn.close()
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # Served by the ft_prescription_text and ft_history_medicine FULLTEXT indexes,
+        # +word makes every word required
+        sql = """
+        SELECT * FROM prescriptions
+        WHERE (MATCH(issued_medicine, additional_prescription) AGAINST (%s IN BOOLEAN MODE)
+               OR prescription_id IN (SELECT prescription_id FROM medication_history
+                                      WHERE MATCH(medicine) AGAINST (%s IN BOOLEAN MODE)))
+        """
+        params = [" ".join(f"+{term}" for term in terms)] * 2
+        if date is not None:
+            sql += " AND visit_date = %s"
+            params.append(date)
+        sql += " ORDER BY visit_date DESC, prescription_id DESC LIMIT %s"
+        params.append(limit)
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute(sql, params)
+            records = attach_medications(cursor, [to_record(row) for row in cursor.fetchall()])
+            return [(record["visit_date"], record) for record in records]
+        finally:
+            cursor.close()
+            conn.close()
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute("""
+            SELECT prescription_id, patient_id, name, visit_date FROM prescriptions
+            WHERE prescription_id > %s ORDER BY prescription_id
+            """, (self.names_seen,))
+            for prescription_id, patient_id, name, visit_date in cursor.fetchall():
+                self.names.add(patient_id, name or "", str(visit_date))
+                self.names_seen = prescription_id
+        finally:
+            cursor.close()
+            conn.close()
+        return self.names.search(query, limit)
+
+    def pending_prescriptions(self, since=None):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute("SELECT COALESCE(MAX(entry_id), 0) FROM medication_history")
+            mark = cursor.fetchone()[0]
+            # Served by the primary key on entry_id and idx_visit_patient
+            cursor.execute("""
+            SELECT * FROM prescriptions WHERE visit_date = %s AND prescription_id IN (
+                SELECT prescription_id FROM medication_history WHERE entry_id > %s AND entry_id <= %s)
+            ORDER BY prescription_id
+            """, (str(datetime.date.today()), max(int(since or 0) - PENDING_OVERLAP, 0), mark))
+            records = attach_medications(cursor, [to_record(row) for row in cursor.fetchall()])
+            return mark, [(record["visit_date"], record) for record in records]
+        finally:
+            cursor.close()
+            conn.close()
+
+    def daily_rollups(self, start=None, end=None):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            cursor.execute("""
+            SELECT day, dimension, value, count FROM daily_rollups
+            WHERE day BETWEEN %s AND %s
+            """, (start or "1000-01-01", end or "9999-12-31"))
+            rollups = DailyRollups()
+            rollups.load_rows(cursor.fetchall())
+            return rollups.between()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def rebuild_rollups(self):
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            rebuild_rollups(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
@@ -0,0 +1,392 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from mysql.connector import errors
+
+# The local store and the outbox live next to the JSON apps, and db_pool needs their metrics.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "json_sourcecode"))
+from db_pool import pool
+from mysql_repository import (MySQLRepository, find_latest_visit, attach_medications, add_medication, add_medicine,
+                              add_rollups, dispense_entries, insert_prescription, reserve_patient_ids)
+from patient_repository import (PatientRepository, JsonRepository, PATIENT_FIELDS, SEARCH_LIMIT, NAME_LIMIT, today,
+                                check_version)
+from outbox import Outbox
+from file_lock import FileLock
+from id_allocator import PATIENT_ID_WIDTH
+from medications import new_entry, undispensed_positions, DESK_NAME
+from daily_rollups import visit_keys
+
+SYNC_BATCH = 100  # Most queued writes sent in one transaction
+SYNC_INTERVAL = 5  # Seconds between sync attempts when nothing new was queued
+OFFLINE_RETRY = 30  # Seconds reads skip the server after it couldn't be reached
+ID_BLOCK = 200  # Patient IDs reserved from the server at a time, for new patients while offline
+ID_LOW_WATER = 50  # Reserve another block once fewer than this are left
+
+# The server being unreachable, as opposed to it turning a write down
+OFFLINE_ERRORS = (errors.InterfaceError, errors.OperationalError, errors.PoolError)
+
+
+class OfflineError(Exception):
+    """Something only the server knows was needed while it couldn't be reached."""
+
+
+class ReservedIds:
+    """Patient IDs reserved from the server's sequence, for new patients registered while offline.
+
+    Kept as [first, last] ranges in a small JSON file, shared by the processes using the same local store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path + ".lock")
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return []
+
+    def _write(self, ranges):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w") as file:
+            json.dump(ranges, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.path)
+
+    def left(self):
+        with self.lock:
+            return sum(last - first + 1 for first, last in self._read())
+
+    def add(self, first, last):
+        with self.lock:
+            self._write(self._read() + [[first, last]])
+
+    def take(self):
+        """Return the next reserved patient ID, or None if there are none left."""
+        with self.lock:
+            ranges = self._read()
+            if not ranges:
+                return None
+            first, last = ranges[0]
+            if first == last:
+                ranges.pop(0)
+            else:
+                ranges[0][0] = first + 1
+            self._write(ranges)
+        return str(first).zfill(PATIENT_ID_WIDTH)
+
+
+def ping(cursor):
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+
+
+def server_copy(cursor, patient_id):
+    """The patient's latest visit on the server, as (visit_date, record) shaped like the local store keeps it."""
+    visit = find_latest_visit(cursor, patient_id)
+    if visit is None:
+        return None, None
+    record = {field: value for field, value in attach_medications(cursor, [visit])[0].items()
+              if field in ["patient_id", "date", "medications", "version"] + PATIENT_FIELDS}
+    # The store keeps the text the visit started with, not the current medicine worked out from it
+    record["issued_medicine"] = visit["issued_medicine"]
+    return visit["visit_date"], record
+
+
+def apply_create(cursor, write):
+    record = write["record"]
+    visit = find_latest_visit(cursor, write["patient_id"])
+    if visit is not None and visit["visit_date"] >= write["date"]:
+        return f"Patient ID already has a visit on {visit['visit_date']} on the server"
+    prescription_id = insert_prescription(cursor, write["patient_id"], record, write["date"])
+    for entry in record["medications"]:
+        add_medication(cursor, prescription_id, entry)
+    add_rollups(cursor, visit_keys(write["date"], record))
+
+
+def apply_update(cursor, write):
+    visit = find_latest_visit(cursor, write["patient_id"])
+    if visit is None:
+        return "Patient is not on the server"
+    if visit["visit_date"] > write["date"]:
+        return f"Patient has a newer visit on {visit['visit_date']} on the server"
+    if visit["visit_date"] == write["date"] and visit["additional_prescription"] not in (
+            write["base_additional"], write["additional_prescription"]):
+        return "Additional prescription was changed at another desk"
+    add_medicine(cursor, visit, write["date"], write["entry"], write["additional_prescription"], write["clear_old"])
+
+
+def apply_dispense(cursor, write):
+    visit = find_latest_visit(cursor, write["patient_id"])
+    if visit is None:
+        return "Patient is not on the server"
+    record = attach_medications(cursor, [visit])[0]
+    # Only what had been issued when the pharmacy handed it over
+    entry_ids = [int(record["medications"][position]["id"]) for position in undispensed_positions(record)
+                 if record["medications"][position]["issued_at"] <= write["dispensed_at"]]
+    if not dispense_entries(cursor, entry_ids, datetime.datetime.fromisoformat(write["dispensed_at"])):
+        return "Already dispensed at another counter"
+
+
+# Queued write "op" -> function applying it. Each returns why it doesn't fit the server, or None.
+APPLY = {"create": apply_create, "update": apply_update, "dispense": apply_dispense}
+
+
+def claim_key(cursor, write):
+    """Record the write's idempotency key. Returns False if it was applied before."""
+    cursor.execute("INSERT IGNORE INTO sync_applied (idempotency_key, desk) VALUES (%s, %s)",
+                   (write["key"], DESK_NAME))
+    return cursor.rowcount == 1
+
+
+def record_conflict(cursor, write, reason):
+    cursor.execute("""
+    INSERT INTO sync_conflicts (idempotency_key, patient_id, operation, reason, desk) VALUES (%s, %s, %s, %s, %s)
+    """, (write["key"], write["patient_id"], json.dumps(write), reason[:255], DESK_NAME))
+
+
+def apply_writes(cursor, writes):
+    """Apply queued desk writes in the caller's transaction, skipping any applied before.
+
+    Writes that no longer fit what the server has go to sync_conflicts instead. Returns how many did.
+    """
+    conflicts = 0
+    for write in writes:
+        if not claim_key(cursor, write):
+            # Sent before, but the desk never got to acknowledge it
+            continue
+        reason = APPLY[write["op"]](cursor, write)
+        if reason is not None:
+            record_conflict(cursor, write, reason)
+            conflicts += 1
+    return conflicts
+
+
+def reject_write(cursor, write, reason):
+    """Record a write the server turned down as a conflict, so it stops holding up the queue.
+
+    Returns False if that was done before.
+    """
+    if not claim_key(cursor, write):
+        return False
+    record_conflict(cursor, write, reason)
+    return True
+
+
+class OfflineFirstRepository(PatientRepository):
+    """MySQL behind a local JSON store, so a desk keeps working while the server can't be reached.
+
+    Writes are checked against the local store (journal_store.py), go to it and to an
+    outbox (outbox.py), both fsynced, and return without touching the network. A
+    background thread sends the outbox to MySQL, SYNC_BATCH writes per transaction, and
+    writes that no longer fit what the server has end up in sync_conflicts. It then
+    copies the patients it sent back from the server. Reads come from MySQL, whose copy
+    of the patient is kept in the local store for the writes to come, or from the local
+    store while it can't be reached and for patients with writes still queued. New
+    patients get IDs from a block reserved from the server ahead of time.
+    """
+
+    def __init__(self, local_file):
+        self.local = JsonRepository(local_file)
+        self.remote = MySQLRepository()
+        self.outbox = Outbox(local_file + ".outbox")
+        self.ids = ReservedIds(local_file + ".ids")
+        self.offline_until = 0
+        self.conflicts = 0
+        self.wake = threading.Event()
+
+    def initialize(self):
+        self.local.initialize()
+        try:
+            self.remote.initialize()
+        except OFFLINE_ERRORS:
+            self._went_offline()
+        threading.Thread(target=self._sync_forever, daemon=True).start()
+        # Send what an earlier run left queued and reserve IDs right away
+        self.wake.set()
+
+    def _online(self):
+        return time.monotonic() >= self.offline_until
+
+    def _went_offline(self):
+        self.offline_until = time.monotonic() + OFFLINE_RETRY
+
+    def _on_server(self, func, *args):
+        """Run func(cursor, *args) in a transaction on the server and return what it returns."""
+        conn = pool.acquire()
+        cursor = conn.cursor(prepared=True)
+        try:
+            result = func(cursor, *args)
+            conn.commit()
+            return result
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _queue(self, write):
+        self.outbox.put(write)
+        self.wake.set()
+
+    def _queued_patients(self):
+        return {write["patient_id"] for _, write in self.outbox.pending()}
+
+    def _read(self, name, *args):
+        """Answer a read from the server, or from the local store while it can't be reached."""
+        if self._online():
+            try:
+                return getattr(self.remote, name)(*args)
+            except OFFLINE_ERRORS:
+                self._went_offline()
+        return getattr(self.local, name)(*args)
+
+    def _copy_from_server(self, patient_ids):
+        """Bring the local copies of patients up to date from the server, skipping any with writes queued."""
+        for patient_id in set(patient_ids) - self._queued_patients():
+            visit_date, record = self._on_server(server_copy, patient_id)
+            if record is not None:
+                self._keep_local(visit_date, record)
+
+    def _keep_local(self, visit_date, record):
+        # The server's version comes along, so an expected_version from get() checks out locally
+        store = self.local.store
+        store.refresh()
+        local_date, local_record = store.find_latest(record["patient_id"])
+        if local_date is None or local_date < visit_date:
+            store.add_record(visit_date, record)
+        elif local_date == visit_date and any(local_record.get(field) != record[field] for field in
+                                              ["issued_medicine", "additional_prescription", "medications", "version"]):
+            store.update_record(visit_date, record["patient_id"], {
+                "issued_medicine": record["issued_medicine"],
+                "additional_prescription": record["additional_prescription"],
+                "medications": record["medications"],
+                "version": record["version"]
+            })
+
+    def _reserve_ids(self):
+        self.ids.add(*self._on_server(reserve_patient_ids, ID_BLOCK))
+
+    def _new_id(self):
+        patient_id = self.ids.take()
+        if patient_id is None:
+            # Only before this desk first reached the server, or after a whole block was used offline
+            try:
+                self._reserve_ids()
+            except OFFLINE_ERRORS as error:
+                self._went_offline()
+                raise OfflineError("No patient IDs left for new patients until the server can be reached") from error
+            patient_id = self.ids.take()
+        return patient_id
+
+    def create(self, fields, patient_id=None):
+        record = self.local._new_record(fields, patient_id or self._new_id())
+        self._queue({"op": "create", "date": today(), "patient_id": record["patient_id"], "record": record})
+        self.local.store.add_record(today(), record)
+        return record["patient_id"]
+
+    def get(self, patient_id):
+        # Always answered from the local store, after copying the server's visit into it when
+        # it can be reached, so the desk's writes are checked against what it was shown
+        if self._online():
+            try:
+                self._copy_from_server([patient_id])
+            except OFFLINE_ERRORS:
+                self._went_offline()
+        return self.local.get(patient_id)
+
+    def update_medicine(self, patient_id, issued_medicine, additional_prescription, clear_old=False,
+                        expected_version=None):
+        # Only against the local copy, the syncer sorts out what changed on the server since
+        visit_date, record = self.local.get(patient_id)
+        if record is None:
+            return False
+        check_version(patient_id, record.get("version", 0), expected_version)
+        entry = new_entry(issued_medicine, clear_old) if issued_medicine or clear_old else None
+        self._queue({"op": "update", "date": today(), "patient_id": patient_id, "entry": entry,
+                     "additional_prescription": additional_prescription,
+                     "base_additional": record["additional_prescription"], "clear_old": clear_old})
+        return self.local.add_medicine(patient_id, entry, additional_prescription, clear_old)
+
+    def dispense(self, patient_id):
+        visit_date, record = self.local.get(patient_id)
+        if record is None or not undispensed_positions(record):
+            return 0
+        self._queue({"op": "dispense", "patient_id": patient_id,
+                     "dispensed_at": datetime.datetime.now().isoformat(timespec="seconds")})
+        return self.local.dispense(patient_id)
+
+    def list_day(self, date):
+        return self._read("list_day", date)
+
+    def search(self, query, date=None, limit=SEARCH_LIMIT):
+        return self._read("search", query, date, limit)
+
+    def find_by_name(self, query, limit=NAME_LIMIT):
+        return self._read("find_by_name", query, limit)
+
+    def pending_prescriptions(self, since=None):
+        # Marks from the server and the local store don't mix, so this one is server only
+        if not self._online():
+            raise OfflineError("The server can't be reached")
+        return self.remote.pending_prescriptions(since)
+
+    def daily_rollups(self, start=None, end=None):
+        return self._read("daily_rollups", start, end)
+
+    def rebuild_rollups(self):
+        self.remote.rebuild_rollups()
+
+    def sync(self):
+        """Send every queued write to the server, SYNC_BATCH per transaction. Returns how many were sent."""
+        sent = 0
+        with self.outbox.send_lock:
+            while True:
+                batch = self.outbox.pending(SYNC_BATCH)
+                if not batch:
+                    break
+                self._send([write for _, write in batch])
+                self.outbox.ack(batch[-1][0])
+                sent += len(batch)
+                # Take in what the server made of them, and what other desks wrote meanwhile
+                self._copy_from_server(write["patient_id"] for _, write in batch)
+        if self.ids.left() < ID_LOW_WATER:
+            self._reserve_ids()
+        elif not sent and not self._online():
+            # Nothing to send, only finding out whether the server is back
+            self._on_server(ping)
+        self.offline_until = 0
+        return sent
+
+    def _send(self, writes):
+        try:
+            self.conflicts += self._on_server(apply_writes, writes)
+        except OFFLINE_ERRORS:
+            raise
+        except errors.DatabaseError as error:
+            if len(writes) > 1:
+                # Send them one at a time to find the write the server turns down
+                for write in writes:
+                    self._send([write])
+            else:
+                if self._on_server(reject_write, writes[0], f"Rejected by the server: {error}"):
+                    self.conflicts += 1
+
+    def _sync_forever(self):
+        while True:
+            self.wake.wait(SYNC_INTERVAL)
+            self.wake.clear()
+            try:
+                self.sync()
+            except OFFLINE_ERRORS:
+                self._went_offline()
+            except Exception as error:
+                # Keep the thread alive, the writes stay queued for the next attempt
+                print(f"Sync failed: {error}", file=sys.stderr)
+
+    def sync_status(self):
+        """(writes still queued, whether the server was reachable last time, conflicts seen), for the desks."""
+        return len(self.outbox.pending()), self._online(), self.conflicts
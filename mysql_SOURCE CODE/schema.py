@@ -0,0 +1,227 @@
+# Single prescriptions table for every day. visit_date is appended after the original
+# columns so SELECT * rows keep the same positions as the old prescriptions_YYYY_MM_DD tables.
+# It is indexed on (visit_date, patient_id) for per-day lookups and on (patient_id, visit_date)
+# for a patient's history across days. The FULLTEXT index serves the pharmacy's medicine search.
+# version goes up with every medicine update, so a desk can tell if a visit changed since it read it.
+PRESCRIPTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS prescriptions (
+    prescription_id INT AUTO_INCREMENT PRIMARY KEY,
+    patient_id VARCHAR(16),
+    name VARCHAR(255),
+    blood_group VARCHAR(10),
+    age INT,
+    gender VARCHAR(10),
+    issued_medicine TEXT,
+    additional_prescription TEXT,
+    date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_login TIMESTAMP NULL,
+    visit_date DATE NOT NULL,
+    version INT NOT NULL DEFAULT 0,
+    INDEX idx_visit_patient (visit_date, patient_id),
+    INDEX idx_patient_visit (patient_id, visit_date),
+    FULLTEXT INDEX ft_prescription_text (issued_medicine, additional_prescription)
+)
+"""
+
+# Daily tables already copied into prescriptions by migrate_daily_tables.py
+MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS prescription_migrations (
+    table_name VARCHAR(64) PRIMARY KEY,
+    rows_copied INT NOT NULL,
+    migrated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+
+# Single-row counter behind patient ID allocation, see SQLdoctor.get_new_patient_id
+SEQUENCE_TABLE = """
+CREATE TABLE IF NOT EXISTS patient_id_sequence (
+    id TINYINT PRIMARY KEY,
+    last_id BIGINT NOT NULL
+)
+"""
+
+# One row per medicine issued, see mysql_repository.add_medication. prescriptions.issued_medicine
+# keeps only the text a visit started with, and the pharmacy marks rows dispensed.
+MEDICATION_HISTORY_TABLE = """
+CREATE TABLE IF NOT EXISTS medication_history (
+    entry_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    prescription_id INT NOT NULL,
+    patient_id VARCHAR(16) NOT NULL,
+    medicine TEXT NOT NULL,
+    issued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    issued_by VARCHAR(64),
+    clears_previous BOOLEAN NOT NULL DEFAULT FALSE,
+    dispensed_at TIMESTAMP NULL,
+    INDEX idx_history_prescription (prescription_id, entry_id),
+    INDEX idx_history_undispensed (patient_id, dispensed_at),
+    FULLTEXT INDEX ft_history_medicine (medicine),
+    FOREIGN KEY (prescription_id) REFERENCES prescriptions (prescription_id)
+)
+"""
+
+# Medicine still waiting at the pharmacy, newest visit first
+UNDISPENSED_VIEW = """
+CREATE OR REPLACE VIEW undispensed_medication AS
+SELECT h.entry_id, h.patient_id, p.name, p.visit_date, h.medicine, h.issued_at, h.issued_by
+FROM medication_history h JOIN prescriptions p ON p.prescription_id = h.prescription_id
+WHERE h.dispensed_at IS NULL AND h.medicine <> ''
+  -- Entries before one that cleared the old medicine are no longer prescribed
+  AND NOT EXISTS (SELECT 1 FROM medication_history c
+                  WHERE c.prescription_id = h.prescription_id AND c.clears_previous AND c.entry_id > h.entry_id)
+"""
+
+# Daily census and dispensing counts, bumped in the same transaction as every write.
+# See daily_rollups.py for the dimensions and mysql_repository.rebuild_rollups for backfills.
+ROLLUPS_TABLE = """
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    day DATE NOT NULL,
+    dimension VARCHAR(16) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    count INT NOT NULL,
+    PRIMARY KEY (day, dimension, value)
+)
+"""
+
+# Writes queued by offline-first desks, see offline_repository.py. Each queued write
+# carries a key that is recorded in the transaction applying it, so a batch resent
+# after a lost commit acknowledgement is never applied twice.
+SYNC_APPLIED_TABLE = """
+CREATE TABLE IF NOT EXISTS sync_applied (
+    idempotency_key CHAR(32) PRIMARY KEY,
+    desk VARCHAR(64),
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+# Queued writes that no longer fit what the server has, kept for someone to look at
+SYNC_CONFLICTS_TABLE = """
+CREATE TABLE IF NOT EXISTS sync_conflicts (
+    conflict_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    idempotency_key CHAR(32) NOT NULL,
+    patient_id VARCHAR(16),
+    operation TEXT NOT NULL,
+    reason VARCHAR(255) NOT NULL,
+    desk VARCHAR(64),
+    detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+# update_medicine for a batch of patients in one round trip, see mysql_repository.update_medicine_many.
+# It runs in the caller's transaction and leaves the commit, or rollback, to the caller. p_updates is a JSON array of {"patient_id", "day",
+# "additional_prescription", "entry", "rollups", "expected_version"}, where entry (a medication
+# entry) and expected_version may be left out. Each patient's latest visit is locked and only
+# changed if it is on day and, when expected_version is given, still at that version. Returns
+# one JSON array with ["updated", new version], ["stale", version], ["earlier", version] (the
+# latest visit is from an earlier day, left to the caller) or ["not found", null] per update.
+UPDATE_MEDICINE_PROCEDURE = """
+CREATE PROCEDURE update_medicine_batch(IN p_updates JSON)
+BEGIN
+    DECLARE i INT DEFAULT 0;
+    DECLARE v_update JSON;
+    DECLARE v_prescription_id INT;
+    DECLARE v_visit_date DATE;
+    DECLARE v_version INT;
+    DECLARE v_results JSON DEFAULT JSON_ARRAY();
+
+    WHILE i < JSON_LENGTH(p_updates) DO
+        SET v_update = JSON_EXTRACT(p_updates, CONCAT('$[', i, ']'));
+        SET v_prescription_id = NULL;
+        SELECT prescription_id, visit_date, version INTO v_prescription_id, v_visit_date, v_version
+        FROM prescriptions WHERE patient_id = JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.patient_id'))
+        ORDER BY visit_date DESC, prescription_id DESC LIMIT 1 FOR UPDATE;
+
+        IF v_prescription_id IS NULL THEN
+            SET v_results = JSON_ARRAY_APPEND(v_results, '$', JSON_ARRAY('not found', NULL));
+        ELSEIF v_visit_date <> JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.day')) THEN
+            SET v_results = JSON_ARRAY_APPEND(v_results, '$', JSON_ARRAY('earlier', v_version));
+        ELSEIF JSON_EXTRACT(v_update, '$.expected_version') IS NOT NULL
+               AND v_version <> JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.expected_version')) THEN
+            SET v_results = JSON_ARRAY_APPEND(v_results, '$', JSON_ARRAY('stale', v_version));
+        ELSE
+            UPDATE prescriptions
+            SET additional_prescription = JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.additional_prescription')),
+                version = version + 1
+            WHERE prescription_id = v_prescription_id;
+            IF JSON_EXTRACT(v_update, '$.entry') IS NOT NULL THEN
+                INSERT INTO medication_history (prescription_id, patient_id, medicine, issued_at, issued_by, clears_previous)
+                VALUES (v_prescription_id,
+                        JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.patient_id')),
+                        JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.entry.medicine')),
+                        JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.entry.issued_at')),
+                        JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.entry.issued_by')),
+                        JSON_UNQUOTE(JSON_EXTRACT(v_update, '$.entry.clears')));
+            END IF;
+            INSERT INTO daily_rollups (day, dimension, value, count)
+            SELECT r.day, r.dimension, r.value, r.count
+            FROM JSON_TABLE(v_update, '$.rollups[*]' COLUMNS (
+                day DATE PATH '$[0]',
+                dimension VARCHAR(16) PATH '$[1]',
+                value VARCHAR(255) PATH '$[2]',
+                count INT PATH '$[3]'
+            )) AS r
+            ON DUPLICATE KEY UPDATE count = daily_rollups.count + r.count;
+            SET v_results = JSON_ARRAY_APPEND(v_results, '$', JSON_ARRAY('updated', v_version + 1));
+        END IF;
+        SET i = i + 1;
+    END WHILE;
+    SELECT v_results;
+END
+"""
+
+PATIENT_ID_LENGTH = 16
+
+
+def create_tables(cursor):
+    cursor.execute(PRESCRIPTIONS_TABLE)
+    cursor.execute(MIGRATIONS_TABLE)
+    cursor.execute(SEQUENCE_TABLE)
+    cursor.execute(MEDICATION_HISTORY_TABLE)
+    cursor.execute(UNDISPENSED_VIEW)
+    cursor.execute(ROLLUPS_TABLE)
+    cursor.execute(SYNC_APPLIED_TABLE)
+    cursor.execute(SYNC_CONFLICTS_TABLE)
+
+    # Tables created before IDs were widened still have patient_id VARCHAR(3)
+    cursor.execute("""
+    SELECT CHARACTER_MAXIMUM_LENGTH FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'prescriptions' AND COLUMN_NAME = 'patient_id'
+    """)
+    if cursor.fetchone()[0] < PATIENT_ID_LENGTH:
+        cursor.execute(f"ALTER TABLE prescriptions MODIFY patient_id VARCHAR({PATIENT_ID_LENGTH})")
+
+    # Tables created before medicine search have no FULLTEXT index yet
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'prescriptions' AND INDEX_NAME = 'ft_prescription_text'
+    """)
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("ALTER TABLE prescriptions ADD FULLTEXT INDEX ft_prescription_text (issued_medicine, additional_prescription)")
+
+    # Tables created before row versions have no version column yet
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'prescriptions' AND COLUMN_NAME = 'version'
+    """)
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("ALTER TABLE prescriptions ADD COLUMN version INT NOT NULL DEFAULT 0")
+
+    # Servers set up before the batched medicine update have no procedure for it yet, and
+    # the first version of it committed on its own, so it is replaced
+    cursor.execute("""
+    SELECT ROUTINE_DEFINITION FROM information_schema.ROUTINES
+    WHERE ROUTINE_SCHEMA = DATABASE() AND ROUTINE_NAME = 'update_medicine_batch'
+    """)
+    routine = cursor.fetchone()
+    if routine is not None and "COMMIT" in (routine[0] or ""):
+        cursor.execute("DROP PROCEDURE update_medicine_batch")
+        routine = None
+    if routine is None:
+        cursor.execute(UPDATE_MEDICINE_PROCEDURE)
+
+    # Start the sequence after the highest numeric ID already handed out
+    cursor.execute("""
+    INSERT IGNORE INTO patient_id_sequence (id, last_id)
+    SELECT 1, COALESCE(MAX(CAST(patient_id AS UNSIGNED)), 0) FROM prescriptions
+    WHERE patient_id REGEXP '^[0-9]+$'
+    """)